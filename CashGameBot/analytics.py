@@ -0,0 +1,91 @@
+import itertools
+import threading
+from collections import namedtuple
+from metrics import registry
+
+# --- READ ME! ---:
+# This file holds every player's stats over the finished sessions of a ledger.
+#
+# for usage in file, write:
+# 'from analytics import PlayerAnalytics, PlayerStats'
+#
+# Balances owns a PlayerAnalytics; use it through Balances.get_player_stats(user), which returns a PlayerStats:
+# sessions_played, bought_in, cashed_out, net, roi, biggest_win, biggest_loss, hours_played, and history: a
+# (session_end, result, running_net) tuple for every session they played, oldest first.
+#
+# Only buy-ins and cash-outs of finished sessions count, from the player's side of the table (a banker's stats don't
+# include what went through the bank). Payments outside sessions don't count either, so 'net' here is what the player
+# won or lost at the table, not their net_gain on the leaderboard.
+#
+# The stats only change when a session ends, so they're worked out for every player at once on first use, kept in
+# memory, and worked out again after the next Balances.end_session. The work happens in the database: two GROUP BY
+# queries over debt_history and sessions (see Balances.get_session_totals and Balances.iter_session_results), so the
+# cost of a refresh is a couple of round trips no matter how long the history is.
+
+
+# ------------- CLASSES -------------
+
+
+# class PlayerStats holds one player's totals over every finished session they played. Money amounts are Decimals.
+# Initialize: stats = PlayerStats(player_id, sessions_played, bought_in, cashed_out, biggest_win, biggest_loss,
+#   seconds_played, history)
+class PlayerStats(namedtuple("PlayerStats", ["player_id", "sessions_played", "bought_in", "cashed_out", "biggest_win",
+                                             "biggest_loss", "seconds_played", "history"])):
+    __slots__ = ()
+
+    @property
+    def net(self):
+        return self.cashed_out - self.bought_in
+
+    # Net result per dollar bought in (0.25 is +25%), or None if they never bought in.
+    @property
+    def roi(self):
+        if not self.bought_in:
+            return None
+        return self.net / self.bought_in
+
+    @property
+    def hours_played(self):
+        return self.seconds_played / 3600
+
+
+# class PlayerAnalytics keeps the PlayerStats of every player of one Balances. Thread-safe.
+# Initialize: analytics = PlayerAnalytics(balances)
+class PlayerAnalytics:
+    def __init__(self, balances):
+        self.balances = balances
+        self.lock = threading.Lock()
+        # player_id -> PlayerStats, None until loaded and after a session ends
+        self.stats = None
+        # goes up on every invalidate, so stats loaded from before a session ended are never kept
+        self.generation = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.stats = None
+            self.generation += 1
+
+    def __load(self):
+        histories = {player_id: list(rows) for player_id, rows
+                     in itertools.groupby(self.balances.iter_session_results(), key=lambda row: row[0])}
+        stats = {}
+        # totals are [player_id, sessions_played, bought_in, cashed_out, biggest_win, biggest_loss, seconds_played]
+        for totals in self.balances.get_session_totals():
+            history = [row[1:] for row in histories.get(totals[0], [])]
+            stats[totals[0]] = PlayerStats(*totals, history)
+        return stats
+
+    # Returns {player_id: PlayerStats} for every player who has played a finished session.
+    def get_all(self):
+        stats = self.stats
+        registry.cache("stats", stats is not None)
+        if stats is None:
+            generation = self.generation
+            stats = self.__load()
+            with self.lock:
+                if self.generation == generation:
+                    self.stats = stats
+        return stats
+
+    def get(self, player_id):
+        return self.get_all().get(player_id)
@@ -0,0 +1,61 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# --- READ ME! ---:
+# This file lets the bot's async command handlers use the database without blocking the discord.py event loop.
+#
+# TO USE:
+#
+# for usage in file, write:
+# 'from async_balances import AsyncBalances'
+#
+# AsyncBalances wraps a Balances object. Every public Balances method is available on AsyncBalances as a coroutine
+# taking the same arguments, e.g.:
+#     balances = AsyncBalances(Balances())
+#     plr = await balances.get_player(user)
+#
+# Calls run on a bounded thread pool of at most MAX_WORKERS threads (and no more than the Balances connection pool
+# size), so a slow query only ties up one worker instead of stalling every guild and the gateway heartbeat. When more
+# calls are waiting than there are workers, the extra calls queue inside the executor rather than spawning threads.
+# Several AsyncBalances (e.g. one per guild) can share one pool: AsyncBalances(balances, executor=executor).
+
+
+# ------------- CONSTANTS -------------
+
+
+MAX_WORKERS = 4
+
+
+# ------------- CLASSES -------------
+
+
+# class AsyncBalances runs Balances methods on a thread pool and exposes them as coroutines.
+# Initialize: async_balances = AsyncBalances(balances) or AsyncBalances(balances, max_workers) or
+#   AsyncBalances(balances, executor=executor)
+class AsyncBalances:
+    def __init__(self, balances, max_workers=None, executor=None):
+        self.balances = balances
+        # a shared executor belongs to whoever created it, and isn't shut down by close()
+        self.owns_executor = executor is None
+        if executor is None:
+            if max_workers is None:
+                # more workers than pooled connections would only leave threads waiting on the pool
+                max_workers = min(MAX_WORKERS, getattr(balances, "pool_size", MAX_WORKERS))
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="balances")
+        self.executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self.balances, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        async def run_in_executor(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(attr, *args, **kwargs))
+
+        return run_in_executor
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=True)
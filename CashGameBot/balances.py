@@ -1,9 +1,18 @@
 import datetime
-import mysql.connector
-from mysql.connector import Error
-# make file 'sql_password.py' and define PASS = <server_password>. Do not commit this file to repo
-from sql_password import PASS
-import pandas as pd
+import logging
+import threading
+import time
+from analytics import PlayerAnalytics
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from events import check_debt_type, make_event, DEBT_TYPES, EVENT_TYPES, MONEY_EVENTS
+from leaderboard import Leaderboard
+from metrics import registry, query_label
+from migrations import migrate
+from projections import ProjectionDelta, BalanceProjection, PairProjection
+from sessions import Session, SessionState, DEFAULT_TABLE
+from storage import make_backend, POOL_SIZE
 
 # --- READ ME! ---:
 # This file acts as main database interaction for the bot.
@@ -13,72 +22,93 @@ import pandas as pd
 # for usage in file, write:
 # 'from balances import Balances'
 #
-# Balances is the class used for interaction with the MySQL database
+# Balances is the class used for interaction with the database. It runs on a storage backend (see storage.py): the
+# MySQL server by default, or an embedded SQLite file, picked by the CASHGAMEBOT_BACKEND environment variable or passed
+# in as Balances(backend=...). Creating a Balances applies any pending schema migrations (see migrations.py); run
+# 'python migrations.py' once to create a MySQL database itself.
+# Money amounts are Decimals rounded to the cent (see to_money).
+# From async code (e.g. the bot's command handlers) wrap it in AsyncBalances (see async_balances.py) and await its
+# methods, so database round trips don't block the event loop.
 #
 # RELEVANT FUNCTIONS:
 # Balances.get_players() returns list of all players as Player objects (holding their name and balance)
 # Balances.get_debts() returns list with full debt history as Debt objects (including debt_type, recipient_id,
 #     payer_id, amount, date)
+# Balances.iter_players() / Balances.iter_debts(after_debt_id) yield the same records one at a time, streamed from the
+#     database in chunks, for reading large tables with bounded memory
+# Balances.iter_events(after_event_id) yields every event of the log (see below), session starts and ends included
+# Balances.get_counterparty_totals(user) returns [counterparty_id, amount] pairs: the net amount owed between 'user'
+#     and each other player (positive: owed to 'user'). Read from the pair_balances projection
 # Balances.get_player(player_id) gets player with id 'player_id', returns as a Player object
-# Balances.update_player_balance(player_id, balance) sets new balance to 'balance' for player with id 'player_id'
-# Balances.add_player_net(player_id, amount) adds 'amount' to total net gains of player with id 'player_id'
-# Balances.update_player_net(player_id, net) sets new total net gains to 'net' for player with id 'player_id'
-# Balances.add_player_net(player_id, amount) adds 'amount' to balance of player with id 'player_id'
+# Balances.get_leaderboard() returns [rank, name, net] for every player, highest net first. Served from memory
+# Balances.get_rank(user) returns the leaderboard rank of 'user', or None if they're not a player
 # Balances.add_player(player_name) adds a player of name 'player_name' to the database
 # Balances.add_debt(debt_type, recipient_id, payer_id, amount) adds a new debt to database with provided parameters
-# Balances.refresh_balances() recalculates and updates all player balances based solely on debt history
+# Balances.add_debts(debts) adds a list of (debt_type, recipient, payer, amount) debts in one transaction
+# Balances.void_debt(debt_id) voids a debt by appending its reversal, and returns the voided Debt
+# Balances.undo_last(table_key) voids the latest debt not voided yet of the session running at a table, or outside
+#     every running session if none is. Balances.get_voidable_debts(count) lists the latest debts not voided yet
+# Balances.get_journal_seq(journal_key) returns the last write-behind journal entry recorded (see write_behind.py)
+# Balances.refresh_balances(full, checkpoint_id) rebuilds every projection from the event log and returns how many
+#     seconds it took. full=False starts from the last checkpoint (or checkpoint 'checkpoint_id'): a stored snapshot of
+#     every projection, saved whenever no session is running. Only needed for audits and repairs, see below
+# Balances.start_session(bank_id, table_key) / Balances.end_session(table_key) start and end the session at a table
+#     (see sessions.py). Several tables can run sessions at once
+# Balances.get_session(table_key) returns the Session running at a table, or None. Served from memory
+# Balances.get_session_ledger(table_key) returns the SessionLedger (buy-ins, cash-outs, chips in play and every
+#     player's result so far) of the session running at a table, or None. Served from memory
+# Balances.get_player_stats(user) returns the PlayerStats of 'user' over every finished session (see analytics.py), or
+#     None if they haven't played one. Cached, and only worked out again after a session ends
+# Balances.get_session_totals() / Balances.iter_session_results() give the per-player session totals and results
+#     those stats are built from, summed up by the database
+# Balances.iter_records() / Balances.import_records(records) stream the whole ledger out, and bulk load one in (see
+#     ledger_io.py for the file formats)
+# Balances.get_checkpoint(checkpoint_id) returns (checkpoint_id, last_debt_id) of the latest checkpoint (or of
+#     'checkpoint_id'), or None. Only the latest CHECKPOINTS_KEPT checkpoints of a guild are kept
+# Balances.version is a counter that goes up whenever a player, balance or net gain changes (add_debt(s), add_player,
+#     void_debt, end_session and refresh_balances). Output built from the ledger can be cached under it and reused
+#     for as long as it's unchanged (see render_cache.py)
+#
+# debt_history is the ledger's event log (see events.py): every debt, and every session's start and end, is an event
+# appended to it and never changed afterwards. Every other figure is a projection of the log (see projections.py):
+# player balances and net gains, what every pair of players owe each other, and the leaderboard. Each method appending
+# events updates every projection in the same transaction, by exactly what the events change, so reads are always
+# served from up-to-date projections and nothing ever sets a balance by hand. refresh_balances rebuilds the projections
+# from the log (in parallel, each in its own transaction), e.g. after editing the database by hand.
+#
+# Every Balances holds the ledger of one discord guild (server), Balances(guild_id=...): every row it reads or writes
+# carries that guild_id, so guilds sharing a database never see each other's players, debts, sessions or leaderboard.
+# To get the Balances of any guild, routed to the database shard that guild lives on, use a LedgerRouter (see
+# sharding.py).
+#
+# Every statement Balances runs is timed and counted in metrics.registry (see metrics.py), grouped by query_label.
 
 
 # ------------- CONSTANTS -------------
 
 
-DATABASE_NAME = "cashgamebot"
-
-
-# ------------- FUNCTIONS -------------
-
-
-def create_server_connection(host_name, user_name, user_password):
-    connection = None
-    try:
-        connection = mysql.connector.connect(
-            host=host_name,
-            user=user_name,
-            passwd=user_password
-        )
-        print("MySQL Database connection successful")
-    except Error as err:
-        print(f"Error: '{err}'")
-
-    return connection
-
-
-def get_connection():
-    return create_server_connection("localhost", "root", PASS)
+CENT = Decimal("0.01")
+# largest amount a DECIMAL(12, 2) money column holds
+MAX_AMOUNT = Decimal("9999999999.99")
+# rows fetched per round trip when streaming query results
+CHUNK_SIZE = 1000
+# checkpoints kept per guild: saving one deletes the ones before the latest CHECKPOINTS_KEPT
+CHECKPOINTS_KEPT = 3
+# guild_id of ledgers that don't belong to a particular guild, including everything recorded before guilds had their
+#   own ledgers (see migrations.py to hand those over to a guild)
+DEFAULT_GUILD = 0
+# SQL condition picking the events that move money out of debt_history, i.e. the debts (see events.py)
+DEBT_FILTER = f"debt_type IN ({', '.join(f"'{event_type}'" for event_type in MONEY_EVENTS)})"
 
+logger = logging.getLogger(__name__)
 
-def __make_database(connection):
-    query = f"""
-    CREATE DATABASE {DATABASE_NAME};
 
-    USE {DATABASE_NAME};
+# ------------- FUNCTIONS -------------
 
-    CREATE TABLE debt_history (
-        debt_type VARCHAR(20),
-        recipient_id INT,
-        payer_id INT,
-        amount FLOAT,
-        date DATE
-    );
 
-    CREATE TABLE player_data (
-        player_id INT,
-        player_name VARCHAR(25),
-        balance INT
-    );
-    """
-    cursor = connection.cursor()
-    cursor.execute(query)
+# Rounds 'amount' to the cent as a Decimal, matching the DECIMAL(12, 2) money columns.
+def to_money(amount):
+    return Decimal(str(amount)).quantize(CENT)
 
 
 def get_current_time_sql():
@@ -88,18 +118,23 @@ def get_current_time_sql():
 def sql_time_to_datetime(sql_time):
     return datetime.datetime.strptime(sql_time, '%Y-%m-%d %H:%M:%S')
 
+
+# MySQL hands back DATETIME columns as datetime objects, SQLite as text
+def to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return sql_time_to_datetime(str(value))
+
 # ------------- CLASSES -------------
 
 
 # class Player contains a player's player_id, name, balance and net winnings. Used to compare different players and
-#   balances with ease
+#   balances with ease. Players are immutable named tuples with no per-instance __dict__.
+#   Players order by net winnings (ties broken by player_id, then name and balance), so sorting a list of players ranks
+#   them like the leaderboard. Two Players are equal, and hash the same, only if every field matches.
 # Initialize: plr = Player(player_id, name, balance, net)
-class Player:
-    def __init__(self, player_id, name, balance, net):
-        self.player_id = player_id
-        self.name = name
-        self.balance = balance
-        self.net = net
+class Player(namedtuple("Player", ["player_id", "name", "balance", "net"])):
+    __slots__ = ()
 
     def __str__(self):
         return (f'{self.player_id} - {self.name} - '
@@ -108,35 +143,30 @@ class Player:
     def __repr__(self):
         return self.__str__()
 
-    def __eq__(self, other):
-        return self.player_id == other.player_id
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def sort_key(self):
+        return self.net, self.player_id, self.name, self.balance
 
     def __lt__(self, other):
-        return self.net < other.net
+        return self.sort_key() < other.sort_key()
 
     def __le__(self, other):
-        return self.net <= other.net
+        return self.sort_key() <= other.sort_key()
 
     def __gt__(self, other):
-        return self.net > other.net
+        return self.sort_key() > other.sort_key()
 
     def __ge__(self, other):
-        return self.net >= other.net
+        return self.sort_key() >= other.sort_key()
 
 
-# class Debt contains a debt's debt_type, recipient_id, payer_id, amount and date added. Used to interact
-#   with individual debts more easily.
-# Initialize: debt = Debt(debt_type, recipient_id, payer_id, amount, date)
-class Debt:
-    def __init__(self, debt_type, recipient_id, payer_id, amount, date):
-        self.debt_type = debt_type
-        self.recipient_id = recipient_id
-        self.payer_id = payer_id
-        self.amount = amount
-        self.date = date
+# class Debt contains a debt's debt_type, recipient_id, payer_id, amount, date added and debt_id. Used to interact
+#   with individual debts more easily. Debts are immutable named tuples with no per-instance __dict__.
+#   Debts order by date, then debt_id. Two Debts are equal, and hash the same, only if every field matches.
+# Initialize: debt = Debt(debt_type, recipient_id, payer_id, amount, date) or
+#   Debt(debt_type, recipient_id, payer_id, amount, date, debt_id)
+class Debt(namedtuple("Debt", ["debt_type", "recipient_id", "payer_id", "amount", "date", "debt_id"],
+                      defaults=(None,))):
+    __slots__ = ()
 
     def __str__(self):
         return (f"Debt type: {self.debt_type}\n"
@@ -148,221 +178,854 @@ class Debt:
     def __repr__(self):
         return self.__str__()
 
-    def __hash__(self):
-        return hash((self.debt_type, self.recipient_id, self.payer_id, self.amount, self.date))
+    def sort_key(self):
+        return self.date, self.debt_id or 0, self.debt_type, self.recipient_id, self.payer_id, self.amount
+
+    def __lt__(self, other):
+        return self.sort_key() < other.sort_key()
 
-    def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+    def __le__(self, other):
+        return self.sort_key() <= other.sort_key()
+
+    def __gt__(self, other):
+        return self.sort_key() > other.sort_key()
+
+    def __ge__(self, other):
+        return self.sort_key() >= other.sort_key()
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+
+# class ImportResult holds what Balances.import_records added: how many players, sessions and debts, the sum of every
+#   player's balance afterwards (0 when the ledger reconciles), [player_id, expected (balance, net_gain), actual
+#   (balance, net_gain)] for every imported player whose rebuilt totals differ from the ones in the import, and how
+#   many sessions of the import were still running and got ended (their net winnings count now, so the players in
+#   them differ from the import).
+# Initialize: result = ImportResult(players, sessions, debts, balance_total, mismatches, ended_sessions)
+class ImportResult(namedtuple("ImportResult", ["players", "sessions", "debts", "balance_total", "mismatches",
+                                               "ended_sessions"], defaults=(0,))):
+    __slots__ = ()
+
+    def reconciles(self):
+        return self.balance_total == 0 and not self.mismatches
 
 
 # class Balances allows direct interaction with the database.
-# Initialize: balances = Balances()
+# Balances is safe to share between threads (see async_balances.py): every round trip gets its own connection from the
+#   backend (a pool of 'pool_size' connections for MySQL, one connection per thread for SQLite).
+# Initialize: balances = Balances(pool_size) or Balances(backend=backend, guild_id=guild_id)
 class Balances:
-    def __init__(self):
-        self.connection = get_connection()
+    def __init__(self, pool_size=POOL_SIZE, backend=None, guild_id=DEFAULT_GUILD):
+        self.guild_id = int(guild_id)
+        self.backend = backend or make_backend(pool_size=pool_size)
+        self.pool_size = self.backend.pool_size
+        migrate(self.backend)
+        self.sessions = SessionState()
+        self.sessions.load(self.__load_sessions())
+        self.__load_session_ledgers()
+        # loaded from the database on first use, then kept up to date by every method that changes net_gain
+        self.leaderboard = None
+        self.version = 0
+        self.version_lock = threading.Lock()
+        # player stats over finished sessions, worked out on first use and again after every end_session
+        self.analytics = PlayerAnalytics(self)
+        # every table built from the event log, kept up to date by the methods appending events
+        self.projections = [BalanceProjection(self.backend, self.guild_id), PairProjection(self.backend, self.guild_id)]
+        # held while starting or ending a session, so two commands can't start one at the same table, and while voiding
+        #   a debt, so it's voided once and counted in its session or not, never both
+        self.session_lock = threading.Lock()
+
+    def __bump_version(self):
+        with self.version_lock:
+            self.version += 1
+
+    # Runs one statement on 'cursor', recording how long it took and the round trip in metrics.registry.
+    def __run(self, cursor, query, params=None):
+        label = query_label(query)
+        start_time = time.perf_counter()
+        try:
+            if params is None:
+                cursor.execute(self.backend.sql(query))
+            else:
+                cursor.execute(self.backend.sql(query), params)
+        except self.backend.Error:
+            registry.inc("db_errors_total", query=label)
+            raise
+        finally:
+            registry.observe("db_query_seconds", time.perf_counter() - start_time, query=label)
+            registry.inc("db_round_trips_total", query=label)
+
+    # Runs 'query' once for every params tuple in 'rows' (one executemany), recording it like __run.
+    def __run_many(self, cursor, query, rows):
+        label = query_label(query)
+        start_time = time.perf_counter()
+        try:
+            cursor.executemany(self.backend.sql(query), rows)
+        except self.backend.Error:
+            registry.inc("db_errors_total", query=label)
+            raise
+        finally:
+            registry.observe("db_query_seconds", time.perf_counter() - start_time, query=label)
+            registry.inc("db_round_trips_total", query=label)
+
+    def __commit(self, connection):
+        with registry.time("db_query_seconds", query="COMMIT"):
+            connection.commit()
+        registry.inc("db_round_trips_total", query="COMMIT")
 
     def __execute_query(self, query):
-        cursor = self.connection.cursor()
         try:
-            cursor.execute(query)
-            self.connection.commit()
-            return cursor.rowcount
-        except Error as err:
-            print(f"Error: '{err}'")
-
-    def __get_table(self, table_name):
-        self.__execute_query("USE cashgamebot")
-        query = f"SELECT * FROM {table_name}"
+            with self.backend.connection() as connection:
+                cursor = connection.cursor()
+                self.__run(cursor, query)
+                self.__commit(connection)
+                return cursor.rowcount
+        except self.backend.Error as err:
+            logger.error("Query failed: '%s'", err)
+
+    # Runs 'query' with 'params' and returns the id it generated, or None on error. 'follow_up' is a function of that id
+    #   returning more queries (SQL strings or (SQL string, params) tuples) to run in the same transaction.
+    def __execute_insert(self, query, params, follow_up=None):
         try:
-            pd_table = pd.read_sql(query, self.connection)
-            return pd_table
-        except Exception as e:
-            print(str(e))
+            with self.backend.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    self.__run(cursor, query, params)
+                    row_id = cursor.lastrowid
+                    for follow_up_query in (follow_up(row_id) if follow_up else []):
+                        if isinstance(follow_up_query, tuple):
+                            self.__run(cursor, follow_up_query[0], follow_up_query[1])
+                        else:
+                            self.__run(cursor, follow_up_query)
+                    self.__commit(connection)
+                except self.backend.Error:
+                    connection.rollback()
+                    raise
+                return row_id
+        except self.backend.Error as err:
+            logger.error("Query failed: '%s'", err)
+
+    # Runs all of 'queries' on one connection and commits once at the end. If any query fails, none of them take
+    #   effect. Each query is either a SQL string or a (SQL string, params) tuple. Returns the total row count, or None
+    #   on error. 'guard' is a (SQL string, params) tuple run first: if it changes no rows, nothing else runs and 0 is
+    #   returned.
+    def __execute_transaction(self, queries, guard=None):
+        try:
+            with self.backend.connection() as connection:
+                cursor = connection.cursor()
+                row_count = 0
+                try:
+                    if guard:
+                        self.__run(cursor, guard[0], guard[1])
+                        if cursor.rowcount < 1:
+                            connection.rollback()
+                            return 0
+                    for query in queries:
+                        if isinstance(query, tuple):
+                            self.__run(cursor, query[0], query[1])
+                        else:
+                            self.__run(cursor, query)
+                        row_count += max(cursor.rowcount, 0)
+                    self.__commit(connection)
+                except self.backend.Error:
+                    connection.rollback()
+                    raise
+                return row_count
+        except self.backend.Error as err:
+            logger.error("Transaction failed, rolled back: '%s'", err)
+
+    # Yields the rows of 'query' as tuples, fetching CHUNK_SIZE rows from the database at a time so memory stays bounded
+    #   however big the result is. The connection is held until the generator is exhausted or closed.
+    def __iter_rows(self, query, params=()):
+        with self.backend.connection() as connection:
+            cursor = connection.cursor()
+            label = query_label(query)
+            try:
+                self.__run(cursor, query, params)
+                while True:
+                    rows = cursor.fetchmany(CHUNK_SIZE)
+                    registry.inc("db_round_trips_total", query=label)
+                    if not rows:
+                        return
+                    yield from rows
+            finally:
+                try:
+                    cursor.close()
+                except self.backend.Error:
+                    pass
+
+    def __fetch_one(self, query, params=()):
+        with self.backend.connection() as connection:
+            cursor = connection.cursor()
+            self.__run(cursor, query, params)
+            rows = cursor.fetchall()
+            return rows[0] if rows else None
+
+    # Decimal amount of a money column read back from the database (see store_money and load_money in storage.py).
+    def __money(self, value):
+        return to_money(self.backend.load_money(value))
+
+    def iter_players(self):
+        for player_id, player_name, balance, net in self.__iter_rows(
+                "SELECT player_id, player_name, balance, net_gain FROM player_data WHERE guild_id = %s",
+                (self.guild_id,)):
+            yield Player(player_id, player_name, self.__money(balance), self.__money(net))
 
     def get_players(self):
-        player_data = self.__get_table("player_data")
-        players = []
-        for i in player_data.index:
-            player_id = player_data['player_id'][i]
-            player_name = player_data['player_name'][i]
-            balance = player_data['balance'][i]
-            net = player_data['net_gain'][i]
-            new_plr = Player(player_id, player_name, balance, net)
-            players.append(new_plr)
-        return players
+        return list(self.iter_players())
+
+    # Yields every debt in debt_history, oldest first, as Debt objects. 'after_debt_id' skips debts up to that id.
+    #   Session starts and ends aren't debts and are left out.
+    def iter_debts(self, after_debt_id=0):
+        for debt_id, debt_type, recipient_id, payer_id, amount, date in self.__iter_debt_rows(after_debt_id):
+            yield Debt(debt_type, recipient_id, payer_id, self.__money(amount), to_datetime(date), debt_id)
+
+    def __iter_debt_rows(self, after_debt_id=0):
+        return self.__iter_rows(f"SELECT debt_id, debt_type, recipient_id, payer_id, amount, date FROM debt_history "
+                                f"WHERE guild_id = %s AND debt_id > %s AND {DEBT_FILTER} ORDER BY debt_id",
+                                (self.guild_id, after_debt_id))
+
+    # Yields every event in the log after 'after_event_id', oldest first, as typed events (see events.py).
+    def iter_events(self, after_event_id=0):
+        query = ("SELECT debt_type, recipient_id, payer_id, amount, date, session_id, debt_id, reverses_id "
+                 "FROM debt_history WHERE guild_id = %s AND debt_id > %s ORDER BY debt_id")
+        for (event_type, recipient_id, payer_id, amount, date, session_id, event_id,
+             reverses_id) in self.__iter_rows(query, (self.guild_id, after_event_id)):
+            yield make_event(event_type, recipient_id, payer_id, self.__money(amount), to_datetime(date), session_id,
+                             event_id, reverses_id)
 
     def get_debts(self):
-        debt_history = self.__get_table("debt_history")
-        debts = []
-        for i in debt_history.index:
-            debt_type = debt_history['debt_type'][i]
-            recipient_id = debt_history['recipient_id'][i]
-            payer_id = debt_history['payer_id'][i]
-            amount = debt_history['amount'][i]
-            date = debt_history['date'][i]
-            new_debt = Debt(debt_type, recipient_id, payer_id, amount, date)
-            debts.append(new_debt)
-        return debts
-
-    def get_session_debts(self):
-        session = self.get_session()
-        if not session[0]:
-            return False
-        debt_history = self.__get_table("debt_history")
-        debts = []
-        for i in debt_history.index:
-            date = sql_time_to_datetime(str(debt_history['date'][i]))
-            amount = debt_history['amount'][i]
-            if date > session[1] and amount > 0:
-                debt_type = debt_history['debt_type'][i]
-                recipient_id = debt_history['recipient_id'][i]
-                payer_id = debt_history['payer_id'][i]
-                new_debt = Debt(debt_type, recipient_id, payer_id, amount, date)
-                debts.append(new_debt)
-        return debts
-
-    def update_player_balance(self, balance, user):
-        self.__execute_query("USE cashgamebot")
-        query = (f"UPDATE player_data "
-                 f"SET balance = {balance} "
-                 f"WHERE player_id = {user.id}")
-        row_count = self.__execute_query(query)
-        if not row_count or row_count < 1:
-            return False
-        return balance
-
-    def add_player_balance(self, amount, user):
-        self.__execute_query("USE cashgamebot")
-        current_balance = self.get_player(user).balance
-        query = (f"UPDATE player_data "
-                 f"SET balance = {current_balance + amount} "
-                 f"WHERE player_id = {user.id}")
-        row_count = self.__execute_query(query)
-        if not row_count or row_count < 1:
-            return False
-        return current_balance + amount
-
-    def update_player_net(self, net, user):
-        self.__execute_query("USE cashgamebot")
-        query = (f"UPDATE player_data "
-                 f"SET net_gain = {net} "
-                 f"WHERE player_id = {user.id}")
-        row_count = self.__execute_query(query)
-        if not row_count or row_count < 1:
-            return False
-        return net
-
-    def add_player_net(self, amount, user):
-        self.__execute_query("USE cashgamebot")
-        current_net = self.get_player(user).net
-        query = (f"UPDATE player_data "
-                 f"SET net_gain = {current_net + amount} "
-                 f"WHERE player_id = {user.id}")
-        row_count = self.__execute_query(query)
-        if not row_count or row_count < 1:
+        return list(self.iter_debts())
+
+    # Returns [counterparty_id, amount] for everyone 'user' has debts with, where amount is the net owed to 'user'
+    #   (negative: owed by 'user'). Read from the pair_balances projection, one row per counterparty, so the cost
+    #   doesn't depend on the size of the history.
+    def get_counterparty_totals(self, user):
+        query = ("SELECT counterparty_id, amount FROM pair_balances "
+                 "WHERE guild_id = %s AND player_id = %s AND amount <> 0 ORDER BY counterparty_id")
+        return [[counterparty_id, self.__money(amount)]
+                for counterparty_id, amount in self.__iter_rows(query, (self.guild_id, user.id))]
+
+    # Returns the debts of the session running at 'table_key', found through the session_id index, or False if no
+    #   session is running there.
+    def get_session_debts(self, table_key=DEFAULT_TABLE):
+        session = self.get_session(table_key)
+        if not session:
             return False
-        return current_net + amount
+        query = (f"SELECT debt_id, debt_type, recipient_id, payer_id, amount, date FROM debt_history "
+                 f"WHERE session_id = %s AND {DEBT_FILTER} ORDER BY debt_id")
+        return [Debt(debt_type, recipient_id, payer_id, self.__money(amount), to_datetime(date), debt_id)
+                for debt_id, debt_type, recipient_id, payer_id, amount, date
+                in self.__iter_rows(query, (session.session_id,))]
 
     def get_player(self, user):
-        self.__execute_query("USE cashgamebot")
-        query = (f"SELECT * "
-                 f"FROM player_data "
-                 f"WHERE player_id = {user.id}")
-        plr = pd.read_sql(query, self.connection)
-        if not plr.empty:
-            return Player(plr.iloc[0]['player_id'], plr.iloc[0]['player_name'], plr.iloc[0]['balance'],
-                          plr.iloc[0]['net_gain'])
+        query = ("SELECT player_id, player_name, balance, net_gain "
+                 "FROM player_data "
+                 "WHERE guild_id = %s AND player_id = %s")
+        plr = self.__fetch_one(query, (self.guild_id, user.id))
+        if plr:
+            return Player(plr[0], plr[1], self.__money(plr[2]), self.__money(plr[3]))
         return None
 
-    def add_debt(self, debt_type, recipient, payer, amount):
-        self.__execute_query("USE cashgamebot")
-        query = (f"INSERT INTO debt_history (debt_type, recipient_id, payer_id, amount, date) VALUES "
-                 f"('{debt_type}', {recipient.id}, {payer.id}, {amount}, "
-                 f"'{get_current_time_sql()}')")
-        self.__execute_query(query)
-        self.add_player_balance(amount, recipient)
-        self.add_player_balance(-amount, payer)
-        if amount >= 0 and not self.get_session()[0]:
-            self.add_player_net(amount, recipient)
-            self.add_player_net(-amount, payer)
+    def add_debt(self, debt_type, recipient, payer, amount, table_key=None):
+        return self.add_debts([(debt_type, recipient, payer, amount)], table_key)
+
+    # Adds every (debt_type, recipient, payer, amount) in 'debts' in a single transaction: one multi-row INSERT of their
+    #   events into debt_history, then every projection updated by exactly what they change (one relative UPDATE of
+    #   player_data, one upsert of pair_balances). Either all of the debts are recorded or none are, and concurrent
+    #   calls can't overwrite each other's changes. Pass the 'table_key' of the session the debts belong to, if any:
+    #   they're tagged with its session_id and added to its SessionLedger, and count towards balance but not net_gain
+    #   until the session ends. Returns True on success, False otherwise. Raises ValueError on a debt_type that isn't
+    #   a debt (see DEBT_TYPES in events.py).
+    # A debt can carry the time it was made as a fifth item ('%Y-%m-%d %H:%M:%S'), otherwise it's dated now.
+    #   'journal' is a (journal_key, seq) pair: journal_state is moved to 'seq' in the same transaction, so a
+    #   write-behind journal knows exactly which of its entries made it to the database (see write_behind.py). The
+    #   watermark only ever moves forward: if it's at 'seq' or past it already, the debts were recorded before (e.g. a
+    #   batch replayed after a newer one, or two flushers racing), so nothing is added and True is returned.
+    # With a 'table_key', the session is looked up and the debts written under session_lock, so the session can't end
+    #   in between and leave them tagged with a session that's over.
+    def add_debts(self, debts, table_key=None, journal=None):
+        if not debts:
+            return True
+        if table_key is None:
+            return self.__add_debts(debts, None, journal)
+        with self.session_lock:
+            return self.__add_debts(debts, table_key, journal)
+
+    # Called with session_lock held if 'table_key' isn't None.
+    def __add_debts(self, debts, table_key, journal):
+        session = self.get_session(table_key) if table_key is not None else None
+        session_id = session.session_id if session else None
+        now = get_current_time_sql()
+        events = []
+        for debt in debts:
+            debt_type, recipient, payer, amount = debt[:4]
+            check_debt_type(debt_type)
+            events.append(make_event(debt_type, recipient.id, payer.id, to_money(amount),
+                                     debt[4] if len(debt) > 4 else now, session_id))
+        delta = ProjectionDelta([session_id] if session else ()).apply(events)
+        queries = [self.__event_insert_query(events)] + self.__projection_queries(delta)
+        guard = None
+        if journal:
+            # taken first, so a concurrent batch of the same journal waits for this one, then finds the watermark moved
+            guard = ("UPDATE journal_state SET last_seq = %s "
+                     "WHERE guild_id = %s AND journal_key = %s AND last_seq < %s",
+                     (journal[1], self.guild_id, journal[0], journal[1]))
+        row_count = self.__execute_transaction(queries, guard)
+        if row_count is None:
+            return False
+        # the INSERT always adds rows, so 0 means the guard found the journal entries recorded already
+        if row_count == 0:
+            logger.warning("Journal '%s' is already past entry %s, skipped its debts", journal[0], journal[1])
+            return True
+        if session:
+            ledger = self.sessions.get_ledger(table_key)
+            if ledger:
+                for event in events:
+                    ledger.apply(event.event_type, event.recipient_id, event.payer_id, event.amount)
+        self.__update_leaderboard(delta.net_changes)
+        self.__bump_version()
+        return True
+
+    # Builds one multi-row INSERT appending 'events' to debt_history, as a (SQL string, params) tuple.
+    def __event_insert_query(self, events):
+        query = ("INSERT INTO debt_history "
+                 "(guild_id, debt_type, recipient_id, payer_id, amount, date, session_id, reverses_id) VALUES "
+                 + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(events)))
+        params = [value for event in events
+                  for value in (self.guild_id, event.event_type, event.recipient_id, event.payer_id,
+                                self.backend.store_money(event.amount), event.date, event.session_id,
+                                event.reverses_id)]
+        return query, params
+
+    # Queries applying 'delta' (a ProjectionDelta) to every projection.
+    def __projection_queries(self, delta):
+        return [query for projection in self.projections for query in projection.update_queries(delta)]
+
+    # Builds a query for the debts of this guild that can still be voided (not reversals, not voided already), newest
+    #   first. 'condition' narrows them down further.
+    def __voidable_debts_query(self, condition="TRUE"):
+        debt_types = ", ".join(f"'{debt_type}'" for debt_type in DEBT_TYPES)
+        return (f"SELECT d.debt_id, d.debt_type, d.recipient_id, d.payer_id, d.amount, d.date, d.session_id "
+                f"FROM debt_history d "
+                f"WHERE d.guild_id = %s AND d.debt_type IN ({debt_types}) AND {condition} "
+                f"AND NOT EXISTS (SELECT 1 FROM debt_history r WHERE r.reverses_id = d.debt_id) "
+                f"ORDER BY d.debt_id DESC")
+
+    # Returns the latest 'count' debts that can still be voided, newest first, as Debt objects.
+    def get_voidable_debts(self, count):
+        query = self.__voidable_debts_query() + f" LIMIT {int(count)}"
+        return [Debt(debt_type, recipient_id, payer_id, self.__money(amount), to_datetime(date), debt_id)
+                for debt_id, debt_type, recipient_id, payer_id, amount, date, _ in self.__iter_rows(query,
+                                                                                                   (self.guild_id,))]
+
+    # Voids debt 'debt_id' by appending its reversal: the same amount, with recipient and payer swapped. Every
+    #   projection moves back by exactly the debt's own change, in one transaction, with no replay of the history.
+    #   A debt of a session still running stays in it, so the reversal comes off its SessionLedger and its net_gain
+    #   waits for the session to end like the debt's did. Returns the voided Debt, or None on error. Raises ValueError
+    #   if there's no such debt in this guild, or it can't be voided (a reversal, a session event, or voided already).
+    def void_debt(self, debt_id):
+        with self.session_lock:
+            row = self.__fetch_one(self.__voidable_debts_query("d.debt_id = %s"), (self.guild_id, debt_id))
+            if not row:
+                event = self.__fetch_one("SELECT debt_type FROM debt_history WHERE guild_id = %s AND debt_id = %s",
+                                         (self.guild_id, debt_id))
+                if not event:
+                    raise ValueError(f"There is no debt {debt_id}")
+                if event[0] not in DEBT_TYPES:
+                    raise ValueError(f"{debt_id} is a {event[0].replace('_', ' ')}, only debts can be voided")
+                raise ValueError(f"Debt {debt_id} has already been voided")
+            return self.__void(*row)
+
+    # Voids the latest debt that hasn't been voided yet, see void_debt: the latest of the session running at table
+    #   'table_key', or if none is (or no table is given), the latest recorded outside every running session, so an
+    #   undo never reaches into another table's game. Raises ValueError if there's none.
+    def undo_last(self, table_key=None):
+        with self.session_lock:
+            session = self.get_session(table_key) if table_key is not None else None
+            if session:
+                row = self.__fetch_one(self.__voidable_debts_query("d.session_id = %s") + " LIMIT 1",
+                                       (self.guild_id, session.session_id))
+            else:
+                running_ids = ", ".join(str(int(running.session_id)) for running in self.sessions.active())
+                condition = f"(d.session_id IS NULL OR d.session_id NOT IN ({running_ids}))" if running_ids else "TRUE"
+                row = self.__fetch_one(self.__voidable_debts_query(condition) + " LIMIT 1", (self.guild_id,))
+            if not row:
+                raise ValueError("There is no debt to undo at this table" if session else "There is no debt to undo")
+            return self.__void(*row)
+
+    # Called with session_lock held.
+    def __void(self, debt_id, debt_type, recipient_id, payer_id, amount, date, session_id):
+        amount = self.__money(amount)
+        table_key = next((session.table_key for session in self.sessions.active()
+                          if session.session_id == session_id), None)
+        event = make_event("reversal", payer_id, recipient_id, amount, get_current_time_sql(),
+                           session_id if table_key is not None else None, reverses_id=debt_id)
+        delta = ProjectionDelta([session_id] if table_key is not None else ()).apply([event])
+        if self.__execute_transaction([self.__event_insert_query([event])] + self.__projection_queries(delta)) is None:
+            return None
+        if table_key is not None:
+            self.sessions.get_ledger(table_key).reverse(debt_type, recipient_id, payer_id, amount)
+        elif session_id is not None:
+            # a finished session's stats change
+            self.analytics.invalidate()
+        self.__update_leaderboard(delta.net_changes)
+        self.__bump_version()
+        logger.info("Voided debt %s (%s of %s)", debt_id, debt_type, amount)
+        return Debt(debt_type, recipient_id, payer_id, amount, to_datetime(date), debt_id)
+
+    def __update_leaderboard(self, net_changes):
+        if self.leaderboard is not None:
+            for player_id, net_change in net_changes.items():
+                self.leaderboard.add_net(player_id, net_change)
+
+    # Returns the seq of the last entry of write-behind journal 'journal_key' recorded in debt_history (0 for a new
+    #   journal, which is registered here, or None with register=False).
+    def get_journal_seq(self, journal_key, register=True):
+        row = self.__fetch_one("SELECT last_seq FROM journal_state WHERE guild_id = %s AND journal_key = %s",
+                               (self.guild_id, journal_key))
+        if row:
+            return int(row[0])
+        if not register:
+            return None
+        self.__execute_transaction([("INSERT INTO journal_state (guild_id, journal_key, last_seq) VALUES (%s, %s, 0)",
+                                     (self.guild_id, journal_key))])
+        return 0
 
     def add_player(self, user):
         if not self.get_player(user):
-            self.__execute_query("USE cashgamebot")
-            query = f"INSERT INTO player_data (player_id, player_name) VALUES ({user.id}, '{user.name}')"
-            row_count = self.__execute_query(query)
+            query = "INSERT INTO player_data (guild_id, player_id, player_name) VALUES (%s, %s, %s)"
+            row_count = self.__execute_transaction([(query, (self.guild_id, user.id, user.name))])
             if not row_count or row_count < 1:
                 return False
+            if self.leaderboard is not None:
+                self.leaderboard.set_player(user.id, user.name, 0)
+            self.__bump_version()
             return True
         return False
 
-    def refresh_balances(self):
-        debt_history = self.__get_table("debt_history")
-        player_data = self.__get_table("player_data")
-        session = self.get_session()
-        for i in player_data.index:
-            reset_query = """
-            UPDATE player_data
-            SET balance = 0
-            """
-            self.__execute_query(reset_query)
-        for j in debt_history.index:
-            recipient_id = debt_history['recipient_id'][j]
-            payer_id = debt_history['payer_id'][j]
-            amount = debt_history['amount'][j]
-            debt_datetime = sql_time_to_datetime(str(debt_history['date'][j]))
-            query = f"""
-            UPDATE player_data
-            SET balance = balance + {amount}
-            WHERE player_id = {recipient_id}
-            """
-            self.__execute_query(query)
-            query = f"""
-            UPDATE player_data
-            SET balance = balance - {amount}
-            WHERE player_id = {payer_id}
-            """
-            self.__execute_query(query)
-            if amount >= 0 and ((not session[0]) or session[0] and debt_datetime < session[1]):
-                query = f"""
-                UPDATE player_data
-                SET net_gain = net_gain + {amount}
-                WHERE player_id = {recipient_id}
-                """
-                self.__execute_query(query)
-                query = f"""
-                UPDATE player_data
-                SET net_gain = net_gain - {amount}
-                WHERE player_id = {payer_id}
-                """
-                self.__execute_query(query)
-
-    def start_session(self, bank_id):
-        self.__execute_query("USE cashgamebot")
-        query = f"UPDATE session SET is_session = 1, session_start='{get_current_time_sql()}', bank_id={bank_id}"
-        self.__execute_query(query)
-
-    def end_session(self):
-        self.__execute_query("USE cashgamebot")
-        query = f"UPDATE session SET is_session = 0"
-        self.__execute_query(query)
-        self.refresh_balances()
-
-    def get_session(self):
-        self.__execute_query("USE cashgamebot")
-        query = (f"SELECT * "
-                 f"FROM session ")
-        session_row = pd.read_sql(query, self.connection)
-        if not session_row.empty:
-            if bool(session_row.iloc[0]['is_session']):
-                return (True, sql_time_to_datetime(str(session_row.iloc[0]['session_start'])),
-                        session_row.iloc[0]['bank_id'])
+    def __get_leaderboard(self):
+        registry.cache("leaderboard", self.leaderboard is not None)
+        if self.leaderboard is None:
+            leaderboard = Leaderboard()
+            leaderboard.load(self.get_players())
+            self.leaderboard = leaderboard
+        return self.leaderboard
+
+    # Moves every player whose net_gain changed in the database to their new place on the leaderboard.
+    def __sync_leaderboard(self):
+        if self.leaderboard is not None:
+            for plr in self.get_players():
+                self.leaderboard.set_player(plr.player_id, plr.name, plr.net)
+
+    def get_leaderboard(self):
+        return self.__get_leaderboard().rows()
+
+    def get_rank(self, user):
+        return self.__get_leaderboard().get_rank(user.id)
+
+    # Builds a subquery giving what every player bought in for and cashed out in every finished session: one row per
+    #   (player_id, session_id), with the session's end and how many seconds it lasted. Voided buy-ins and cash-outs
+    #   are taken back out.
+    def __session_results_query(self):
+        seconds = self.backend.seconds_between("s.session_start", "s.session_end")
+        return f"""
+        SELECT d.player_id, d.session_id, s.session_end, {seconds} AS seconds,
+               SUM(d.bought_in) AS bought_in, SUM(d.cashed_out) AS cashed_out
+        FROM (SELECT payer_id AS player_id, session_id, amount AS bought_in, 0 AS cashed_out FROM debt_history
+              WHERE guild_id = {self.guild_id} AND debt_type = 'buyin' AND session_id IS NOT NULL
+              UNION ALL
+              SELECT recipient_id, session_id, 0, amount FROM debt_history
+              WHERE guild_id = {self.guild_id} AND debt_type = 'cashout' AND session_id IS NOT NULL
+              UNION ALL
+              SELECT CASE WHEN o.debt_type = 'buyin' THEN o.payer_id ELSE o.recipient_id END, o.session_id,
+                     CASE WHEN o.debt_type = 'buyin' THEN -o.amount ELSE 0 END,
+                     CASE WHEN o.debt_type = 'cashout' THEN -o.amount ELSE 0 END
+              FROM debt_history r JOIN debt_history o ON o.debt_id = r.reverses_id
+              WHERE r.guild_id = {self.guild_id} AND r.debt_type = 'reversal' AND o.debt_type IN ('buyin', 'cashout')
+                AND o.session_id IS NOT NULL) d
+        JOIN sessions s ON s.session_id = d.session_id
+        WHERE s.session_end IS NOT NULL
+        GROUP BY d.player_id, d.session_id, s.session_start, s.session_end
+        HAVING SUM(d.bought_in) <> 0 OR SUM(d.cashed_out) <> 0
+        """
+
+    # Returns [player_id, sessions_played, bought_in, cashed_out, biggest_win, biggest_loss, seconds_played] for every
+    #   player who bought in or cashed out in a finished session. biggest_win and biggest_loss are the best and worst
+    #   results (cashed_out - bought_in) of a single session.
+    def get_session_totals(self):
+        query = f"""
+        SELECT r.player_id, COUNT(*), SUM(r.bought_in), SUM(r.cashed_out), MAX(r.cashed_out - r.bought_in),
+               MIN(r.cashed_out - r.bought_in), SUM(r.seconds)
+        FROM ({self.__session_results_query()}) r
+        GROUP BY r.player_id
+        """
+        return [[player_id, int(sessions_played), self.__money(bought_in), self.__money(cashed_out),
+                 self.__money(biggest_win), self.__money(biggest_loss), int(seconds_played or 0)]
+                for player_id, sessions_played, bought_in, cashed_out, biggest_win, biggest_loss, seconds_played
+                in self.__iter_rows(query)]
+
+    # Yields (player_id, session_end, result, running_net) for every finished session of every player, ordered by
+    #   player, then by when the session ended. running_net is the player's total result up to and including that
+    #   session, added up by the database with a window function (MySQL 8+, SQLite 3.25+).
+    def iter_session_results(self):
+        query = f"""
+        SELECT r.player_id, r.session_end, r.cashed_out - r.bought_in,
+               SUM(r.cashed_out - r.bought_in) OVER (PARTITION BY r.player_id ORDER BY r.session_end, r.session_id)
+        FROM ({self.__session_results_query()}) r
+        ORDER BY r.player_id, r.session_end, r.session_id
+        """
+        for player_id, session_end, result, running_net in self.__iter_rows(query):
+            yield player_id, to_datetime(session_end), self.__money(result), self.__money(running_net)
+
+    def get_player_stats(self, user):
+        return self.analytics.get(user.id)
+
+    def __get_last_debt_id(self):
+        return int(self.__fetch_one("SELECT COALESCE(MAX(debt_id), 0) FROM debt_history WHERE guild_id = %s",
+                                    (self.guild_id,))[0])
+
+    # Returns (checkpoint_id, last_debt_id) of checkpoint 'checkpoint_id', or of the most recent checkpoint if None.
+    #   None if there's no such checkpoint.
+    def get_checkpoint(self, checkpoint_id=None):
+        query = ("SELECT checkpoint_id, last_debt_id "
+                 "FROM balance_checkpoint "
+                 "WHERE guild_id = %s" + (" AND checkpoint_id = %s" if checkpoint_id is not None else "") + " "
+                 "ORDER BY checkpoint_id DESC LIMIT 1")
+        params = (self.guild_id,) if checkpoint_id is None else (self.guild_id, checkpoint_id)
+        checkpoint = self.__fetch_one(query, params)
+        if not checkpoint:
+            return None
+        return int(checkpoint[0]), int(checkpoint[1])
+
+    # Rebuilds every projection from the event log, and returns how long it took in seconds (None on error).
+    # full=True replays the whole log (use for audits). full=False starts from the last checkpoint, or from checkpoint
+    #   'checkpoint_id' (one of the latest CHECKPOINTS_KEPT, older ones are deleted), and only replays the events after
+    #   it, so its cost doesn't grow with the size of the history.
+    # Every projection rebuilds in its own transaction, all of them at once on MySQL (SQLite has one writer at a time).
+    #   Events appended meanwhile are never lost: each rebuild reads the log as it is when it runs, and events committed
+    #   after it update the rebuilt projection as usual. Reads keep being served from the projections throughout.
+    # When no session is running anywhere, a new checkpoint of every projection is saved afterwards.
+    def refresh_balances(self, full=True, checkpoint_id=None):
+        start_time = time.perf_counter()
+        checkpoint = None if full else self.get_checkpoint(checkpoint_id)
+        if checkpoint_id is not None and not checkpoint:
+            logger.error("No checkpoint %s to refresh balances from", checkpoint_id)
+            return None
+
+        def rebuild(projection):
+            with registry.time("projection_rebuild_seconds", projection=projection.name):
+                return self.__execute_transaction(projection.rebuild_queries(checkpoint))
+        if self.backend.dialect == "sqlite":
+            results = [rebuild(projection) for projection in self.projections]
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.projections)) as executor:
+                results = list(executor.map(rebuild, self.projections))
+        if None in results:
+            return None
+        if not self.sessions.active() and self.__execute_transaction(self.__checkpoint_queries()) is None:
+            return None
+        self.__sync_leaderboard()
+        self.__bump_version()
+        elapsed = time.perf_counter() - start_time
+        registry.observe("refresh_balances_seconds", elapsed, full=str(not checkpoint).lower())
+        logger.info("Balances refreshed (%s) in %.3fs", "full" if not checkpoint else "from checkpoint", elapsed)
+        return elapsed
+
+    # Queries saving a checkpoint of every projection, covering every event recorded when the transaction runs, then
+    #   deleting this guild's checkpoints older than the latest CHECKPOINTS_KEPT, so they don't pile up. Only valid
+    #   while no session is running.
+    def __checkpoint_queries(self):
+        checkpoint_id = self.backend.last_insert_id('balance_checkpoint', 'checkpoint_id')
+        last_debt_id = f"(SELECT COALESCE(MAX(debt_id), 0) FROM debt_history WHERE guild_id = {self.guild_id})"
+        queries = [f"INSERT INTO balance_checkpoint (guild_id, last_debt_id, created) "
+                   f"VALUES ({self.guild_id}, {last_debt_id}, '{get_current_time_sql()}')"]
+        for projection in self.projections:
+            queries += projection.checkpoint_queries(checkpoint_id)
+        # the derived table lets MySQL delete from the table it reads the ids from
+        oldest_kept = (f"(SELECT MIN(checkpoint_id) FROM "
+                       f"(SELECT checkpoint_id FROM balance_checkpoint WHERE guild_id = {self.guild_id} "
+                       f"ORDER BY checkpoint_id DESC LIMIT {CHECKPOINTS_KEPT}) AS kept)")
+        for projection in self.projections:
+            queries += projection.prune_checkpoint_queries(oldest_kept)
+        queries.append(f"DELETE FROM balance_checkpoint WHERE guild_id = {self.guild_id} "
+                       f"AND checkpoint_id < {oldest_kept}")
+        return queries
+
+    def __load_sessions(self):
+        query = ("SELECT session_id, table_key, bank_id, session_start FROM sessions "
+                 "WHERE guild_id = %s AND session_end IS NULL")
+        return [Session(session_id, table_key, bank_id, to_datetime(start))
+                for session_id, table_key, bank_id, start in self.__iter_rows(query, (self.guild_id,))]
+
+    # Replays the debts of every running session into its SessionLedger, e.g. after a restart mid-session.
+    def __load_session_ledgers(self):
+        sessions = {session.session_id: session for session in self.sessions.active()}
+        if not sessions:
+            return
+        # a reversal is taken out as the debt it voids, so it needs that debt's type
+        query = (f"SELECT d.session_id, d.debt_type, d.recipient_id, d.payer_id, d.amount, o.debt_type "
+                 f"FROM debt_history d LEFT JOIN debt_history o ON o.debt_id = d.reverses_id "
+                 f"WHERE d.session_id IN ({', '.join(['%s'] * len(sessions))}) AND d.{DEBT_FILTER} "
+                 f"ORDER BY d.debt_id")
+        for session_id, debt_type, recipient_id, payer_id, amount, voided_type in self.__iter_rows(query,
+                                                                                                   tuple(sessions)):
+            ledger = self.sessions.get_ledger(sessions[session_id].table_key)
+            if debt_type == "reversal":
+                ledger.reverse(voided_type, payer_id, recipient_id, self.__money(amount))
             else:
-                return False, None, None
-        return None
+                ledger.apply(debt_type, recipient_id, payer_id, self.__money(amount))
+
+    # Starts a session at 'table_key' with 'bank_id' as banker: adds it to sessions and appends its session_start event
+    #   in one transaction. Returns the new Session, or None if that table already has a session running or an error
+    #   occurred.
+    def start_session(self, bank_id, table_key=DEFAULT_TABLE):
+        with self.session_lock:
+            if self.sessions.get(table_key):
+                return None
+            start = get_current_time_sql()
+            query = "INSERT INTO sessions (guild_id, table_key, bank_id, session_start) VALUES (%s, %s, %s, %s)"
+            session_id = self.__execute_insert(
+                query, (self.guild_id, table_key, bank_id, start),
+                lambda new_id: [self.__event_insert_query([make_event("session_start", bank_id, bank_id, to_money(0),
+                                                                      start, new_id)])])
+            if session_id is None:
+                return None
+            session = Session(session_id, table_key, bank_id, sql_time_to_datetime(start))
+            self.sessions.start(session)
+            return session
+
+    # Ends the session running at 'table_key': appends its session_end event, which folds the session's debts into
+    #   net_gain. The net_gain changes come ready-made from the session's SessionLedger, so this is one transaction
+    #   with no reads of debt_history. When it was the last session running, a checkpoint is saved in the same
+    #   transaction. Returns the ended Session, or None if no session was running there (or on error, in which case
+    #   the session keeps running).
+    def end_session(self, table_key=DEFAULT_TABLE):
+        # held until the session is over, so no new session starts at the table while it may still carry on
+        with self.session_lock:
+            session, ledger = self.sessions.end(table_key)
+            if not session:
+                return None
+            end = get_current_time_sql()
+            event = make_event("session_end", session.bank_id, session.bank_id, to_money(0), end, session.session_id)
+            delta = ProjectionDelta()
+            delta.hold(session.session_id, ledger.get_net_changes())
+            delta.apply([event])
+            queries = [("UPDATE sessions SET session_end = %s WHERE session_id = %s", (end, session.session_id)),
+                       self.__event_insert_query([event])]
+            queries += self.__projection_queries(delta)
+            if not self.sessions.active():
+                queries += self.__checkpoint_queries()
+            if self.__execute_transaction(queries) is None:
+                self.sessions.start(session, ledger)
+                return None
+            self.__update_leaderboard(delta.net_changes)
+            self.__bump_version()
+            self.analytics.invalidate()
+            return session
+
+    # Returns the Session running at 'table_key', or None. Served from memory, no database round trip.
+    def get_session(self, table_key=DEFAULT_TABLE):
+        return self.sessions.get(table_key)
 
+    def get_sessions(self):
+        return self.sessions.active()
+
+    def get_session_ledger(self, table_key=DEFAULT_TABLE):
+        return self.sessions.get_ledger(table_key)
+
+    # Queries appending the session_start and session_end events missing from the log for sessions of this guild.
+    def __session_event_queries(self):
+        return [f"""
+                INSERT INTO debt_history (guild_id, debt_type, recipient_id, payer_id, amount, date, session_id)
+                SELECT s.guild_id, '{event_type}', s.bank_id, s.bank_id, 0, s.{event_type}, s.session_id
+                FROM sessions s
+                WHERE s.guild_id = {self.guild_id} AND s.{event_type} IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM debt_history e
+                                  WHERE e.session_id = s.session_id AND e.debt_type = '{event_type}')
+                ORDER BY s.session_id
+                """ for event_type in ("session_start", "session_end")]
+
+    # Yields every record of the ledger, streamed from the database in chunks: ("player", player_id, player_name,
+    #   balance, net_gain) for every player, then ("session", session_id, table_key, bank_id, session_start,
+    #   session_end) for every session, then ("debt", debt_type, recipient_id, payer_id, amount, date, session_id,
+    #   debt_id, reverses_id) for every event of the log (debts, session starts and ends, reversals), oldest first.
+    #   import_records takes the same records.
+    def iter_records(self):
+        for plr in self.iter_players():
+            yield "player", plr.player_id, plr.name, plr.balance, plr.net
+        query = ("SELECT session_id, table_key, bank_id, session_start, session_end FROM sessions "
+                 "WHERE guild_id = %s ORDER BY session_id")
+        for session_id, table_key, bank_id, start, end in self.__iter_rows(query, (self.guild_id,)):
+            yield "session", session_id, table_key, bank_id, to_datetime(start), to_datetime(end)
+        query = ("SELECT debt_type, recipient_id, payer_id, amount, date, session_id, debt_id, reverses_id "
+                 "FROM debt_history WHERE guild_id = %s ORDER BY debt_id")
+        for (debt_type, recipient_id, payer_id, amount, date, session_id, debt_id,
+             reverses_id) in self.__iter_rows(query, (self.guild_id,)):
+            yield ("debt", debt_type, recipient_id, payer_id, self.__money(amount), to_datetime(date), session_id,
+                   debt_id, reverses_id)
+
+    # Adds 'records' (as iter_records yields them, dates as '%Y-%m-%d %H:%M:%S' strings; balance and net_gain can be
+    #   None) to the ledger in one transaction, with one executemany per CHUNK_SIZE players or debts, so memory stays
+    #   bounded whatever the size of the import. The ledger must have no debts yet: importing on top of a history (e.g.
+    #   the same file twice) would count debts twice. Players already in the ledger are kept as they are, and every
+    #   player a debt names must be in the ledger or in the import. Sessions get new session_ids, and the debts pointing
+    #   at them follow. Sessions that were still running when the ledger was exported are ended at the time of the
+    #   import: their table may not exist here, so nothing could end them later. Debts get new debt_ids from the
+    #   database's AUTO_INCREMENT, in the same order, so guilds writing to the same shard meanwhile can't take the same
+    #   ids. The new id of every imported debt_id is kept in a temporary table on the connection, and each reversal is
+    #   pointed at the new id of the debt it voids once everything is in. Nothing else may write to this guild's ledger
+    #   during the import (the bot runs 'lb import' on its own, see scheduler.py).
+    # Then every balance and net_gain is rebuilt from the debt history and checked: balances must add up to 0 and every
+    #   imported player must end up with the balance and net_gain of their record. Returns an ImportResult, or None if
+    #   the import failed (nothing is added then). Raises ValueError on records that don't make sense, if the ledger
+    #   already has debts, or while a session is running.
+    def import_records(self, records):
+        if self.sessions.active():
+            raise ValueError("End every running session before importing")
+        if self.__get_last_debt_id() != 0:
+            raise ValueError("This ledger already has debts, import only into an empty one (importing the same "
+                             "file twice would count every debt twice)")
+        player_ids = {plr.player_id for plr in self.iter_players()}
+        # player_id -> (balance, net_gain) in the import, to check the rebuilt totals against
+        expected = {}
+        # session_id in the import -> session_id it was given here
+        session_ids = {}
+        # player_ids named by debts that aren't in the ledger or the import
+        unknown_ids = set()
+        # records added, by type
+        counts = {"player": 0, "session": 0, "debt": 0}
+        # running sessions in the import are ended now, see above
+        now = get_current_time_sql()
+        ended_sessions = 0
+        queries = {
+            "player": "INSERT INTO player_data (guild_id, player_id, player_name) VALUES (%s, %s, %s)",
+            # reverses_id holds the debt_id in the import until every debt is in, see below
+            "debt": ("INSERT INTO debt_history "
+                     "(guild_id, debt_type, recipient_id, payer_id, amount, date, session_id, reverses_id) "
+                     "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"),
+        }
+        session_query = ("INSERT INTO sessions (guild_id, table_key, bank_id, session_start, session_end) "
+                         "VALUES (%s, %s, %s, %s, %s)")
+        try:
+            with self.backend.connection() as connection:
+                cursor = connection.cursor()
+                batch_kind = None
+                batch = []
+                # debt_id in the import of every debt in the batch (None for a debt without one)
+                batch_debt_ids = []
+                try:
+                    self.__run(cursor, "CREATE TEMPORARY TABLE IF NOT EXISTS import_ids "
+                                       "(import_id BIGINT PRIMARY KEY, debt_id BIGINT NOT NULL)")
+                    self.__run(cursor, "DELETE FROM import_ids")
+                    self.__run(cursor, "SELECT COALESCE(MAX(debt_id), 0) FROM debt_history WHERE guild_id = %s",
+                               (self.guild_id,))
+                    # every debt_id above first_debt_id in this guild is the import's
+                    first_debt_id = last_debt_id = int(cursor.fetchall()[0][0])
+                    last_import_id = 0
 
+                    def write_batch():
+                        nonlocal last_debt_id
+                        self.__run_many(cursor, queries[batch_kind], batch)
+                        if batch_kind != "debt":
+                            return
+                        # the ids the database gave the batch, in order
+                        self.__run(cursor, f"SELECT debt_id FROM debt_history WHERE guild_id = %s AND debt_id > %s "
+                                           f"ORDER BY debt_id LIMIT {len(batch)}", (self.guild_id, last_debt_id))
+                        new_debt_ids = [int(debt_id) for (debt_id,) in cursor.fetchall()]
+                        id_pairs = [(import_id, debt_id) for import_id, debt_id in zip(batch_debt_ids, new_debt_ids)
+                                    if import_id is not None]
+                        if id_pairs:
+                            self.__run_many(cursor, "INSERT INTO import_ids (import_id, debt_id) VALUES (%s, %s)",
+                                            id_pairs)
+                        last_debt_id = new_debt_ids[-1]
 
+                    for record in records:
+                        kind = record[0]
+                        if batch and (kind != batch_kind or len(batch) >= CHUNK_SIZE):
+                            write_batch()
+                            batch = []
+                            batch_debt_ids = []
+                        batch_kind = kind
+                        if kind == "player":
+                            player_id, player_name, balance, net = record[1:]
+                            if balance is not None and net is not None:
+                                expected[player_id] = (to_money(balance), to_money(net))
+                            if player_id not in player_ids:
+                                player_ids.add(player_id)
+                                batch.append((self.guild_id, player_id, player_name))
+                                counts["player"] += 1
+                        elif kind == "session":
+                            session_id, table_key, bank_id, start, end = record[1:]
+                            if session_id in session_ids:
+                                raise ValueError(f"Session {session_id} is in the import twice")
+                            if end is None:
+                                end = now
+                                ended_sessions += 1
+                            # one INSERT per session, for its new session_id; there are few sessions next to debts
+                            self.__run(cursor, session_query, (self.guild_id, table_key, bank_id, start, end))
+                            session_ids[session_id] = cursor.lastrowid
+                            counts["session"] += 1
+                        elif kind == "debt":
+                            (debt_type, recipient_id, payer_id, amount, date, session_id, debt_id,
+                             reverses_id) = record[1:]
+                            if debt_type not in EVENT_TYPES:
+                                raise ValueError(f"Unknown debt type '{debt_type}'")
+                            unknown_ids.update({recipient_id, payer_id} - player_ids)
+                            if session_id is not None and session_id not in session_ids:
+                                raise ValueError(f"A debt belongs to session {session_id}, which isn't in the import")
+                            if debt_id is not None:
+                                if debt_id <= last_import_id:
+                                    raise ValueError(f"Debt {debt_id} is out of order, debts must be sorted by "
+                                                     f"debt_id")
+                                last_import_id = debt_id
+                            if (reverses_id is not None) != (debt_type == "reversal"):
+                                raise ValueError(f"Debt {debt_id} has a reverses_id but isn't a reversal, or the "
+                                                 f"other way around")
+                            if reverses_id is not None and (debt_id is None or not 0 < reverses_id < debt_id):
+                                raise ValueError(f"Reversal {debt_id} doesn't point at an earlier debt")
+                            batch.append((self.guild_id, debt_type, recipient_id, payer_id,
+                                          self.backend.store_money(to_money(amount)), date,
+                                          session_ids.get(session_id), reverses_id))
+                            batch_debt_ids.append(debt_id)
+                            counts["debt"] += debt_type in MONEY_EVENTS
+                        else:
+                            raise ValueError(f"Unknown record type '{kind}'")
+                    if batch:
+                        write_batch()
+                    if unknown_ids:
+                        raise ValueError(f"The debts name players who aren't in the ledger or the import, add them "
+                                         f"first: {', '.join(str(player_id) for player_id in sorted(unknown_ids))}")
+                    # every reversal now points at the new id of the debt it voids
+                    self.__run(cursor, """
+                    UPDATE debt_history
+                    SET reverses_id = (SELECT m.debt_id FROM import_ids m WHERE m.import_id = debt_history.reverses_id)
+                    WHERE guild_id = %s AND debt_id > %s AND reverses_id IS NOT NULL
+                    """, (self.guild_id, first_debt_id))
+                    self.__run(cursor, "SELECT COUNT(*) FROM debt_history "
+                                       "WHERE guild_id = %s AND debt_id > %s AND debt_type = 'reversal' "
+                                       "AND reverses_id IS NULL", (self.guild_id, first_debt_id))
+                    if cursor.fetchall()[0][0]:
+                        raise ValueError("A reversal points at a debt that isn't in the import")
+                    # ledgers exported before sessions were events have none for their sessions
+                    for query in self.__session_event_queries():
+                        self.__run(cursor, query)
+                    self.__commit(connection)
+                except (self.backend.Error, ValueError):
+                    connection.rollback()
+                    raise
+        except self.backend.Error as err:
+            logger.error("Import failed, rolled back: '%s'", err)
+            return None
+        if ended_sessions:
+            logger.warning("Ended %s sessions that were still running in the import", ended_sessions)
+        self.analytics.invalidate()
+        if self.refresh_balances(full=True) is None:
+            return None
+        players = {plr.player_id: plr for plr in self.iter_players()}
+        mismatches = [[player_id, totals, (players[player_id].balance, players[player_id].net)]
+                      for player_id, totals in expected.items()
+                      if (players[player_id].balance, players[player_id].net) != totals]
+        balance_total = sum((plr.balance for plr in players.values()), Decimal(0))
+        logger.info("Imported %s players, %s sessions and %s debts", counts["player"], counts["session"],
+                    counts["debt"])
+        return ImportResult(counts["player"], counts["session"], counts["debt"], balance_total, mismatches,
+                            ended_sessions)
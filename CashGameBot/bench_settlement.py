@@ -0,0 +1,73 @@
+import argparse
+import random
+import time
+from settlement import settle_greedy, settle_exact, to_cents, EXACT_MAX_PLAYERS
+
+# --- READ ME! ---:
+# Benchmark comparing the settlement strategies in settlement.py on synthetic ledgers.
+#
+# Run: 'python bench_settlement.py' (see --help for options)
+#
+# For every ledger size it builds random balances that add up to zero, settles them with each strategy, checks that
+# the payments really clear every balance, and prints how long each strategy took and how many payments it needed.
+# settle_exact only runs on ledgers of up to EXACT_MAX_PLAYERS players.
+
+
+# ------------- CONSTANTS -------------
+
+
+DEFAULT_SIZES = (4, 8, 12, EXACT_MAX_PLAYERS, 100, 500, 1000)
+DEFAULT_REPEATS = 5
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Returns {player_id: balance} for 'players' players, in whole dollars (like most buy-ins), adding up to zero.
+def make_ledger(players, rng):
+    balances = {player_id: rng.randint(-200, 200) for player_id in range(1, players)}
+    balances[players] = -sum(balances.values())
+    return balances
+
+
+def check_payments(balances, payments):
+    remaining = {player_id: to_cents(balance) for player_id, balance in balances.items()}
+    for payer_id, recipient_id, amount in payments:
+        remaining[payer_id] += to_cents(amount)
+        remaining[recipient_id] -= to_cents(amount)
+    if any(remaining.values()):
+        raise AssertionError("payments don't clear every balance")
+
+
+def time_strategy(strategy, ledgers):
+    payment_count = 0
+    start_time = time.perf_counter()
+    for balances in ledgers:
+        payments = strategy(balances)
+        check_payments(balances, payments)
+        payment_count += len(payments)
+    elapsed = time.perf_counter() - start_time
+    return elapsed / len(ledgers), payment_count / len(ledgers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare greedy and exact settlement on synthetic ledgers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="players per ledger")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="ledgers generated per size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f"{'players':>8} {'strategy':>8} {'ms/ledger':>10} {'payments':>9}")
+    for size in args.sizes:
+        ledgers = [make_ledger(size, rng) for _ in range(args.repeats)]
+        strategies = [("greedy", settle_greedy)]
+        if size <= EXACT_MAX_PLAYERS:
+            strategies.append(("exact", settle_exact))
+        for name, strategy in strategies:
+            seconds, payments = time_strategy(strategy, ledgers)
+            print(f"{size:>8} {name:>8} {seconds * 1000:>10.3f} {payments:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from balances import Balances
+from metrics import registry
+from storage import SQLiteBackend
+
+# --- READ ME! ---:
+# Benchmark suite for the ledger and the bot's command paths, on synthetic data in an in-memory SQLite database.
+#
+# Run: 'python benchmark.py' (see --help for options), e.g.
+#     python benchmark.py --debts 100 10000 1000000 --output results.json
+#
+# For every --debts size it builds a fresh ledger of --players players, --sessions finished sessions and that many
+# debts (generated from --seed, so runs are repeatable), then times each operation --repeats times:
+# refresh_balances (full and from checkpoint), get_owed (Balances.get_counterparty_totals), get_leaderboard (cold and
+# warm), add_debt and end_session (of a session with SESSION_BUYINS buy-ins).
+#
+# With --commands, the bot's command handlers (interactions.py) also run against the same ledger with a fake discord
+# context, so no network or token is needed. That needs discord.py and table2ascii installed.
+#
+# Results are printed (or written to --output) as JSON: one entry per size and operation with the mean, median, min and
+# max seconds, and the database round trips per call (see metrics.py). Compare files from two runs to catch regressions.
+
+
+# ------------- CONSTANTS -------------
+
+
+DEFAULT_PLAYERS = 50
+DEFAULT_DEBTS = (100, 10000)
+DEFAULT_SESSIONS = 20
+DEFAULT_REPEATS = 5
+# debts written per add_debts call while generating data
+LOAD_CHUNK = 1000
+# buy-ins recorded in the session timed by end_session
+SESSION_BUYINS = 20
+
+
+# ------------- FUNCTIONS -------------
+
+
+def round_trips():
+    return sum(value for (name, _), value in registry.counters.items() if name == "db_round_trips_total")
+
+
+# Fills 'balances' with 'players' players and 'debts' debts: about half of them buy-ins and cash-outs spread over
+#   'sessions' finished sessions, the rest payments between players.
+def load_ledger(balances, players, debts, sessions, rng):
+    users = [BenchUser(player_id, f"player{player_id}") for player_id in range(1, players + 1)]
+    for user in users:
+        balances.add_player(user)
+    session_debts = debts // 2 if sessions else 0
+    for session in range(sessions):
+        bank = rng.choice(users)
+        balances.start_session(bank.id, "bench")
+        count = session_debts // sessions + (1 if session < session_debts % sessions else 0)
+        for start in range(0, count, LOAD_CHUNK):
+            chunk = []
+            for _ in range(min(LOAD_CHUNK, count - start)):
+                player = rng.choice(users)
+                if rng.random() < 0.6:
+                    chunk.append(("buyin", bank, player, rng.randint(10, 200)))
+                else:
+                    chunk.append(("cashout", player, bank, rng.randint(0, 400)))
+            balances.add_debts(chunk, "bench")
+        balances.end_session("bench")
+    remaining = debts - session_debts
+    for start in range(0, remaining, LOAD_CHUNK):
+        chunk = []
+        for _ in range(min(LOAD_CHUNK, remaining - start)):
+            payer, recipient = rng.sample(users, 2)
+            chunk.append(("payment", recipient, payer, -rng.randint(1, 100)))
+        balances.add_debts(chunk)
+    return users
+
+
+# Runs 'operation' 'repeats' times, calling 'setup' (untimed) before each run. Returns a result dict.
+def measure(name, operation, repeats, setup=None):
+    samples = []
+    trips = 0
+    for _ in range(repeats):
+        if setup:
+            setup()
+        trips_before = round_trips()
+        start_time = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - start_time)
+        trips += round_trips() - trips_before
+    return {
+        "operation": name,
+        "repeats": repeats,
+        "mean_seconds": statistics.fmean(samples),
+        "median_seconds": statistics.median(samples),
+        "min_seconds": min(samples),
+        "max_seconds": max(samples),
+        "round_trips_per_call": trips / repeats,
+    }
+
+
+def bench_ledger(balances, users, repeats, rng):
+    results = [measure("refresh_balances_full", lambda: balances.refresh_balances(full=True), repeats),
+               measure("refresh_balances_checkpoint", lambda: balances.refresh_balances(full=False), repeats),
+               measure("get_owed", lambda: balances.get_counterparty_totals(rng.choice(users)), repeats)]
+
+    def drop_leaderboard():
+        balances.leaderboard = None
+    results.append(measure("get_leaderboard_cold", balances.get_leaderboard, repeats, drop_leaderboard))
+    results.append(measure("get_leaderboard_warm", balances.get_leaderboard, repeats))
+
+    def add_payment():
+        payer, recipient = rng.sample(users, 2)
+        balances.add_debt("payment", recipient, payer, -rng.randint(1, 100))
+    results.append(measure("add_debt", add_payment, repeats))
+
+    def fill_session():
+        bank = rng.choice(users)
+        balances.start_session(bank.id, "bench")
+        balances.add_debts([("buyin", bank, rng.choice(users), rng.randint(10, 200)) for _ in range(SESSION_BUYINS)],
+                           "bench")
+    results.append(measure("end_session", lambda: balances.end_session("bench"), repeats, fill_session))
+    return results
+
+
+# Runs the bot's command handlers against 'balances', as the ledger of the fake contexts' guild.
+def bench_commands(balances, users, repeats, rng):
+    import interactions
+    from async_balances import AsyncBalances
+    interactions.async_ledgers[balances.guild_id] = AsyncBalances(balances)
+    members = users
+    interactions.user_index.rebuild(members)
+    loop = asyncio.new_event_loop()
+
+    def command(name, *args):
+        def run():
+            ctx = FakeContext(rng.choice(members), balances.guild_id)
+            loop.run_until_complete(getattr(interactions, name).callback(ctx, *args))
+        return run
+
+    def player_name():
+        return rng.choice(members).name
+
+    results = [measure("command_leaderboard", command("leaderboard"), repeats),
+               measure("command_info", lambda: command("info", player_name())(), repeats),
+               measure("command_debt", lambda: command("debt", player_name())(), repeats),
+               measure("command_payment", lambda: command("payment", *rng.sample([m.name for m in members], 2), "5")(),
+                       repeats)]
+    bank = members[0]
+    loop.run_until_complete(interactions.session.callback(FakeContext(bank, balances.guild_id), "start", bank.name))
+    results.append(measure("command_session_buyin",
+                           lambda: command("session", "buyin", player_name(), "20")(), repeats))
+    results.append(measure("command_session_status", command("session", "status"), repeats))
+    loop.run_until_complete(interactions.session.callback(FakeContext(bank, balances.guild_id), "end"))
+    loop.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time ledger operations and bot commands on synthetic data")
+    parser.add_argument("--players", type=int, default=DEFAULT_PLAYERS)
+    parser.add_argument("--debts", type=int, nargs="+", default=DEFAULT_DEBTS, help="ledger sizes to run")
+    parser.add_argument("--sessions", type=int, default=DEFAULT_SESSIONS, help="finished sessions in each ledger")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="timed runs per operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--commands", action="store_true", help="also time the bot's command handlers")
+    parser.add_argument("--output", help="write the JSON results to this file instead of printing them")
+    args = parser.parse_args()
+    if args.players < 2:
+        parser.error("--players must be at least 2")
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "backend": "sqlite-memory",
+        "players": args.players,
+        "sessions": args.sessions,
+        "seed": args.seed,
+        "results": [],
+    }
+    for debts in args.debts:
+        rng = random.Random(args.seed)
+        balances = Balances(backend=SQLiteBackend(":memory:"))
+        load_start = time.perf_counter()
+        users = load_ledger(balances, args.players, debts, args.sessions, rng)
+        load_seconds = time.perf_counter() - load_start
+        results = bench_ledger(balances, users, args.repeats, rng)
+        if args.commands:
+            results += bench_commands(balances, users, args.repeats, rng)
+        for result in results:
+            report["results"].append({"debts": debts, "load_seconds": load_seconds, **result})
+        balances.backend.close()
+        print(f"{debts} debts: loaded in {load_seconds:.2f}s, {len(results)} operations timed", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+# ------------- CLASSES -------------
+
+
+# class BenchUser stands in for a discord user or member: an id, a name and administrator permissions.
+# Initialize: user = BenchUser(user_id, name)
+class BenchUser:
+    __slots__ = ("id", "name", "guild_permissions")
+
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.guild_permissions = FakePermissions()
+
+
+class FakePermissions:
+    administrator = True
+
+
+# class FakeContext stands in for a discord.py command context. Sent messages are kept in 'sent' instead of going to
+#   discord.
+# Initialize: ctx = FakeContext(author, guild_id)
+class FakeContext:
+    def __init__(self, author, guild_id, channel_id=0):
+        self.author = author
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeChannel(channel_id)
+        self.message = FakeMessage()
+        self.command = None
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content if content is not None else kwargs)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeMessage:
+    def __init__(self):
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import InterfaceError, OperationalError, PoolError
+
+# --- READ ME! ---:
+# This file holds the MySQL connection pool used by Balances.
+#
+# for usage in file, write:
+# 'from connection_pool import ConnectionPool'
+#
+# pool = ConnectionPool(host_name, user_name, user_password, database, pool_size)
+# with pool.connection() as connection:
+#     ... use connection ...
+#
+# - At most 'pool_size' connections are open at once. connection() waits up to POOL_TIMEOUT seconds for a free one
+#   and raises PoolError if none frees up.
+# - Every connection is opened with 'database' selected, so callers never need to send 'USE <database>'.
+# - A connection that has been idle for more than PING_AFTER seconds is pinged before it is handed out, and
+#   reconnected if the server dropped it. A connection that fails mid-query with a connection error is thrown away,
+#   so the next caller gets a fresh one instead of the bot staying down until restart.
+# - Any transaction left open is rolled back when a connection goes back to the pool, so the next user never sees a
+#   stale read snapshot or half-finished writes.
+
+
+# ------------- CONSTANTS -------------
+
+
+POOL_SIZE = 5
+POOL_TIMEOUT = 10
+PING_AFTER = 30
+
+
+# ------------- CLASSES -------------
+
+
+# class ConnectionPool hands out MySQL connections to the selected database, checking them before use.
+# Initialize: pool = ConnectionPool(host_name, user_name, user_password, database, pool_size)
+class ConnectionPool:
+    def __init__(self, host_name, user_name, user_password, database, pool_size=POOL_SIZE):
+        self.connect_args = {
+            "host": host_name,
+            "user": user_name,
+            "passwd": user_password,
+            "database": database
+        }
+        self.pool_size = pool_size
+        self.slots = threading.BoundedSemaphore(pool_size)
+        # (connection, time it was returned), most recently returned connection on top
+        self.idle = queue.LifoQueue()
+
+    def __open(self):
+        return mysql.connector.connect(**self.connect_args)
+
+    def __checkout(self):
+        if not self.slots.acquire(timeout=POOL_TIMEOUT):
+            raise PoolError(f"No free database connection after {POOL_TIMEOUT} seconds")
+        try:
+            try:
+                connection, returned_at = self.idle.get_nowait()
+            except queue.Empty:
+                return self.__open()
+            if time.monotonic() - returned_at > PING_AFTER:
+                connection.ping(reconnect=True, attempts=3, delay=1)
+            return connection
+        except Exception:
+            self.slots.release()
+            raise
+
+    def __checkin(self, connection, broken):
+        try:
+            if not broken:
+                try:
+                    if connection.in_transaction:
+                        connection.rollback()
+                    self.idle.put((connection, time.monotonic()))
+                    return
+                except Error:
+                    pass
+            try:
+                connection.close()
+            except Error:
+                pass
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.__checkout()
+        broken = False
+        try:
+            yield connection
+        except (InterfaceError, OperationalError):
+            broken = True
+            raise
+        finally:
+            self.__checkin(connection, broken)
+
+    def close(self):
+        while True:
+            try:
+                connection, returned_at = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.close()
+            except Error:
+                pass
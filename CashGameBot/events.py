@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+# --- READ ME! ---:
+# This file holds the typed events of the ledger. debt_history is the ledger's event store: every change to the ledger
+# is a row appended to it, and rows are never changed or deleted afterwards.
+#
+# for usage in file, write:
+# 'from events import make_event, BuyIn, CashOut, Payment, SessionStart, SessionEnd, Reversal'
+#
+# event = make_event(event_type, recipient_id, payer_id, amount, date, session_id, event_id, reverses_id)
+# check_debt_type(debt_type) raises ValueError unless 'debt_type' is one of DEBT_TYPES
+#
+# EVENT TYPES (debt_type in debt_history):
+# buyin - a player (payer) buys chips from the session's bank (recipient)
+# cashout - the bank (payer) pays a player (recipient) for their chips
+# payment - money changing hands between two players, stored as a negative amount
+# session_start / session_end - the bank (both recipient and payer) opens or closes the session 'session_id'. Their
+#     amount is 0
+# reversal - undoes the event 'reverses_id': the same amount, with recipient and payer swapped. Only appended by
+#     Balances.void_debt, and at most once per debt
+#
+# Every event knows how it changes the projections built from the log (see projections.py): event.apply(delta).
+# Money events move 'amount' from payer to recipient. Their net_gain change waits for the end of their session while
+# it's running. A session_end releases what its session held back.
+
+
+# ------------- CONSTANTS -------------
+
+
+# events recorded as debts, e.g. by Balances.add_debts
+DEBT_TYPES = ("buyin", "cashout", "payment")
+MONEY_EVENTS = DEBT_TYPES + ("reversal",)
+SESSION_EVENTS = ("session_start", "session_end")
+EVENT_TYPES = MONEY_EVENTS + SESSION_EVENTS
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Returns the typed event for a debt_history row. Raises ValueError for an unknown event_type.
+def make_event(event_type, recipient_id, payer_id, amount, date=None, session_id=None, event_id=None,
+               reverses_id=None):
+    event_class = EVENT_CLASSES.get(event_type)
+    if event_class is None:
+        raise ValueError(f"Unknown event type '{event_type}', expected one of: {', '.join(EVENT_TYPES)}")
+    return event_class(event_type, recipient_id, payer_id, amount, date, session_id, event_id, reverses_id)
+
+
+# Raises ValueError unless 'debt_type' can be recorded as a debt.
+def check_debt_type(debt_type):
+    if debt_type not in DEBT_TYPES:
+        raise ValueError(f"'{debt_type}' isn't a debt type, expected one of: {', '.join(DEBT_TYPES)}")
+
+
+# ------------- CLASSES -------------
+
+
+# class Event holds one row of debt_history. Use one of the typed subclasses below, or make_event.
+# Initialize: event = BuyIn("buyin", recipient_id, payer_id, amount, date, session_id, event_id, reverses_id)
+class Event(namedtuple("Event", ["event_type", "recipient_id", "payer_id", "amount", "date", "session_id",
+                                 "event_id", "reverses_id"], defaults=(None, None, None, None))):
+    __slots__ = ()
+
+    def apply(self, delta):
+        raise NotImplementedError
+
+
+# class MoneyEvent is an event that moves 'amount' from payer to recipient.
+class MoneyEvent(Event):
+    __slots__ = ()
+
+    def apply(self, delta):
+        delta.move(self.recipient_id, self.payer_id, self.amount, self.session_id)
+
+
+class BuyIn(MoneyEvent):
+    __slots__ = ()
+
+
+class CashOut(MoneyEvent):
+    __slots__ = ()
+
+
+class Payment(MoneyEvent):
+    __slots__ = ()
+
+
+class Reversal(MoneyEvent):
+    __slots__ = ()
+
+
+class SessionStart(Event):
+    __slots__ = ()
+
+    def apply(self, delta):
+        delta.start_session(self.session_id)
+
+
+class SessionEnd(Event):
+    __slots__ = ()
+
+    def apply(self, delta):
+        delta.end_session(self.session_id)
+
+
+EVENT_CLASSES = {"buyin": BuyIn, "cashout": CashOut, "payment": Payment, "reversal": Reversal,
+                 "session_start": SessionStart, "session_end": SessionEnd}
@@ -1,110 +1,332 @@
-from balances import Balances
+from async_balances import AsyncBalances, MAX_WORKERS
+from balances import Balances, to_money, MAX_AMOUNT, DEFAULT_GUILD
+from sharding import LedgerRouter
+from storage import SHARD_COUNT
+from write_behind import WriteBehindBalances, guild_journal_path, replay_legacy_journal, ENABLED as WRITE_BEHIND
+from user_index import UserIndex
+from render_cache import RenderCache, paginate, MESSAGE_LIMIT
+from scheduler import CommandScheduler, QueueFull, READ, WRITE
+from sessions import DEFAULT_TABLE
+from ledger_io import export_ledger, import_ledger, FORMATS as LEDGER_FORMATS
+from settlement import settle as settle_balances
+from metrics import registry, configure_logging, monitor_event_loop, start_http_server, METRICS_PORT
 from discord.ext import commands
-from bot_token import TOKEN
 from table2ascii import table2ascii as t2a, PresetStyle
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+import asyncio
 import discord
+import functools
+import logging
+import os
+import sys
+import tempfile
+import time
 
 # Make file bot_token.py, put "TOKEN = "<TOKEN>" in it, do not commit this file to repo."
-BOT_TOKEN = TOKEN
-CHANNEL_ID = 1217961509414764705
+# The bot starts when this file is run ('python interactions.py'). Importing it (e.g. from benchmark.py) only sets up
+# the command handlers, and needs no token.
+# Every guild has its own ledger (see sharding.py). To run the bot over several processes, give each one the discord
+# gateway shards it should handle: CASHGAMEBOT_GATEWAY_SHARDS=<total shard count> and CASHGAMEBOT_SHARD_IDS=0,1,...
+GATEWAY_SHARDS = os.environ.get("CASHGAMEBOT_GATEWAY_SHARDS")
+SHARD_IDS = os.environ.get("CASHGAMEBOT_SHARD_IDS")
 USAGES = {
+    "leaderboard": "lb leaderboard [page]",
     "add": "lb add <to_add> <arg1> <arg2> ...",
     "add player": "lb add player <player_name>",
     "info": "lb info <player_name>",
-    "debt": "lb debt <player_name>",
-    "session": "lb session [start|end|buyin|cashout] <arg1> <arg2> ... ",
+    "debt": "lb debt <player_name> [page]",
+    "session": "lb session [start|end|status|buyin|cashout] <arg1> <arg2> ... ",
     "session start": "lb session start <banker_name>",
     "session end": "lb session end",
-    "session buyin": "lb session buyin <player_name> <buy_in_amount>",
-    "session cashout": "lb session cashout <player_name> <stack_size>",
-    "payment": "lb payment <payer_name> <recipient_name> <amount>"
+    "session status": "lb session status",
+    "session buyin": "lb session buyin <player_name> <buy_in_amount> [<player_name> <buy_in_amount> ...]",
+    "session cashout": "lb session cashout <player_name> <stack_size> [<player_name> <stack_size> ...]",
+    "payment": "lb payment <payer_name> <recipient_name> <amount>",
+    "undo": "lb undo",
+    "void": "lb void <debt_id>",
+    "settle": "lb settle [exact]",
+    "stats": "lb stats [player_name]",
+    "export": "lb export [jsonl|csv|parquet]",
+    "import": "lb import (attach a file made by lb export, or a debts.csv)"
 }
+# file name extension of 'lb export' files, by format
+EXPORT_EXTENSIONS = {"jsonl": ".jsonl.gz", "csv": ".zip", "parquet": ".parquet.zip"}
+# rows shown per section by 'lb stats'
+STATS_ROWS = 10
+# sessions shown in a player's 'lb stats <player_name>'
+RECENT_SESSIONS = 10
+# characters kept free at the end of every page of a paginated message for its page footer
+PAGE_FOOTER_ROOM = 100
+# debts listed by 'lb void' with no debt_id
+VOID_LIST_ROWS = 10
 
-balances = Balances()
+configure_logging()
+logger = logging.getLogger("interactions")
 
-bot = commands.Bot(command_prefix=("LB ", "lb ", "Lb ", "lB "),
-                   intents=discord.Intents.all(),
-                   case_insensitive=True)
+
+# with CASHGAMEBOT_WRITE_BEHIND=1, debts are journaled and written to the database in batches (see write_behind.py)
+def make_write_behind(ledger):
+    return WriteBehindBalances(ledger, guild_journal_path(ledger.guild_id))
+
+
+ledgers = LedgerRouter(wrap=make_write_behind if WRITE_BEHIND else None)
+# every guild's AsyncBalances runs on this one pool, sized for the shards' connection pools
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * max(1, SHARD_COUNT), thread_name_prefix="balances")
+# guild_id -> AsyncBalances
+async_ledgers = {}
+user_index = UserIndex()
+# rendered leaderboard and debt pages, reused until the guild's ledger changes (see render_cache.py)
+render_cache = RenderCache()
+# every guild's commands take turns on its ledger: writes one at a time, reads together between them (see scheduler.py)
+scheduler = CommandScheduler()
+lag_monitor = None
+if METRICS_PORT:
+    start_http_server(METRICS_PORT)
+
+bot = commands.AutoShardedBot(command_prefix=("LB ", "lb ", "Lb ", "lB "),
+                              intents=discord.Intents.all(),
+                              case_insensitive=True,
+                              shard_count=int(GATEWAY_SHARDS) if GATEWAY_SHARDS else None,
+                              shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")] if SHARD_IDS else None)
+
+
+# Returns the AsyncBalances of guild 'guild_id', opening its ledger (on a worker thread) the first time.
+async def get_balances(guild_id):
+    balances = async_ledgers.get(guild_id)
+    if balances is None:
+        ledger = await asyncio.get_running_loop().run_in_executor(executor, ledgers.get, guild_id)
+        balances = async_ledgers.setdefault(guild_id, AsyncBalances(ledger, executor=executor))
+    return balances
 
 
 def get_user(user_name=None, user_id=None):
-    for user in bot.users:
-        print(f"{user_name} == {user.name}: {user_name == user.name}")
-        if user_name == user.name or user_id == user.id:
-            return user
-    return False
+    return user_index.get(user_name=user_name, user_id=user_id)
+
+
+def is_visible(user):
+    return any(guild.get_member(user.id) for guild in bot.guilds)
 
 
-def get_leaderboard():
-    players = balances.get_players()
-    sorted_players = np.flip(np.sort(players))
+async def get_leaderboard(balances):
     new_leaderboard = []
-    current_rank = 1
-    current_net = None
-    for player in sorted_players:
-        if current_net is not None and current_net != player.net:
-            current_rank += 1
-        current_net = player.net
-        row = [str(current_rank), player.name, f"{f"${format(player.net, ".2f")}" if player.net >= 0 else
-            f"-${format(-player.net, ".2f")}"}"]
+    for rank, name, net in await balances.get_leaderboard():
+        row = [str(rank), name, f"{f"${format(net, ".2f")}" if net >= 0 else f"-${format(-net, ".2f")}"}"]
         new_leaderboard.append(row)
     return new_leaderboard
 
 
-def get_rank(user):
-    plr_name = user.name
-    current_leader_board = get_leaderboard()
-    for row in current_leader_board:
-        if row[1] == plr_name:
-            return row[0]
+async def get_rank(balances, user):
+    return await balances.get_rank(user)
 
 
-def get_owed(user):
-    plr = balances.get_player(user)
+async def get_owed(balances, user):
+    plr = await balances.get_player(user)
     if plr:
-        all_debts = balances.get_debts()
-        relevant_debts = filter(lambda d: d.recipient_id == plr.player_id or d.payer_id == plr.player_id, all_debts)
-        owed = {}
-        for d in relevant_debts:
-            if d.recipient_id == plr.player_id:
-                payer = get_user(user_id=d.payer_id)
-                if f"{payer.name}" in owed.keys():
-                    owed[f"{payer.name}"] += d.amount
-                else:
-                    owed[f"{payer.name}"] = d.amount
-            if d.payer_id == plr.player_id:
-                recipient = get_user(user_id=d.recipient_id)
-                if f"{recipient.name}" in owed.keys():
-                    owed[f"{recipient.name}"] -= d.amount
-                else:
-                    owed[f"{recipient.name}"] = -d.amount
-        owed = list([k, owed[k]] for k in owed if owed[k] != 0)
+        owed = []
+        for counterparty_id, amount in await balances.get_counterparty_totals(user):
+            counterparty = get_user(user_id=counterparty_id)
+            owed.append([counterparty.name if counterparty else str(counterparty_id), amount])
         return owed
     return False
 
 
+# Returns the page number in 'args' (1 if there's none), or None if it isn't a whole number above 0.
+def get_page(args):
+    if not args:
+        return 1
+    if len(args) > 1 or not args[0].isdigit() or int(args[0]) < 1:
+        return None
+    return int(args[0])
+
+
+# Adds 'Page x of y' to every page of a message split by paginate, with the 'command' that shows the next one.
+def add_page_footers(pages, command):
+    if len(pages) < 2:
+        return pages
+    return [f"{page}\nPage {number} of {len(pages)}." + (f" Next page: `{command} {number + 1}`"
+                                                          if number < len(pages) else "")
+            for number, page in enumerate(pages, 1)]
+
+
+async def send_page(ctx, pages, page):
+    if page > len(pages):
+        await ctx.send(f"There {'is only 1 page' if len(pages) == 1 else f'are only {len(pages)} pages'}.")
+        return
+    await ctx.send(pages[page - 1])
+
+
+def is_admin(ctx):
+    permissions = getattr(ctx.author, "guild_permissions", None)
+    return bool(permissions and permissions.administrator)
+
+
+def format_money(amount):
+    return f"${format(amount, ".2f")}" if amount >= 0 else f"-${format(-amount, ".2f")}"
+
+
+# Returns 'text' as an amount of money rounded to the cent, or None if it isn't a number from $0.01 to MAX_AMOUNT
+#   (so 'inf', 'nan' and amounts the money columns can't hold never reach the ledger).
+def parse_amount(text):
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    if not amount.is_finite() or not 0 < amount <= MAX_AMOUNT:
+        return None
+    amount = to_money(amount)
+    return amount if amount > 0 else None
+
+
+async def send_invalid_amount(ctx, text, usage):
+    await ctx.send(f"Invalid Amount '{text}', must be a number from $0.01 to {format_money(MAX_AMOUNT)}.\n"
+                   f"Usage: ```{USAGES[usage]}```")
+
+
+# One line describing 'debt' (with its debt_id, to pass to 'lb void') for the undo and void messages.
+# Returns (table_key, Session or None) of the table in the channel of 'ctx'. Every channel is its own table, so several
+#   games can run at once. A session left running from before tables were per channel was carried over to
+#   DEFAULT_TABLE (see migrations.py): with 'legacy', a channel without a session of its own reaches it, so it can be
+#   played out and ended.
+async def get_table(balances, ctx, legacy=True):
+    table_key = str(ctx.channel.id)
+    session = await balances.get_session(table_key)
+    if not session and legacy:
+        legacy_session = await balances.get_session(DEFAULT_TABLE)
+        if legacy_session:
+            return DEFAULT_TABLE, legacy_session
+    return table_key, session
+
+
+def describe_table(table_key):
+    if table_key == DEFAULT_TABLE:
+        return "the table carried over from before tables were per channel"
+    return f"<#{table_key}>"
+
+
+def describe_debt(debt):
+    recipient = get_user(user_id=debt.recipient_id)
+    payer = get_user(user_id=debt.payer_id)
+    recipient_name = recipient.name if recipient else str(debt.recipient_id)
+    payer_name = payer.name if payer else str(debt.payer_id)
+    if debt.debt_type == "payment":
+        return f"#{debt.debt_id} payment: {payer_name} paid {format_money(-debt.amount)} to {recipient_name}"
+    return f"#{debt.debt_id} {debt.debt_type}: {payer_name} owes {format_money(debt.amount)} to {recipient_name}"
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return ">10000"
+    return format(seconds * 1000, ".1f")
+
+
+# Runs the decorated command once the scheduler lets it in on its guild's ledger. 'mode' is READ or WRITE, or a
+#   function of the command's args returning one. When too many commands are already waiting, the user is asked to try
+#   again instead.
+def scheduled(mode):
+    def decorate(command):
+        @functools.wraps(command)
+        async def run(ctx, *args):
+            try:
+                async with scheduler.slot(ctx.guild.id, mode(args) if callable(mode) else mode):
+                    await command(ctx, *args)
+            except QueueFull as err:
+                await ctx.send(f"The bank is busy, {err.waiting} commands are already waiting in this server. "
+                               f"Try again in a moment.")
+        return run
+    return decorate
+
+
+# ledgers are per guild, so commands only work in a server
+@bot.check
+async def in_guild(ctx):
+    return ctx.guild is not None
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_start = time.perf_counter()
+
+
+# discord.py calls this even when the command raised, so failed commands are timed too
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    start = getattr(ctx, "command_start", None)
+    if start is not None and ctx.command:
+        registry.observe("command_seconds", time.perf_counter() - start, command=ctx.command.qualified_name)
+
+
 @bot.event
 async def on_ready():
-    print("BOT IS READY")
-    print(f"USERS:\n{bot.users}")
-    channel = bot.get_channel(CHANNEL_ID)
-    # await channel.send("message")
-    get_leaderboard()
+    global lag_monitor
+    logger.info("BOT IS READY")
+    # on_ready runs again after every reconnect; only one lag monitor is needed
+    if lag_monitor is None:
+        lag_monitor = asyncio.create_task(monitor_event_loop())
+    for guild in bot.guilds:
+        balances = await get_balances(guild.id)
+        user_index.load_players(await balances.get_players())
+        await balances.get_leaderboard()
+    user_index.rebuild(bot.users)
+    logger.info("Indexed %s users across %s guilds", len(user_index.by_id), len(bot.guilds))
+
+
+@bot.event
+async def on_member_join(member):
+    user_index.add(member)
+
+
+@bot.event
+async def on_member_remove(member):
+    if not is_visible(member):
+        user_index.remove(member)
+
+
+@bot.event
+async def on_user_update(before, after):
+    user_index.rename(before, after)
+    # debt tables show names from the user index, so pages rendered with the old name are dropped
+    render_cache.clear()
+
+
+@bot.event
+async def on_guild_join(guild):
+    for member in guild.members:
+        user_index.add(member)
 
 
 @bot.command()
-async def leaderboard(ctx):
-    leaderboard_ascii = t2a(
-        header=["Rank", "Player", "Net Winnings"],
-        body=get_leaderboard(),
-        style=PresetStyle.thin_compact
-    )
-    await ctx.send(f"```{leaderboard_ascii}```")
+@scheduled(READ)
+async def leaderboard(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    page = get_page(args)
+    if page is None:
+        await ctx.send(f"Usage: ```{USAGES["leaderboard"]}```")
+        return
+    key = (ctx.guild.id, "leaderboard")
+    # read before the leaderboard, so a debt added while rendering leaves the pages under the older version
+    version = balances.version
+    pages = render_cache.get(key, version)
+    if pages is None:
+        def render(rows):
+            leaderboard_ascii = t2a(
+                header=["Rank", "Player", "Net Winnings"],
+                body=rows,
+                style=PresetStyle.thin_compact
+            )
+            return f"```{leaderboard_ascii}```"
+        pages = add_page_footers(paginate(await get_leaderboard(balances), render,
+                                          limit=MESSAGE_LIMIT - PAGE_FOOTER_ROOM), "lb leaderboard")
+        render_cache.put(key, version, pages)
+    await send_page(ctx, pages, page)
 
 
 @bot.command()
+@scheduled(WRITE)
 async def add(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
     if not args:
         await ctx.send(f"Usage: ```{USAGES["add"]}```")
         return
@@ -117,7 +339,7 @@ async def add(ctx, *args):
             return
         if user:
             try:
-                success = balances.add_player(user)
+                success = await balances.add_player(user)
                 if success:
                     await ctx.send(f"Player '{plr_name}' added successfully. ")
                 else:
@@ -129,7 +351,9 @@ async def add(ctx, *args):
 
 
 @bot.command()
+@scheduled(READ)
 async def info(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
     if not args:
         await ctx.send(f"Usage: ```{USAGES["info"]}```")
         return
@@ -138,9 +362,9 @@ async def info(ctx, *args):
     embed = discord.Embed(title=f"{plr_name}", color=0x03f8fc, timestamp=ctx.message.created_at)
     if user:
         try:
-            plr = balances.get_player(user)
+            plr = await balances.get_player(user)
             if plr:
-                embed.add_field(name="Rank", value=f"{get_rank(user)}", inline=True)
+                embed.add_field(name="Rank", value=f"{await get_rank(balances, user)}", inline=True)
                 embed.add_field(name="Net Winnings", value=f"${plr.net}", inline=True)
                 embed.add_field(name="Balance", value=f"${plr.balance}", inline=False)
                 await ctx.send(embed=embed)
@@ -154,45 +378,62 @@ async def info(ctx, *args):
 
 
 @bot.command()
+@scheduled(READ)
 async def debt(ctx, *args):
-    if not args:
+    balances = await get_balances(ctx.guild.id)
+    page = get_page(args[1:])
+    if not args or page is None:
         await ctx.send(f"Usage: ```{USAGES["debt"]}```")
         return
     plr_name = args[0]
     user = get_user(user_name=plr_name)
     if not user:
         await ctx.send(f"User '{plr_name}' is not in the server, or you used an @")
-    plr = balances.get_player(user)
-    if not plr:
-        await ctx.send(f"Player '{plr_name}' has not been added yet or an error occurred. "
-                       f"Try adding the player: ```{USAGES["add"]}```")
-    try:
-        owed = get_owed(user)
+        return
+    key = (ctx.guild.id, "debt", user.id)
+    version = balances.version
+    pages = render_cache.get(key, version)
+    if pages is None:
+        plr = await balances.get_player(user)
+        if not plr:
+            await ctx.send(f"Player '{plr_name}' has not been added yet or an error occurred. "
+                           f"Try adding the player: ```{USAGES["add"]}```")
+            return
+        try:
+            owed = await get_owed(balances, user)
+        except Exception as e:
+            await ctx.send(f"ERROR: {str(e)}")
+            return
         if owed:
-            debt_table = t2a(
-                header=["Owed To/By", "Amount"],
-                body=owed,
-                style=PresetStyle.thin_compact
-            )
-            await ctx.send(f"```{debt_table}\nNet Balance: {plr.balance}\n"
-                           f"Positive: Owed to {plr_name}\nNegative: Owed by {plr_name}```")
+            def render(rows):
+                debt_table = t2a(
+                    header=["Owed To/By", "Amount"],
+                    body=rows,
+                    style=PresetStyle.thin_compact
+                )
+                return (f"```{debt_table}\nNet Balance: {plr.balance}\n"
+                        f"Positive: Owed to {plr_name}\nNegative: Owed by {plr_name}```")
+            pages = add_page_footers(paginate(owed, render, limit=MESSAGE_LIMIT - PAGE_FOOTER_ROOM),
+                                     f"lb debt {plr_name}")
         else:
-            await ctx.send(f"Player '{plr_name}' does not owe and is not owed.")
-    except Exception as e:
-        await ctx.send(f"ERROR: {str(e)}")
+            pages = [f"Player '{plr_name}' does not owe and is not owed."]
+        render_cache.put(key, version, pages)
+    await send_page(ctx, pages, page)
 
 
 @bot.command()
+@scheduled(lambda args: READ if args[:1] == ("status",) else WRITE)
 async def session(ctx, *args):
-    cmd_types = ("start", "buyin", "cashout", "end")
+    balances = await get_balances(ctx.guild.id)
+    cmd_types = ("start", "buyin", "cashout", "end", "status")
     if not (args and args[0] in cmd_types):
         await ctx.send(f"Usage: ```{USAGES["session"]}```")
         return
     cmd_type = args[0]
-    session = balances.get_session()
+    table_key, session = await get_table(balances, ctx, legacy=cmd_type != "start")
     if cmd_type == "start":
-        if session[0]:
-            await ctx.send(f"There is already a session running. You can end this session with:\n"
+        if session:
+            await ctx.send(f"There is already a session running in this channel. You can end this session with:\n"
                            f" ```{USAGES["session end"]}```")
             return
         if len(args) != 2:
@@ -204,89 +445,133 @@ async def session(ctx, *args):
             await ctx.send(f"User '{bank_name}' is not in the server, or you used an @")
             return
         try:
-            balances.start_session(bank.id)
+            session = await balances.start_session(bank.id, table_key)
+            if not session:
+                await ctx.send(f"A session could not be started in this channel, try again.")
+                return
             await ctx.send(f"A new session has been started!\n"
-                           f"```Banker: {bank_name}\nStart Time: {session[1]}\n\n"
+                           f"```Banker: {bank_name}\nStart Time: {session.start}\n\n"
                            f"Note: All buyins/cashouts and other interactions will not show on leaderboard until after"
                            f"this session is over. Balances, however, will be updated.```")
         except Exception as e:
             await ctx.send(f"ERROR: {str(e)}")
             return
     if cmd_type == "end":
-        if not session[0]:
-            await ctx.send(f"There is no current session. You can start a new one with:"
+        if not session:
+            await ctx.send(f"There is no current session in this channel. You can start a new one with:"
                            f" ```{USAGES["session start"]}```")
             return
-        bank_name = get_user(user_id=session[2]).name
-        balances.end_session()
+        bank = get_user(user_id=session.bank_id)
+        bank_name = bank.name if bank else str(session.bank_id)
+        try:
+            ended = await balances.end_session(table_key)
+        except Exception as e:
+            await ctx.send(f"ERROR: {str(e)}")
+            return
+        if not ended:
+            if await balances.get_session(table_key):
+                await ctx.send("The session could not be ended, it is still running. Try again.")
+            else:
+                await ctx.send(f"There is no session running in this channel. You can start a new one with:"
+                               f" ```{USAGES["session start"]}```")
+            return
         await ctx.send(f"The current session has ended!\n"
-                       f"```Banker: {bank_name}\nStart Time: {session[1]}\n\n"
+                       f"```Banker: {bank_name}\nStart Time: {session.start}\n\n"
                        f"LEADERBOARD HAS BEEN UPDATED!```")
+    if cmd_type == "status":
+        if not session:
+            await ctx.send(f"There is no current session in this channel. You can start a new one with:"
+                           f" ```{USAGES["session start"]}```")
+            return
+        ledger = await balances.get_session_ledger(table_key)
+        bank = get_user(user_id=session.bank_id)
+        body = []
+        for player_id, bought_in, cashed_out, result in ledger.rows():
+            plr = get_user(user_id=player_id)
+            body.append([plr.name if plr else str(player_id), f"${format(bought_in, ".2f")}",
+                         f"${format(cashed_out, ".2f")}",
+                         f"{f"${format(result, ".2f")}" if result >= 0 else f"-${format(-result, ".2f")}"}"])
+        status = (f"Banker: {bank.name if bank else session.bank_id}\nStart Time: {session.start}\n"
+                  f"Chips in play: ${format(ledger.chips_in_play(), ".2f")}")
+        if body:
+            status_ascii = t2a(
+                header=["Player", "Bought In", "Cashed Out", "Result"],
+                body=body,
+                style=PresetStyle.thin_compact
+            )
+            status += f"\n\n{status_ascii}"
+        await ctx.send(f"```{status}```")
     if cmd_type in ('buyin', 'cashout'):
-        if not session[0]:
-            await ctx.send(f"There is no current session. You can start a new one with:"
+        if not session:
+            await ctx.send(f"There is no current session in this channel. You can start a new one with:"
                            f"```{USAGES["session start"]}```")
             return
-        if len(args) != 3:
+        if len(args) < 3 or len(args) % 2 != 1:
             if cmd_type == 'buyin':
                 await ctx.send(f"Usage: ```{USAGES["session buyin"]}```")
             else:
                 await ctx.send(f"Usage: ```{USAGES["session cashout"]}```")
             return
-        amount = 0
-        try:
-            amount = float(args[2])
-        except TypeError:
-            await ctx.send(f"Invalid Amount '{args[2]}', likely non-numerical.")
-            return
-        if amount <= 0:
-            await ctx.send(f"Invalid Amount {format(amount, ".2f")}, must be greater than 0.")
-            return
-        payer_name = args[1]
-        payer = get_user(user_name=payer_name)
-        bank = get_user(user_id=session[2])
-        bank_name = bank.name
-        if not payer:
-            await ctx.send(f"User '{payer_name}' is not in the server, or you used an @")
-            return
+        bank = get_user(user_id=session.bank_id)
         if not bank:
-            await ctx.send(f"User '{bank_name}' (the bank player) is either no longer in the server, or an"
-                           f"error occurred.")
-            return
-        payer_plr = balances.get_player(payer)
-        bank_plr = balances.get_player(bank)
-        if not payer_plr:
-            await ctx.send(f"Player '{payer_name}' has not been added yet or an error occurred. "
-                           f"Try adding the player: ```lb add player {payer_name}```")
+            await ctx.send(f"The bank player is either no longer in the server, or an error occurred.")
             return
+        bank_name = bank.name
+        bank_plr = await balances.get_player(bank)
         if not bank_plr:
             await ctx.send(f"Player '{bank_name}' has not been added yet or an error occurred. "
                            f"Try adding the player: ```lb add player {bank_name}```")
             return
+        # every (player_name, amount) pair is validated first, then all of them are added in one transaction
+        entries = []
+        for i in range(1, len(args), 2):
+            payer_name = args[i]
+            amount = parse_amount(args[i + 1])
+            if amount is None:
+                await send_invalid_amount(ctx, args[i + 1], f"session {cmd_type}")
+                return
+            payer = get_user(user_name=payer_name)
+            if not payer:
+                await ctx.send(f"User '{payer_name}' is not in the server, or you used an @")
+                return
+            payer_plr = await balances.get_player(payer)
+            if not payer_plr:
+                await ctx.send(f"Player '{payer_name}' has not been added yet or an error occurred. "
+                               f"Try adding the player: ```lb add player {payer_name}```")
+                return
+            entries.append((payer, amount))
         if cmd_type == "buyin":
-            balances.add_debt("buyin", bank, payer, amount)
-            await ctx.send(f"Player '{payer_name}' has bought in for ${format(amount, ".2f")}. Bank: '{bank_name}'.\n"
-                           f"The following debt has been added:\n"
-                           f"```{payer_name} owes ${format(amount, ".2f")} to {bank_name}```")
+            debts = [("buyin", bank, payer, amount) for payer, amount in entries]
         else:
-            balances.add_debt("cashout", payer, bank, amount)
-            await ctx.send(f"Player '{payer_name}' has cashed out for ${format(amount, ".2f")}. Bank: '{bank_name}'.\n"
-                           f"The following debt has been added:\n"
-                           f"```{bank_name} owes ${format(amount, ".2f")} to {payer_name}```")
+            debts = [("cashout", payer, bank, amount) for payer, amount in entries]
+        if not await balances.add_debts(debts, table_key):
+            await ctx.send("ERROR: the transaction could not be recorded, nothing was added.")
+            return
+        for payer, amount in entries:
+            if cmd_type == "buyin":
+                await ctx.send(f"Player '{payer.name}' has bought in for ${format(amount, ".2f")}. "
+                               f"Bank: '{bank_name}'.\n"
+                               f"The following debt has been added:\n"
+                               f"```{payer.name} owes ${format(amount, ".2f")} to {bank_name}```")
+            else:
+                await ctx.send(f"Player '{payer.name}' has cashed out for ${format(amount, ".2f")}. "
+                               f"Bank: '{bank_name}'.\n"
+                               f"The following debt has been added:\n"
+                               f"```{bank_name} owes ${format(amount, ".2f")} to {payer.name}```")
 
 
 @bot.command()
+@scheduled(WRITE)
 async def payment(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
     if not (args and len(args) == 3):
         await ctx.send(f"Usage: ```{USAGES["payment"]}```")
         return
     payer_name = args[0]
     recipient_name = args[1]
-    amount = 0
-    try:
-        amount = float(args[2])
-    except:
-        await ctx.send(f"Invalid Amount '{args[2]}', likely non-numerical.")
+    amount = parse_amount(args[2])
+    if amount is None:
+        await send_invalid_amount(ctx, args[2], "payment")
         return
     payer = get_user(user_name=payer_name)
     recipient = get_user(user_name=recipient_name)
@@ -297,8 +582,253 @@ async def payment(ctx, *args):
         await ctx.send(f"User '{recipient_name}' is not in the server, or you used an @")
         return
     try:
-        balances.add_debt("payment", recipient, payer, -amount)
+        # add_debt doesn't check its players, so a payment with someone who isn't one would only land in the history
+        for plr_name, user in ((payer_name, payer), (recipient_name, recipient)):
+            if not await balances.get_player(user):
+                await ctx.send(f"Player '{plr_name}' has not been added yet or an error occurred. "
+                               f"Try adding the player: ```lb add player {plr_name}```")
+                return
+        if not await balances.add_debt("payment", recipient, payer, -amount):
+            await ctx.send("ERROR: the payment could not be recorded, nothing was added.")
+            return
+    except Exception as e:
+        await ctx.send(f"ERROR: {str(e)}")
+        return
+    await ctx.send(f"Player '{payer_name}' has paid {format_money(amount)} to '{recipient_name}'.\n"
+                   f"The following payment has been recorded:\n"
+                   f"```{payer_name} paid {format_money(amount)} to {recipient_name}```")
+
+
+# 'lb undo' voids the latest debt that hasn't been voided yet of the session running in the channel, or if none is, the
+#   latest recorded outside every running session: a table can't undo another table's debts. Run it again to void the
+#   one before.
+@bot.command()
+@scheduled(WRITE)
+async def undo(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    if args:
+        await ctx.send(f"Usage: ```{USAGES["undo"]}```")
+        return
+    table_key, session = await get_table(balances, ctx)
+    try:
+        voided = await balances.undo_last(table_key)
+    except ValueError as e:
+        await ctx.send(f"{str(e)}.")
+        return
+    except Exception as e:
+        await ctx.send(f"ERROR: {str(e)}")
+        return
+    if not voided:
+        await ctx.send("ERROR: the debt could not be voided, nothing was changed.")
+        return
+    where = f"of the session at {describe_table(table_key)}" if session else "recorded outside every running session"
+    await ctx.send(f"The following debt {where} has been undone:\n```{describe_debt(voided)}```")
+
+
+# 'lb void <debt_id>' voids one debt. With no debt_id it lists the latest VOID_LIST_ROWS debts that can be voided.
+@bot.command()
+@scheduled(lambda args: WRITE if args else READ)
+async def void(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    if not args:
+        try:
+            debts = await balances.get_voidable_debts(VOID_LIST_ROWS)
+        except Exception as e:
+            await ctx.send(f"ERROR: {str(e)}")
+            return
+        if not debts:
+            await ctx.send("There are no debts to void.")
+            return
+        await ctx.send(f"Usage: ```{USAGES["void"]}```Latest debts:\n"
+                       f"```{"\n".join(describe_debt(debt) for debt in debts)}```")
+        return
+    debt_id = args[0].lstrip("#")
+    if len(args) != 1 or not debt_id.isdigit():
+        await ctx.send(f"Usage: ```{USAGES["void"]}```")
+        return
+    try:
+        voided = await balances.void_debt(int(debt_id))
+    except ValueError as e:
+        await ctx.send(f"{str(e)}.")
+        return
+    except Exception as e:
+        await ctx.send(f"ERROR: {str(e)}")
+        return
+    if not voided:
+        await ctx.send("ERROR: the debt could not be voided, nothing was changed.")
+        return
+    await ctx.send(f"The following debt has been voided:\n```{describe_debt(voided)}```")
+
+
+@bot.command()
+@scheduled(READ)
+async def settle(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    if args and args[0] != "exact":
+        await ctx.send(f"Usage: ```{USAGES["settle"]}```")
+        return
+    try:
+        players = await balances.get_players()
+        # the exact search can take a while, so it runs on the executor, off the event loop
+        payments = await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(settle_balances, {plr.player_id: plr.balance for plr in players},
+                                        exact=bool(args)))
     except Exception as e:
         await ctx.send(f"ERROR: {str(e)}")
+        return
+    if not payments:
+        await ctx.send("Everyone is settled up, no payments needed.")
+        return
+    body = []
+    for payer_id, recipient_id, amount in payments:
+        payer = get_user(user_id=payer_id)
+        recipient = get_user(user_id=recipient_id)
+        body.append([payer.name if payer else str(payer_id), recipient.name if recipient else str(recipient_id),
+                     f"${format(amount, ".2f")}"])
+    settle_table = t2a(
+        header=["Payer", "Recipient", "Amount"],
+        body=body,
+        style=PresetStyle.thin_compact
+    )
+    await ctx.send(f"```{settle_table}\n{len(payments)} payment(s) settle every balance. Record each one with:\n"
+                   f"{USAGES["payment"]}```")
+
+
+@bot.command()
+@scheduled(READ)
+async def stats(ctx, *args):
+    if len(args) > 1:
+        await ctx.send(f"Usage: ```{USAGES["stats"]}```")
+        return
+    if args:
+        await player_stats(ctx, args[0])
+        return
+    if not is_admin(ctx):
+        await ctx.send("Only server administrators can see bot stats.")
+        return
+    command_rows = [[labels["command"], str(count), format_ms(average), format_ms(p95)]
+                    for _, labels, count, average, p95 in registry.summary("command_seconds")[:STATS_ROWS]]
+    query_rows = [[labels["query"], str(count), str(registry.get_counter("db_round_trips_total", **labels)),
+                   format_ms(average), format_ms(p95)]
+                  for _, labels, count, average, p95 in registry.summary("db_query_seconds")[:STATS_ROWS]]
+    cache_rows = [[cache_name, str(hits), str(misses), f"{format(100 * hits / (hits + misses), ".1f")}%"]
+                  for cache_name, (hits, misses) in sorted(registry.cache_stats().items()) if hits + misses]
+    lag = registry.get_gauge("event_loop_lag_seconds")
+    message = f"Event loop lag: {format_ms(lag)} ms\n"
+    if command_rows:
+        message += "\n" + t2a(header=["Command", "Calls", "Avg ms", "p95 ms"], body=command_rows,
+                              style=PresetStyle.thin_compact) + "\n"
+    if query_rows:
+        message += "\n" + t2a(header=["Query", "Runs", "Trips", "Avg ms", "p95 ms"], body=query_rows,
+                              style=PresetStyle.thin_compact) + "\n"
+    if cache_rows:
+        message += "\n" + t2a(header=["Cache", "Hits", "Misses", "Hit rate"], body=cache_rows,
+                              style=PresetStyle.thin_compact)
+    await ctx.send(f"```{message}```")
+
+
+# 'lb stats <player_name>': the player's totals over every finished session, and their last RECENT_SESSIONS results.
+async def player_stats(ctx, plr_name):
+    balances = await get_balances(ctx.guild.id)
+    user = get_user(user_name=plr_name)
+    if not user:
+        await ctx.send(f"User '{plr_name}' is not in the server, or you used an @")
+        return
+    try:
+        plr_stats = await balances.get_player_stats(user)
+    except Exception as e:
+        await ctx.send(f"ERROR: {str(e)}")
+        return
+    if not plr_stats:
+        await ctx.send(f"Player '{plr_name}' has not played in a finished session yet.")
+        return
+    roi = plr_stats.roi
+    message = (f"{plr_name}\n"
+               f"Sessions Played: {plr_stats.sessions_played}\n"
+               f"Hours Played: {format(plr_stats.hours_played, ".1f")}\n"
+               f"Bought In: {format_money(plr_stats.bought_in)}\n"
+               f"Cashed Out: {format_money(plr_stats.cashed_out)}\n"
+               f"Net Result: {format_money(plr_stats.net)}\n"
+               f"ROI: {f"{format(100 * roi, ".1f")}%" if roi is not None else "-"}\n"
+               f"Biggest Win: {format_money(plr_stats.biggest_win) if plr_stats.biggest_win > 0 else "-"}\n"
+               f"Biggest Loss: {format_money(plr_stats.biggest_loss) if plr_stats.biggest_loss < 0 else "-"}")
+    recent = [[session_end.strftime("%Y-%m-%d"), format_money(result), format_money(running_net)]
+              for session_end, result, running_net in reversed(plr_stats.history[-RECENT_SESSIONS:])]
+    history_ascii = t2a(
+        header=["Session End", "Result", "Running Net"],
+        body=recent,
+        style=PresetStyle.thin_compact
+    )
+    await ctx.send(f"```{message}\n\n{history_ascii}```")
+
+
+@bot.command(name="export")
+@scheduled(READ)
+async def export_command(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    if len(args) > 1 or (args and args[0] not in LEDGER_FORMATS):
+        await ctx.send(f"Usage: ```{USAGES["export"]}```")
+        return
+    if not is_admin(ctx):
+        await ctx.send("Only server administrators can export the ledger.")
+        return
+    file_format = args[0] if args else "jsonl"
+    file_name = f"ledger-{ctx.guild.id}{EXPORT_EXTENSIONS[file_format]}"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, file_name)
+        try:
+            count = await asyncio.get_running_loop().run_in_executor(executor, export_ledger, balances.balances, path,
+                                                                     file_format)
+            await ctx.send(f"Exported {count} records.", file=discord.File(path, filename=file_name))
+        except Exception as e:
+            await ctx.send(f"ERROR: {str(e)}")
+
+
+@bot.command(name="import")
+@scheduled(WRITE)
+async def import_command(ctx, *args):
+    balances = await get_balances(ctx.guild.id)
+    if args or not ctx.message.attachments:
+        await ctx.send(f"Usage: ```{USAGES["import"]}```")
+        return
+    if not is_admin(ctx):
+        await ctx.send("Only server administrators can import a ledger.")
+        return
+    attachment = ctx.message.attachments[0]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(attachment.filename))
+        try:
+            await attachment.save(path)
+            result = await asyncio.get_running_loop().run_in_executor(executor, import_ledger, balances.balances, path)
+        except Exception as e:
+            await ctx.send(f"ERROR: {str(e)}")
+            return
+    if result is None:
+        await ctx.send("ERROR: the import could not be written, nothing was added.")
+        return
+    user_index.load_players(await balances.get_players())
+    message = f"Imported {result.players} players, {result.sessions} sessions and {result.debts} debts."
+    if result.ended_sessions:
+        message += f" {result.ended_sessions} session(s) were still running in the file and have been ended."
+    if result.reconciles():
+        message += " Every balance reconciles."
+    else:
+        message += (f"\nWARNING: balances add up to {format_money(result.balance_total)} instead of $0.00, and "
+                    f"{len(result.mismatches)} player(s) don't match the balance and net winnings in the file.")
+    await ctx.send(message)
+
+
+def main():
+    from bot_token import TOKEN
+    # debts left in the journal from before every guild had its own go to guild 0's ledger, where they belong, before
+    #   anything else can happen (see write_behind.py)
+    legacy_balances = Balances(backend=ledgers.get_backend(ledgers.shard_of(DEFAULT_GUILD)), guild_id=DEFAULT_GUILD)
+    try:
+        replay_legacy_journal(legacy_balances)
+    except RuntimeError as err:
+        sys.exit(f"ERROR: {err}")
+    bot.run(TOKEN)
+
 
-bot.run(BOT_TOKEN)
+if __name__ == "__main__":
+    main()
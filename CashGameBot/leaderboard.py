@@ -0,0 +1,107 @@
+import bisect
+import threading
+
+# --- READ ME! ---:
+# This file holds the in-memory leaderboard kept by Balances, so leaderboard and rank lookups don't need to read and
+# sort every player from the database.
+#
+# for usage in file, write:
+# 'from leaderboard import Leaderboard'
+#
+# Leaderboard.load(players) replaces the whole board with a list of Player objects
+# Leaderboard.set_player(player_id, name, net) adds a player or moves them to a new net
+# Leaderboard.add_net(player_id, amount) adds 'amount' to a player's net
+# Leaderboard.get_rank(player_id) returns the player's dense rank (ties share a rank, the next rank is one lower)
+# Leaderboard.rows() returns [rank, name, net] for every player, highest net first
+#
+# Players are kept sorted by net, with a separate sorted list of distinct nets, so an update or a rank lookup costs
+# O(log n) comparisons instead of a full re-sort. All methods are thread-safe.
+
+
+# ------------- CLASSES -------------
+
+
+# class Leaderboard keeps players ordered by net winnings with precomputed dense ranks.
+# Initialize: board = Leaderboard()
+class Leaderboard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # player_id -> (name, net)
+        self.players = {}
+        # (-net, name, player_id) for every player, so the list reads highest net first
+        self.order = []
+        # distinct -net values in ascending order, and how many players are on each
+        self.nets = []
+        self.net_counts = {}
+
+    def __len__(self):
+        return len(self.players)
+
+    def __contains__(self, player_id):
+        return player_id in self.players
+
+    def __insert(self, player_id, name, net):
+        self.players[player_id] = (name, net)
+        bisect.insort(self.order, (-net, name, player_id))
+        if self.net_counts.get(-net, 0) == 0:
+            bisect.insort(self.nets, -net)
+        self.net_counts[-net] = self.net_counts.get(-net, 0) + 1
+
+    def __remove(self, player_id):
+        name, net = self.players.pop(player_id)
+        key = (-net, name, player_id)
+        del self.order[bisect.bisect_left(self.order, key)]
+        self.net_counts[-net] -= 1
+        if self.net_counts[-net] == 0:
+            del self.net_counts[-net]
+            del self.nets[bisect.bisect_left(self.nets, -net)]
+
+    def load(self, players):
+        with self.lock:
+            self.players = {}
+            self.order = []
+            self.nets = []
+            self.net_counts = {}
+            for plr in players:
+                self.__insert(plr.player_id, plr.name, plr.net if plr.net is not None else 0)
+
+    def set_player(self, player_id, name, net):
+        with self.lock:
+            if player_id in self.players:
+                if self.players[player_id] == (name, net):
+                    return
+                self.__remove(player_id)
+            self.__insert(player_id, name, net)
+
+    def add_net(self, player_id, amount):
+        with self.lock:
+            if player_id not in self.players or not amount:
+                return
+            name, net = self.players[player_id]
+            self.__remove(player_id)
+            self.__insert(player_id, name, net + amount)
+
+    def get_net(self, player_id):
+        with self.lock:
+            if player_id not in self.players:
+                return None
+            return self.players[player_id][1]
+
+    def get_rank(self, player_id):
+        with self.lock:
+            if player_id not in self.players:
+                return None
+            net = self.players[player_id][1]
+            return bisect.bisect_left(self.nets, -net) + 1
+
+    def rows(self):
+        with self.lock:
+            rows = []
+            rank = 0
+            current_net = None
+            for neg_net, name, player_id in self.order:
+                if neg_net != current_net:
+                    rank += 1
+                    current_net = neg_net
+                rows.append([rank, name, -neg_net])
+            return rows
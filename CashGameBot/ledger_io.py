@@ -0,0 +1,327 @@
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import zipfile
+from decimal import Decimal, InvalidOperation
+from balances import CHUNK_SIZE
+
+# --- READ ME! ---:
+# This file exports a guild's ledger (players, sessions and debt history) to a file, and imports one back, to back it
+# up, move it to another guild or database, or load history kept somewhere else (e.g. a spreadsheet).
+#
+# for usage in file, write:
+# 'from ledger_io import export_ledger, import_ledger'
+#
+# export_ledger(balances, path, file_format) writes the ledger of 'balances' to 'path' and returns how many records
+# import_ledger(balances, path) adds the records in 'path' to the ledger of 'balances' and returns an ImportResult (see
+#     Balances.import_records): what was added, and whether the rebuilt balances reconcile
+#
+# Or from the command line (see --help), e.g.
+#     python ledger_io.py export <guild_id> ledger.jsonl.gz
+#     python ledger_io.py import <guild_id> ledger.jsonl.gz
+# The bot has the same as 'lb export [format]' and 'lb import' (with the file attached), for server administrators.
+# Stop the bot before importing from the command line: the bot caches balances, sessions and players, and wouldn't see
+# the import (nor could its journal, see write_behind.py, be flushed into it first). While it runs, use 'lb import'.
+#
+# Imports go into a ledger without debts only (players may be there already), and every player a debt names must be
+# in the ledger or in the file. Sessions still running in the file are ended at the time of the import.
+#
+# FORMATS:
+# jsonl - one JSON object per line with a "type" of player, session or debt. Gzipped when the path ends in '.gz'
+# csv - a zip holding players.csv, sessions.csv and debts.csv
+# parquet - a zip holding players.parquet, sessions.parquet and debts.parquet. Needs pyarrow installed
+# A plain .csv file holding just one of those tables (picked by its header) can also be imported, e.g. a debts.csv
+# saved from a spreadsheet (add its players with 'lb add player' first). Its columns are the FIELDS of that table;
+# balance, net_gain, session_id, debt_id and reverses_id can be left out. Reversals (voided debts, see
+# Balances.void_debt) keep pointing at their debt through debt_id and reverses_id.
+#
+# Records are streamed both ways in chunks of CHUNK_SIZE rows, so memory stays bounded however long the history is.
+# Imports go in one transaction with bulk inserts (executemany), so they take seconds, not one round trip per debt.
+
+
+# ------------- CONSTANTS -------------
+
+
+FORMATS = ("jsonl", "csv", "parquet")
+# columns of each record type, in the order Balances.iter_records and Balances.import_records use
+FIELDS = {
+    "player": ("player_id", "player_name", "balance", "net_gain"),
+    "session": ("session_id", "table_key", "bank_id", "session_start", "session_end"),
+    "debt": ("debt_type", "recipient_id", "payer_id", "amount", "date", "session_id", "debt_id", "reverses_id"),
+}
+# file names inside csv and parquet zips, in the order they're written and read
+TABLE_FILES = {"player": "players", "session": "sessions", "debt": "debts"}
+INT_FIELDS = {"player_id", "session_id", "bank_id", "recipient_id", "payer_id", "debt_id", "reverses_id"}
+MONEY_FIELDS = {"balance", "net_gain", "amount"}
+DATE_FIELDS = {"session_start", "session_end", "date"}
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Turns a value read from a file into what Balances.import_records expects for column 'field': ints, Decimals,
+#   DATE_FORMAT strings, or None for an empty value.
+def parse_value(field, value):
+    if value is None or value == "":
+        return None
+    try:
+        if field in INT_FIELDS:
+            return int(value)
+        if field in MONEY_FIELDS:
+            return Decimal(str(value))
+        if field in DATE_FIELDS:
+            if isinstance(value, datetime.datetime):
+                return value.strftime(DATE_FORMAT)
+            return datetime.datetime.fromisoformat(str(value)).strftime(DATE_FORMAT)
+    except (ValueError, InvalidOperation):
+        raise ValueError(f"Invalid {field} '{value}'")
+    return str(value)
+
+
+# Turns a value of a ledger record into JSON and CSV friendly text (None stays None).
+def format_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+# Builds a record as Balances.import_records takes it from {field: value} 'row' of type 'kind'.
+def make_record(kind, row):
+    if kind not in FIELDS:
+        raise ValueError(f"Unknown record type '{kind}'")
+    return (kind, *(parse_value(field, row.get(field)) for field in FIELDS[kind]))
+
+
+def guess_format(path):
+    name = path.lower()
+    if name.endswith(".jsonl") or name.endswith(".jsonl.gz"):
+        return "jsonl"
+    if name.endswith(".parquet.zip"):
+        return "parquet"
+    return "csv"
+
+
+def open_text(path, mode):
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("The parquet format needs pyarrow installed ('pip install pyarrow')")
+    return pyarrow, pyarrow.parquet
+
+
+# Groups consecutive records of the same type: yields (kind, records) for each run, at most 'size' records long.
+def iter_chunks(records, size=CHUNK_SIZE):
+    kind = None
+    chunk = []
+    for record in records:
+        if chunk and (record[0] != kind or len(chunk) >= size):
+            yield kind, chunk
+            chunk = []
+        kind = record[0]
+        chunk.append(record)
+    if chunk:
+        yield kind, chunk
+
+
+def write_jsonl(records, path):
+    count = 0
+    with open_text(path, "w") as file:
+        for record in records:
+            row = {"type": record[0]}
+            row.update(zip(FIELDS[record[0]], map(format_value, record[1:])))
+            file.write(json.dumps(row, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def write_csv_zip(records, path):
+    count = 0
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        member = writer = None
+        written = set()
+        for kind, chunk in iter_chunks(records):
+            if kind not in written:
+                if member:
+                    member.close()
+                member = io.TextIOWrapper(archive.open(TABLE_FILES[kind] + ".csv", "w"), encoding="utf-8",
+                                          newline="")
+                writer = csv.writer(member)
+                writer.writerow(FIELDS[kind])
+                written.add(kind)
+            writer.writerows([["" if value is None else format_value(value) for value in record[1:]]
+                              for record in chunk])
+            count += len(chunk)
+        if member:
+            member.close()
+    return count
+
+
+def write_parquet_zip(records, path):
+    pyarrow, parquet = import_pyarrow()
+    schemas = {
+        "player": pyarrow.schema([("player_id", pyarrow.int64()), ("player_name", pyarrow.string()),
+                                  ("balance", pyarrow.decimal128(12, 2)), ("net_gain", pyarrow.decimal128(12, 2))]),
+        "session": pyarrow.schema([("session_id", pyarrow.int64()), ("table_key", pyarrow.string()),
+                                   ("bank_id", pyarrow.int64()), ("session_start", pyarrow.timestamp("s")),
+                                   ("session_end", pyarrow.timestamp("s"))]),
+        "debt": pyarrow.schema([("debt_type", pyarrow.string()), ("recipient_id", pyarrow.int64()),
+                                ("payer_id", pyarrow.int64()), ("amount", pyarrow.decimal128(12, 2)),
+                                ("date", pyarrow.timestamp("s")), ("session_id", pyarrow.int64()),
+                                ("debt_id", pyarrow.int64()), ("reverses_id", pyarrow.int64())]),
+    }
+    count = 0
+    # every table goes to a temporary file first (parquet writers need a seekable file), then into the zip
+    with tempfile.TemporaryDirectory() as directory:
+        writers = {}
+        for kind, chunk in iter_chunks(records):
+            if kind not in writers:
+                writers[kind] = parquet.ParquetWriter(os.path.join(directory, TABLE_FILES[kind] + ".parquet"),
+                                                      schemas[kind])
+            columns = list(zip(*(record[1:] for record in chunk)))
+            writers[kind].write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, schemas[kind])],
+                schema=schemas[kind]))
+            count += len(chunk)
+        for writer in writers.values():
+            writer.close()
+        with zipfile.ZipFile(path, "w") as archive:
+            for kind in TABLE_FILES:
+                if kind in writers:
+                    archive.write(os.path.join(directory, TABLE_FILES[kind] + ".parquet"),
+                                  TABLE_FILES[kind] + ".parquet")
+    return count
+
+
+# Writes every record of the ledger of 'balances' to 'path' in 'file_format' (guessed from the path if None). Returns
+#   how many records were written.
+def export_ledger(balances, path, file_format=None):
+    file_format = file_format or guess_format(path)
+    writers = {"jsonl": write_jsonl, "csv": write_csv_zip, "parquet": write_parquet_zip}
+    if file_format not in writers:
+        raise ValueError(f"Unknown format '{file_format}', use one of: {', '.join(FORMATS)}")
+    return writers[file_format](balances.iter_records(), path)
+
+
+def read_jsonl(path):
+    with open_text(path, "r") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Line {line_number} is not valid JSON")
+            yield make_record(row.get("type"), row)
+
+
+# Reads one table from CSV 'file'. Its header says which table it is: the record type whose required FIELDS it has.
+def read_csv_table(file, kind=None):
+    reader = csv.DictReader(file)
+    columns = set(reader.fieldnames or ())
+    if kind is None:
+        optional = {"balance", "net_gain", "session_id", "debt_id", "reverses_id"}
+        kinds = [name for name, fields in FIELDS.items() if set(fields) - optional <= columns]
+        if len(kinds) != 1:
+            raise ValueError(f"Can't tell which table has the columns: {', '.join(sorted(columns))}")
+        kind = kinds[0]
+    for row in reader:
+        yield make_record(kind, row)
+
+
+def read_csv_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        for kind, file_name in TABLE_FILES.items():
+            if file_name + ".csv" in names:
+                with io.TextIOWrapper(archive.open(file_name + ".csv"), encoding="utf-8", newline="") as file:
+                    yield from read_csv_table(file, kind)
+
+
+def read_parquet_zip(path):
+    _, parquet = import_pyarrow()
+    with zipfile.ZipFile(path) as archive, tempfile.TemporaryDirectory() as directory:
+        names = set(archive.namelist())
+        for kind, file_name in TABLE_FILES.items():
+            if file_name + ".parquet" not in names:
+                continue
+            # extracted to disk, so row groups can be read one at a time
+            table_path = archive.extract(file_name + ".parquet", directory)
+            for batch in parquet.ParquetFile(table_path).iter_batches(batch_size=CHUNK_SIZE):
+                for row in batch.to_pylist():
+                    yield make_record(kind, row)
+
+
+# Yields the records in the file at 'path', whatever its format.
+def read_records(path):
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+        if any(name.endswith(".parquet") for name in names):
+            return read_parquet_zip(path)
+        return read_csv_zip(path)
+    if guess_format(path) == "jsonl":
+        return read_jsonl(path)
+
+    def read_csv_file():
+        with open_text(path, "r") as file:
+            yield from read_csv_table(file)
+    return read_csv_file()
+
+
+# Adds every record in the file at 'path' to the ledger of 'balances'. Returns an ImportResult, or None if the
+#   database refused the import (nothing is added then). Raises ValueError if the file can't be read.
+def import_ledger(balances, path):
+    return balances.import_records(read_records(path))
+
+
+def main():
+    from sharding import LedgerRouter
+    parser = argparse.ArgumentParser(description="Export a guild's ledger to a file, or import one",
+                                     epilog="Stop the bot before importing: it caches balances and sessions, and "
+                                            "wouldn't see the import. Use 'lb import' while it runs.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("guild_id", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, help="export format (default: from the path's extension)")
+    args = parser.parse_args()
+
+    ledgers = LedgerRouter()
+    try:
+        balances = ledgers.get(args.guild_id)
+        if args.action == "export":
+            count = export_ledger(balances, args.path, args.format)
+            print(f"Exported {count} records to {args.path}")
+            return
+        result = import_ledger(balances, args.path)
+        if result is None:
+            sys.exit("Import failed, nothing was added (see the log)")
+        print(f"Imported {result.players} players, {result.sessions} sessions and {result.debts} debts")
+        if result.ended_sessions:
+            print(f"Ended {result.ended_sessions} session(s) that were still running in the file")
+        if not result.reconciles():
+            sys.exit(f"Balances don't reconcile: they add up to {result.balance_total}, "
+                     f"{len(result.mismatches)} player(s) differ from the import")
+    except ValueError as err:
+        sys.exit(f"ERROR: {err}")
+    finally:
+        ledgers.close()
+
+
+if __name__ == "__main__":
+    main()
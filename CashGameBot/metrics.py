@@ -0,0 +1,252 @@
+import asyncio
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- READ ME! ---:
+# This file holds the bot's instrumentation: latency histograms, counters and gauges, kept in memory.
+#
+# for usage in file, write:
+# 'from metrics import registry'
+#
+# registry.observe("command_seconds", elapsed, command="leaderboard")   # adds one sample to a histogram
+# registry.inc("db_round_trips_total", query="SELECT player_data")       # adds to a counter
+# registry.set("event_loop_lag_seconds", lag)                            # sets a gauge
+# with registry.time("db_query_seconds", query=...): ...                 # times a block into a histogram
+# registry.cache("leaderboard", hit)                                     # counts a cache hit or miss
+#
+# WHAT IS MEASURED:
+# command_seconds{command} - latency of every bot command (see interactions.py)
+# command_wait_seconds{mode} - how long every read or write command waited for its turn (see scheduler.py)
+# commands_rejected_total{mode} - commands turned away because too many were already waiting
+# db_query_seconds{query} / db_round_trips_total{query} - time of every statement Balances runs, and how many trips to
+#     the database it took (the statement plus every chunk fetched). 'query' is the statement's verb and table, e.g.
+#     'UPDATE player_data'
+# db_errors_total{query} - statements that failed
+# cache_requests_total{cache, result} - hits and misses of the in-memory caches (leaderboard, users, render, stats)
+# event_loop_lag_seconds - how late the event loop woke up from a sleep, i.e. how long something blocked it
+# refresh_balances_seconds{full} - time of every Balances.refresh_balances
+# projection_rebuild_seconds{projection} - time each projection took to rebuild in refresh_balances (see projections.py)
+# write_behind_pending - journal entries waiting to be written to the database (see write_behind.py)
+#
+# registry.render() returns every metric in the Prometheus text format. start_http_server(port) serves it on
+# http://<host>:<port>/metrics; the bot does that when the CASHGAMEBOT_METRICS_PORT environment variable is set. The
+# 'lb stats' command (with no player name) shows registry.summary() in discord.
+#
+# LOGGING: modules log through logging.getLogger(__name__). configure_logging() sets the level from the
+# CASHGAMEBOT_LOG_LEVEL environment variable (INFO by default).
+
+
+# ------------- CONSTANTS -------------
+
+
+METRICS_PORT = os.environ.get("CASHGAMEBOT_METRICS_PORT")
+LOG_LEVEL = os.environ.get("CASHGAMEBOT_LOG_LEVEL", "INFO")
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds between event loop lag samples
+LAG_INTERVAL = 1
+SQL_TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
+# ------------- FUNCTIONS -------------
+
+
+def configure_logging(level=LOG_LEVEL):
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+# Returns a short, low-cardinality label for SQL 'query': its first keyword and the first table it names, e.g.
+#   'SELECT debt_history'. Used to group query metrics without one series per distinct statement.
+def query_label(query):
+    words = query.split(None, 1)
+    if not words:
+        return "EMPTY"
+    table = SQL_TABLE_PATTERN.search(query)
+    return f"{words[0].upper()} {table.group(1)}" if table else words[0].upper()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+# Samples event loop lag every 'interval' seconds, forever. Start it as a task from the running loop.
+async def monitor_event_loop(interval=LAG_INTERVAL, metrics=None):
+    metrics = metrics or registry
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.set("event_loop_lag_seconds", lag)
+        metrics.observe("event_loop_lag_seconds_histogram", lag)
+        if lag > 0.5:
+            logger.warning("Event loop was blocked for %.3fs", lag)
+
+
+# Serves registry.render() at http://<host>:<port>/metrics from a daemon thread. Returns the server.
+def start_http_server(port, host="", metrics=None):
+    metrics = metrics or registry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request: " + format, *args)
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Serving metrics on port %s", port)
+    return server
+
+
+# ------------- CLASSES -------------
+
+
+# class Histogram counts samples into fixed BUCKETS, like a Prometheus histogram, and estimates percentiles from them.
+# Initialize: histogram = Histogram()
+class Histogram:
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        # counts[i] is the number of samples <= BUCKETS[i] and > BUCKETS[i - 1]; the last slot is everything above
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    # Upper bound of the bucket holding the 'fraction' (e.g. 0.95) percentile, or None with no samples.
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+# class MetricsRegistry holds every histogram, counter and gauge by (name, labels). Thread-safe.
+# Initialize: metrics = MetricsRegistry() (the bot shares the module-level 'registry')
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def cache(self, cache_name, hit):
+        self.inc("cache_requests_total", cache=cache_name, result="hit" if hit else "miss")
+
+    # Returns {cache_name: (hits, misses)}.
+    def cache_stats(self):
+        stats = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                if name != "cache_requests_total":
+                    continue
+                labels = dict(labels)
+                hits, misses = stats.get(labels["cache"], (0, 0))
+                if labels["result"] == "hit":
+                    hits += value
+                else:
+                    misses += value
+                stats[labels["cache"]] = (hits, misses)
+        return stats
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_gauge(self, name, **labels):
+        return self.gauges.get((name, tuple(sorted(labels.items()))))
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    # Returns [name, labels (dict), count, average seconds, p95 seconds] for every histogram named 'name' (or every
+    #   histogram), slowest total time first.
+    def summary(self, name=None):
+        with self.lock:
+            rows = [[histogram_name, dict(labels), histogram.count, histogram.total / histogram.count,
+                     histogram.percentile(0.95), histogram.total]
+                    for (histogram_name, labels), histogram in self.histograms.items()
+                    if histogram.count and (name is None or histogram_name == name)]
+        rows.sort(key=lambda row: -row[5])
+        return [row[:5] for row in rows]
+
+    # Returns every metric in the Prometheus text exposition format.
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
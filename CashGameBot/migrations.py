@@ -0,0 +1,563 @@
+import datetime
+import logging
+
+# --- READ ME! ---:
+# This file builds and upgrades the database schema through numbered migrations.
+#
+# Run 'python migrations.py' to create the cashgamebot database (if needed) and bring it up to date, on the backend
+# selected in storage.py. Balances also
+# calls migrate() when it starts, so a running bot never uses an out-of-date schema.
+#
+# The schema_version table records every migration that has been applied. migrate(backend) applies the missing ones in
+# order. TO CHANGE THE SCHEMA: add a new entry at the end of MIGRATIONS, never edit one that has already shipped. Each
+# entry maps a storage dialect (see storage.py) to the function that applies it there; a dialect with no function has
+# nothing to do for that version. MySQL commits DDL statements immediately, so migrations can't be rolled back halfway;
+# write each one so that running it again after a failure is harmless. SQLite runs each migration in a transaction of
+# its own (opened explicitly: Python's sqlite3 would otherwise commit DDL as it goes), so a failed one leaves nothing
+# behind, and its ALTER TABLE steps check for their column first all the same.
+#
+# SCHEMA:
+# debt_history: the ledger's append-only event log (see events.py), one row per event, keyed by debt_id, indexed by
+#     recipient_id, payer_id, date, session_id (the session a buy-in or cash-out belongs to, NULL for debts made
+#     outside a session) and reverses_id (the event a reversal undoes)
+# player_data: one row per player, keyed by player_id. balance and net_gain are a projection of debt_history
+# sessions: one row per session (running or finished), keyed by session_id, indexed by table_key
+# pair_balances: what every pair of players owes each other, a projection of debt_history (see projections.py)
+# balance_checkpoint / player_checkpoint / pair_checkpoint: snapshots of the projections, used by
+#     Balances.refresh_balances(full=False)
+# journal_state: one row per write-behind journal (see write_behind.py), holding the last journal entry written to
+#     debt_history
+# Every table but schema_version has a guild_id column (the discord guild the row belongs to) leading its keys and
+# indexes, so each guild's ledger is read through its own index ranges. Rows recorded before guilds had their own
+# ledgers have guild_id 0; hand them to the guild they came from with
+# 'python migrations.py --claim-guild <guild_id>' while the bot is stopped, before that guild records any debts.
+# Money is stored as DECIMAL(12, 2), so balances add up exactly. SQLite has no exact decimal type, so there the same
+# columns hold whole cents as integers (see storage.py). Player ids are BIGINT, since discord ids don't fit in an INT.
+
+
+logger = logging.getLogger(__name__)
+
+
+# ------------- FUNCTIONS -------------
+
+
+def get_columns(cursor, table_name):
+    cursor.execute("SELECT column_name, column_type FROM information_schema.columns "
+                   "WHERE table_schema = DATABASE() AND table_name = %s", (table_name,))
+    return {column_name.lower(): column_type.lower() for column_name, column_type in cursor.fetchall()}
+
+
+def get_columns_sqlite(cursor, table_name):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return {row[1].lower(): row[2].lower() for row in cursor.fetchall()}
+
+
+def get_indexes(cursor, table_name):
+    cursor.execute("SELECT DISTINCT index_name FROM information_schema.statistics "
+                   "WHERE table_schema = DATABASE() AND table_name = %s", (table_name,))
+    return {index_name for (index_name,) in cursor.fetchall()}
+
+
+def add_index(cursor, table_name, index_name, columns):
+    if index_name not in get_indexes(cursor, table_name):
+        cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns})")
+
+
+# Version 1: every table the bot uses, for a brand new database. Tables that already exist are left alone here and
+#   upgraded by version 2.
+def create_tables_mysql(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS debt_history (
+        debt_id INT AUTO_INCREMENT PRIMARY KEY,
+        debt_type VARCHAR(20) NOT NULL,
+        recipient_id BIGINT NOT NULL,
+        payer_id BIGINT NOT NULL,
+        amount DECIMAL(12, 2) NOT NULL,
+        date DATETIME NOT NULL,
+        INDEX debt_history_recipient (recipient_id),
+        INDEX debt_history_payer (payer_id),
+        INDEX debt_history_date (date)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS player_data (
+        player_id BIGINT PRIMARY KEY,
+        player_name VARCHAR(32) NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        net_gain DECIMAL(12, 2) NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS session (
+        is_session TINYINT NOT NULL DEFAULT 0,
+        session_start DATETIME NULL,
+        bank_id BIGINT NULL
+    )
+    """)
+    cursor.execute("INSERT INTO session (is_session) SELECT 0 FROM DUAL WHERE NOT EXISTS (SELECT * FROM session)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS balance_checkpoint (
+        checkpoint_id INT AUTO_INCREMENT PRIMARY KEY,
+        last_debt_id INT NOT NULL,
+        created DATETIME
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS player_checkpoint (
+        checkpoint_id INT NOT NULL,
+        player_id BIGINT NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL,
+        net_gain DECIMAL(12, 2) NOT NULL,
+        PRIMARY KEY (checkpoint_id, player_id)
+    )
+    """)
+
+
+def create_tables_sqlite(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS debt_history (
+        debt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        debt_type VARCHAR(20) NOT NULL,
+        recipient_id BIGINT NOT NULL,
+        payer_id BIGINT NOT NULL,
+        amount DECIMAL(12, 2) NOT NULL,
+        date DATETIME NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_recipient ON debt_history (recipient_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_payer ON debt_history (payer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_date ON debt_history (date)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS player_data (
+        player_id BIGINT PRIMARY KEY,
+        player_name VARCHAR(32) NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        net_gain DECIMAL(12, 2) NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS session (
+        is_session TINYINT NOT NULL DEFAULT 0,
+        session_start DATETIME NULL,
+        bank_id BIGINT NULL
+    )
+    """)
+    cursor.execute("INSERT INTO session (is_session) SELECT 0 WHERE NOT EXISTS (SELECT * FROM session)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS balance_checkpoint (
+        checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        last_debt_id INT NOT NULL,
+        created DATETIME
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS player_checkpoint (
+        checkpoint_id INT NOT NULL,
+        player_id BIGINT NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL,
+        net_gain DECIMAL(12, 2) NOT NULL,
+        PRIMARY KEY (checkpoint_id, player_id)
+    )
+    """)
+
+
+# Version 2: brings tables created by hand (or by older versions of the bot) up to the version 1 layout: surrogate key
+#   on debt_history, primary key on player_data, exact money types and the per-player indexes.
+#   Converting FLOAT amounts to DECIMAL rounds them to the cent; run Balances.refresh_balances() afterwards to rebuild
+#   balances without the old float drift.
+def upgrade_legacy_tables(cursor):
+    if "debt_id" not in get_columns(cursor, "debt_history"):
+        cursor.execute("ALTER TABLE debt_history ADD COLUMN debt_id INT AUTO_INCREMENT PRIMARY KEY FIRST")
+    cursor.execute("""
+    ALTER TABLE debt_history
+        MODIFY debt_type VARCHAR(20) NOT NULL,
+        MODIFY recipient_id BIGINT NOT NULL,
+        MODIFY payer_id BIGINT NOT NULL,
+        MODIFY amount DECIMAL(12, 2) NOT NULL,
+        MODIFY date DATETIME NOT NULL
+    """)
+    add_index(cursor, "debt_history", "debt_history_recipient", "recipient_id")
+    add_index(cursor, "debt_history", "debt_history_payer", "payer_id")
+    add_index(cursor, "debt_history", "debt_history_date", "date")
+
+    if "net_gain" not in get_columns(cursor, "player_data"):
+        cursor.execute("ALTER TABLE player_data ADD COLUMN net_gain DECIMAL(12, 2) NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE player_data SET balance = COALESCE(balance, 0), net_gain = COALESCE(net_gain, 0)")
+    cursor.execute("""
+    ALTER TABLE player_data
+        MODIFY player_id BIGINT NOT NULL,
+        MODIFY player_name VARCHAR(32) NOT NULL,
+        MODIFY balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        MODIFY net_gain DECIMAL(12, 2) NOT NULL DEFAULT 0
+    """)
+    if "PRIMARY" not in get_indexes(cursor, "player_data"):
+        cursor.execute("ALTER TABLE player_data ADD PRIMARY KEY (player_id)")
+
+    cursor.execute("ALTER TABLE session MODIFY session_start DATETIME NULL, MODIFY bank_id BIGINT NULL")
+    cursor.execute("ALTER TABLE player_checkpoint "
+                   "MODIFY player_id BIGINT NOT NULL, "
+                   "MODIFY balance DECIMAL(12, 2) NOT NULL, "
+                   "MODIFY net_gain DECIMAL(12, 2) NOT NULL")
+
+
+# Version 3: replaces the single-row session table with one row per session, so several tables can run a session at
+#   once and past sessions are kept. A session that was running carries over to the default table, 'main'. The bot
+#   keys tables by channel, and lets any channel with no session of its own reach that one (see interactions.py).
+def create_sessions_mysql(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id INT AUTO_INCREMENT PRIMARY KEY,
+        table_key VARCHAR(64) NOT NULL,
+        bank_id BIGINT NOT NULL,
+        session_start DATETIME NOT NULL,
+        session_end DATETIME NULL,
+        INDEX sessions_table (table_key, session_end)
+    )
+    """)
+    move_running_session(cursor)
+
+
+def create_sessions_sqlite(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_key VARCHAR(64) NOT NULL,
+        bank_id BIGINT NOT NULL,
+        session_start DATETIME NOT NULL,
+        session_end DATETIME NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS sessions_table ON sessions (table_key, session_end)")
+    move_running_session(cursor)
+
+
+def move_running_session(cursor):
+    cursor.execute("INSERT INTO sessions (table_key, bank_id, session_start) "
+                   "SELECT 'main', bank_id, session_start FROM session "
+                   "WHERE is_session = 1 AND bank_id IS NOT NULL AND session_start IS NOT NULL")
+    cursor.execute("DROP TABLE session")
+
+
+# Version 4: tags every debt with the session it belongs to. Debts of a session that is still running are matched to it
+#   the way older versions of the bot did (any debt with its banker since it started). Debts of past sessions stay NULL.
+def add_debt_session_mysql(cursor):
+    if "session_id" not in get_columns(cursor, "debt_history"):
+        cursor.execute("ALTER TABLE debt_history ADD COLUMN session_id INT NULL, "
+                       "ADD CONSTRAINT debt_history_session_fk "
+                       "FOREIGN KEY (session_id) REFERENCES sessions (session_id)")
+    add_index(cursor, "debt_history", "debt_history_session", "session_id")
+    tag_running_session_debts(cursor)
+
+
+def add_debt_session_sqlite(cursor):
+    if "session_id" not in get_columns_sqlite(cursor, "debt_history"):
+        cursor.execute("ALTER TABLE debt_history ADD COLUMN session_id INTEGER NULL REFERENCES sessions (session_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_session ON debt_history (session_id)")
+    tag_running_session_debts(cursor)
+
+
+def tag_running_session_debts(cursor):
+    cursor.execute("""
+    UPDATE debt_history
+    SET session_id = (SELECT s.session_id FROM sessions s
+                      WHERE s.session_end IS NULL AND debt_history.date >= s.session_start
+                            AND s.bank_id IN (debt_history.recipient_id, debt_history.payer_id)
+                      ORDER BY s.session_id LIMIT 1)
+    WHERE session_id IS NULL AND amount > 0
+    """)
+
+
+# Version 5: the write-behind journal watermark.
+def create_journal_state(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS journal_state (
+        journal_key VARCHAR(64) PRIMARY KEY,
+        last_seq BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+
+
+# Version 6: a guild_id on every table, leading every key and index. Existing rows go to guild 0.
+GUILD_TABLES = ("debt_history", "player_data", "sessions", "balance_checkpoint", "player_checkpoint", "journal_state")
+
+
+def replace_index_mysql(cursor, table_name, old_index_name, index_name, columns):
+    add_index(cursor, table_name, index_name, columns)
+    if old_index_name in get_indexes(cursor, table_name):
+        cursor.execute(f"DROP INDEX {old_index_name} ON {table_name}")
+
+
+def add_guild_keys_mysql(cursor):
+    for table_name in GUILD_TABLES:
+        if "guild_id" not in get_columns(cursor, table_name):
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN guild_id BIGINT NOT NULL DEFAULT 0 FIRST")
+    cursor.execute("ALTER TABLE player_data DROP PRIMARY KEY, ADD PRIMARY KEY (guild_id, player_id)")
+    cursor.execute("ALTER TABLE journal_state DROP PRIMARY KEY, ADD PRIMARY KEY (guild_id, journal_key)")
+    replace_index_mysql(cursor, "debt_history", "debt_history_recipient", "debt_history_guild_recipient",
+                        "guild_id, recipient_id")
+    replace_index_mysql(cursor, "debt_history", "debt_history_payer", "debt_history_guild_payer", "guild_id, payer_id")
+    replace_index_mysql(cursor, "debt_history", "debt_history_date", "debt_history_guild_date", "guild_id, date")
+    add_index(cursor, "debt_history", "debt_history_guild_debt", "guild_id, debt_id")
+    replace_index_mysql(cursor, "sessions", "sessions_table", "sessions_guild_table",
+                        "guild_id, table_key, session_end")
+    add_index(cursor, "balance_checkpoint", "balance_checkpoint_guild", "guild_id, checkpoint_id")
+
+
+def add_guild_keys_sqlite(cursor):
+    for table_name in ("debt_history", "sessions", "balance_checkpoint", "player_checkpoint"):
+        if "guild_id" not in get_columns_sqlite(cursor, table_name):
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN guild_id BIGINT NOT NULL DEFAULT 0")
+    # SQLite can't change a primary key in place, so these two tables are rebuilt
+    cursor.execute("""
+    CREATE TABLE player_data_new (
+        guild_id BIGINT NOT NULL DEFAULT 0,
+        player_id BIGINT NOT NULL,
+        player_name VARCHAR(32) NOT NULL,
+        balance DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        net_gain DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, player_id)
+    )
+    """)
+    cursor.execute("INSERT INTO player_data_new (player_id, player_name, balance, net_gain) "
+                   "SELECT player_id, player_name, balance, net_gain FROM player_data")
+    cursor.execute("DROP TABLE player_data")
+    cursor.execute("ALTER TABLE player_data_new RENAME TO player_data")
+    cursor.execute("""
+    CREATE TABLE journal_state_new (
+        guild_id BIGINT NOT NULL DEFAULT 0,
+        journal_key VARCHAR(64) NOT NULL,
+        last_seq BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, journal_key)
+    )
+    """)
+    cursor.execute("INSERT INTO journal_state_new (journal_key, last_seq) "
+                   "SELECT journal_key, last_seq FROM journal_state")
+    cursor.execute("DROP TABLE journal_state")
+    cursor.execute("ALTER TABLE journal_state_new RENAME TO journal_state")
+    for old_index_name in ("debt_history_recipient", "debt_history_payer", "debt_history_date", "sessions_table"):
+        cursor.execute(f"DROP INDEX IF EXISTS {old_index_name}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_guild_recipient ON debt_history (guild_id, recipient_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_guild_payer ON debt_history (guild_id, payer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_guild_date ON debt_history (guild_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_guild_debt ON debt_history (guild_id, debt_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS sessions_guild_table ON sessions (guild_id, table_key, session_end)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS balance_checkpoint_guild "
+                   "ON balance_checkpoint (guild_id, checkpoint_id)")
+
+
+# Version 7: debt_history becomes the ledger's event log (see events.py). Reversals point at the event they undo, and
+#   every session's start and end is an event too (backfilled here for existing sessions). Adds the pair_balances
+#   projection, built from the history, and its checkpoints. Older checkpoints have no pair_checkpoint rows, so they're
+#   dropped; the next refresh_balances or end_session takes a new one.
+def create_event_store_mysql(cursor):
+    if "reverses_id" not in get_columns(cursor, "debt_history"):
+        cursor.execute("ALTER TABLE debt_history ADD COLUMN reverses_id INT NULL")
+    add_index(cursor, "debt_history", "debt_history_reverses", "reverses_id")
+    build_event_store(cursor)
+
+
+def create_event_store_sqlite(cursor):
+    if "reverses_id" not in get_columns_sqlite(cursor, "debt_history"):
+        cursor.execute("ALTER TABLE debt_history ADD COLUMN reverses_id INTEGER NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debt_history_reverses ON debt_history (reverses_id)")
+    build_event_store(cursor)
+
+
+def build_event_store(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pair_balances (
+        guild_id BIGINT NOT NULL,
+        player_id BIGINT NOT NULL,
+        counterparty_id BIGINT NOT NULL,
+        amount DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, player_id, counterparty_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pair_checkpoint (
+        guild_id BIGINT NOT NULL DEFAULT 0,
+        checkpoint_id INT NOT NULL,
+        player_id BIGINT NOT NULL,
+        counterparty_id BIGINT NOT NULL,
+        amount DECIMAL(12, 2) NOT NULL,
+        PRIMARY KEY (checkpoint_id, player_id, counterparty_id)
+    )
+    """)
+    for event_type, time_column in (("session_start", "session_start"), ("session_end", "session_end")):
+        cursor.execute(f"""
+        INSERT INTO debt_history (guild_id, debt_type, recipient_id, payer_id, amount, date, session_id)
+        SELECT s.guild_id, '{event_type}', s.bank_id, s.bank_id, 0, s.{time_column}, s.session_id
+        FROM sessions s
+        WHERE s.{time_column} IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM debt_history e
+                          WHERE e.session_id = s.session_id AND e.debt_type = '{event_type}')
+        ORDER BY s.session_id
+        """)
+    cursor.execute("DELETE FROM pair_balances")
+    cursor.execute("""
+    INSERT INTO pair_balances (guild_id, player_id, counterparty_id, amount)
+    SELECT guild_id, player_id, counterparty_id, SUM(amount)
+    FROM (SELECT guild_id, recipient_id AS player_id, payer_id AS counterparty_id, amount FROM debt_history
+          WHERE recipient_id <> payer_id
+          UNION ALL
+          SELECT guild_id, payer_id, recipient_id, -amount FROM debt_history
+          WHERE recipient_id <> payer_id) pairs
+    GROUP BY guild_id, player_id, counterparty_id
+    HAVING SUM(amount) <> 0
+    """)
+    cursor.execute("DELETE FROM player_checkpoint")
+    cursor.execute("DELETE FROM balance_checkpoint")
+
+
+# Version 8: SQLite stores money as whole cents (see storage.py) instead of binary floats, which left balances and
+#   pair totals off by fractions of a cent. Every amount is rounded to the cent on the way, which also clears the drift
+#   already there. It's one transaction, so it's never applied halfway.
+MONEY_COLUMNS = (("debt_history", "amount"), ("player_data", "balance"), ("player_data", "net_gain"),
+                 ("player_checkpoint", "balance"), ("player_checkpoint", "net_gain"), ("pair_balances", "amount"),
+                 ("pair_checkpoint", "amount"))
+
+
+def money_to_cents_sqlite(cursor):
+    for table_name, column in MONEY_COLUMNS:
+        cursor.execute(f"UPDATE {table_name} SET {column} = CAST(ROUND({column} * 100) AS INTEGER)")
+    # pairs the drift kept from settling at exactly 0
+    cursor.execute("DELETE FROM pair_balances WHERE amount = 0")
+    cursor.execute("DELETE FROM pair_checkpoint WHERE amount = 0")
+
+
+# (version, description, {dialect: function taking a cursor}), in the order they must be applied
+MIGRATIONS = [
+    (1, "create tables", {"mysql": create_tables_mysql, "sqlite": create_tables_sqlite}),
+    (2, "keys, indexes and exact money types for existing tables", {"mysql": upgrade_legacy_tables}),
+    (3, "one row per session", {"mysql": create_sessions_mysql, "sqlite": create_sessions_sqlite}),
+    (4, "session_id on debt_history", {"mysql": add_debt_session_mysql, "sqlite": add_debt_session_sqlite}),
+    (5, "write-behind journal state", {"mysql": create_journal_state, "sqlite": create_journal_state}),
+    (6, "guild_id on every table", {"mysql": add_guild_keys_mysql, "sqlite": add_guild_keys_sqlite}),
+    (7, "debt_history as an event log, pair_balances", {"mysql": create_event_store_mysql,
+                                                        "sqlite": create_event_store_sqlite}),
+    (8, "money as whole cents on SQLite", {"sqlite": money_to_cents_sqlite}),
+]
+
+
+def get_schema_version(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INT PRIMARY KEY,
+        description VARCHAR(100) NOT NULL,
+        applied DATETIME NOT NULL
+    )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+
+# Applies every migration newer than the database's schema version to 'backend' (see storage.py). Returns the list of
+#   versions applied.
+def migrate(backend):
+    with backend.connection() as connection:
+        return migrate_connection(connection, backend.dialect)
+
+
+def migrate_connection(connection, dialect):
+    cursor = connection.cursor()
+    current_version = get_schema_version(cursor)
+    connection.commit()
+    applied = []
+    for version, description, migrations in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info("Applying migration %s: %s", version, description)
+        query = "INSERT INTO schema_version (version, description, applied) VALUES (%s, %s, %s)"
+        if dialect == "sqlite":
+            query = query.replace("%s", "?")
+            cursor.execute("BEGIN")
+        try:
+            if dialect in migrations:
+                migrations[dialect](cursor)
+            cursor.execute(query, (version, description, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+# Hands every row recorded before guilds had their own ledgers (guild_id 0) to guild 'guild_id'. Run it once, on the
+#   shard that guild is routed to (see sharding.py), with the bot stopped. Returns the number of rows moved.
+# The guild may have used the bot already, as long as it recorded no debts or sessions (ValueError otherwise): its
+#   players are merged with the claimed ones (a player in both keeps the claimed row), its journal watermarks are
+#   kept (they count the entries of its own journal file, see write_behind.py), and the checkpoints of its empty
+#   ledger are dropped. All in one transaction.
+def claim_guild(backend, guild_id):
+    guild_id = int(guild_id)
+    placeholder = "?" if backend.dialect == "sqlite" else "%s"
+    with backend.connection() as connection:
+        cursor = connection.cursor()
+        try:
+            for table_name in ("debt_history", "sessions"):
+                cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE guild_id = {placeholder}", (guild_id,))
+                if cursor.fetchall()[0][0]:
+                    raise ValueError(f"Guild {guild_id} has {table_name} rows of its own already, only a guild that "
+                                     f"hasn't recorded any debts or sessions can claim the old ledger")
+            # the derived tables let MySQL delete from the table they read
+            cursor.execute(f"DELETE FROM player_data WHERE guild_id = {placeholder} AND player_id IN "
+                           f"(SELECT player_id FROM (SELECT player_id FROM player_data WHERE guild_id = 0) AS claimed)",
+                           (guild_id,))
+            cursor.execute(f"DELETE FROM journal_state WHERE guild_id = 0 AND journal_key IN "
+                           f"(SELECT journal_key FROM (SELECT journal_key FROM journal_state "
+                           f"WHERE guild_id = {placeholder}) AS own)", (guild_id,))
+            for table_name in ("pair_balances", "balance_checkpoint", "player_checkpoint", "pair_checkpoint"):
+                cursor.execute(f"DELETE FROM {table_name} WHERE guild_id = {placeholder}", (guild_id,))
+            row_count = 0
+            for table_name in GUILD_TABLES + ("pair_balances", "pair_checkpoint"):
+                cursor.execute(f"UPDATE {table_name} SET guild_id = {placeholder} WHERE guild_id = 0", (guild_id,))
+                row_count += max(cursor.rowcount, 0)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    return row_count
+
+
+# Creates MySQL database 'database_name' if it doesn't exist yet and migrates it. 'connection' is a server connection
+#   with no database selected, e.g. from storage.get_connection(). SQLite databases are created by just opening them.
+def make_database(connection, database_name):
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database_name}")
+    cursor.execute(f"USE {database_name}")
+    applied = migrate_connection(connection, "mysql")
+    logger.info("Database '%s' is up to date (%s migration(s) applied)", database_name, len(applied))
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from metrics import configure_logging
+    from storage import get_connection, make_backend, shard_database, DATABASE_NAME, STORAGE_BACKEND, SHARD_COUNT
+    parser = argparse.ArgumentParser(description="Create and migrate the database of every shard")
+    parser.add_argument("--claim-guild", type=int, help="give rows recorded before per-guild ledgers to this guild")
+    parser.add_argument("--shard", type=int, default=0, help="shard holding the claiming guild (default 0)")
+    args = parser.parse_args()
+    configure_logging()
+    for shard in range(SHARD_COUNT):
+        if STORAGE_BACKEND == "mysql":
+            server_connection = get_connection()
+            make_database(server_connection, shard_database(DATABASE_NAME, shard))
+            server_connection.close()
+        else:
+            sqlite_backend = make_backend(shard=shard)
+            logger.info("Shard %s is up to date (%s migration(s) applied)", shard, len(migrate(sqlite_backend)))
+            sqlite_backend.close()
+    if args.claim_guild is not None:
+        from write_behind import read_journal, JOURNAL_PATH
+        if read_journal(JOURNAL_PATH, 0):
+            sys.exit(f"ERROR: {JOURNAL_PATH} still holds debts for the old ledger. Start the bot once (or run "
+                     f"'python write_behind.py --replay-legacy 0') to write them to it, then claim it")
+        shard_backend = make_backend(shard=args.shard)
+        try:
+            logger.info("Moved %s row(s) to guild %s", claim_guild(shard_backend, args.claim_guild), args.claim_guild)
+        except ValueError as err:
+            sys.exit(f"ERROR: {err}")
+        finally:
+            shard_backend.close()
@@ -0,0 +1,225 @@
+# --- READ ME! ---:
+# This file holds the projections of the ledger's event log (debt_history, see events.py): tables kept in step with the
+# log, so reads never have to add up the whole history.
+#
+# for usage in file, write:
+# 'from projections import ProjectionDelta, BalanceProjection, PairProjection'
+#
+# PROJECTIONS:
+# BalanceProjection - player_data.balance and player_data.net_gain of every player
+# PairProjection - pair_balances: what every two players owe each other (Balances.get_counterparty_totals)
+# The leaderboard is a projection too, kept in memory by Balances (see leaderboard.py) from the same net_gain changes.
+#
+# Balances never writes a projection by hand. When events are appended, they're applied to a ProjectionDelta, and
+# every projection's update_queries(delta) run in the same transaction as the INSERT of the events, so the projections
+# are never behind the log. rebuild_queries(checkpoint) work a projection out again from the log: from
+# scratch, or from any checkpoint (a snapshot of every projection, saved by checkpoint_queries, and deleted by
+# prune_checkpoint_queries once it's no longer among the latest). Every projection rebuilds on its own, so
+# Balances.refresh_balances can run them in parallel.
+
+
+# ------------- FUNCTIONS -------------
+
+
+def add_to(changes, key, amount):
+    changes[key] = changes.get(key, 0) + amount
+
+
+# SQL condition for a debt_history row's amount counting towards net_gain: money moving the right way (payments are
+#   negative and never count), outside a session or in one whose session_end is in the log. It's worked out from the
+#   log itself, in the same statement, so a session ending mid-rebuild can't be counted twice or missed.
+def net_condition(guild_id):
+    return (f"amount >= 0 AND (session_id IS NULL OR session_id IN "
+            f"(SELECT session_id FROM debt_history WHERE guild_id = {guild_id} AND debt_type = 'session_end'))")
+
+
+# ------------- CLASSES -------------
+
+
+# class ProjectionDelta adds up what a run of events changes in the projections. Pass the sessions running before the
+#   first event: the net_gain changes of their events are held back until their session_end, as net_condition does.
+# Initialize: delta = ProjectionDelta(open_session_ids).apply(events)
+class ProjectionDelta:
+    def __init__(self, open_session_ids=()):
+        self.open_session_ids = set(open_session_ids)
+        # player_id -> amount
+        self.balance_changes = {}
+        self.net_changes = {}
+        # (player_id, counterparty_id) -> change in what counterparty_id owes player_id
+        self.pair_changes = {}
+        # session_id -> {player_id: amount}, net_gain changes waiting for the session to end
+        self.held_net_changes = {}
+
+    def apply(self, events):
+        for event in events:
+            event.apply(self)
+        return self
+
+    def move(self, recipient_id, payer_id, amount, session_id=None):
+        add_to(self.balance_changes, recipient_id, amount)
+        add_to(self.balance_changes, payer_id, -amount)
+        if recipient_id != payer_id:
+            add_to(self.pair_changes, (recipient_id, payer_id), amount)
+            add_to(self.pair_changes, (payer_id, recipient_id), -amount)
+        if amount >= 0:
+            if session_id is not None and session_id in self.open_session_ids:
+                net_changes = self.held_net_changes.setdefault(session_id, {})
+            else:
+                net_changes = self.net_changes
+            add_to(net_changes, recipient_id, amount)
+            add_to(net_changes, payer_id, -amount)
+
+    def start_session(self, session_id):
+        self.open_session_ids.add(session_id)
+
+    def end_session(self, session_id):
+        self.open_session_ids.discard(session_id)
+        for player_id, amount in self.held_net_changes.pop(session_id, {}).items():
+            add_to(self.net_changes, player_id, amount)
+
+    # Holds 'net_changes' ({player_id: amount}) back for running session 'session_id', as if its events had been
+    #   applied here. Used to end a session whose events were applied earlier (see SessionLedger).
+    def hold(self, session_id, net_changes):
+        self.open_session_ids.add(session_id)
+        for player_id, amount in net_changes.items():
+            add_to(self.held_net_changes.setdefault(session_id, {}), player_id, amount)
+
+
+# class BalanceProjection keeps player_data.balance and player_data.net_gain of one guild.
+# Initialize: projection = BalanceProjection(backend, guild_id)
+class BalanceProjection:
+    name = "balances"
+
+    def __init__(self, backend, guild_id):
+        self.backend = backend
+        self.guild_id = guild_id
+
+    # One relative UPDATE (balance = balance + change) of every player 'delta' changes, so concurrent transactions
+    #   can't overwrite each other's changes. Returns a list of (SQL string, params) tuples.
+    def update_queries(self, delta):
+        balance_changes = {player_id: amount for player_id, amount in delta.balance_changes.items() if amount}
+        net_changes = {player_id: amount for player_id, amount in delta.net_changes.items() if amount}
+        player_ids = list(balance_changes)
+        player_ids += [player_id for player_id in net_changes if player_id not in balance_changes]
+        if not player_ids:
+            return []
+        case = " ".join(["WHEN %s THEN %s"] * len(player_ids))
+        update_query = (f"UPDATE player_data "
+                        f"SET balance = COALESCE(balance, 0) + CASE player_id {case} ELSE 0 END, "
+                        f"net_gain = COALESCE(net_gain, 0) + CASE player_id {case} ELSE 0 END "
+                        f"WHERE guild_id = %s AND player_id IN ({', '.join(['%s'] * len(player_ids))})")
+        store_money = self.backend.store_money
+        update_params = ([value for player_id in player_ids
+                          for value in (player_id, store_money(balance_changes.get(player_id, 0)))]
+                         + [value for player_id in player_ids
+                            for value in (player_id, store_money(net_changes.get(player_id, 0)))]
+                         + [self.guild_id] + player_ids)
+        return [(update_query, update_params)]
+
+    # Subquery giving, per player_id, the balance_change and net_change of every event after 'after_debt_id'.
+    def __changes_query(self, after_debt_id):
+        condition = net_condition(self.guild_id)
+        event_filter = f"guild_id = {self.guild_id} AND debt_id > {after_debt_id}"
+        return f"""
+            SELECT player_id, SUM(balance_change) AS balance_change, SUM(net_change) AS net_change
+            FROM (
+                SELECT recipient_id AS player_id, amount AS balance_change,
+                       CASE WHEN {condition} THEN amount ELSE 0 END AS net_change
+                FROM debt_history
+                WHERE {event_filter}
+                UNION ALL
+                SELECT payer_id AS player_id, -amount AS balance_change,
+                       CASE WHEN {condition} THEN -amount ELSE 0 END AS net_change
+                FROM debt_history
+                WHERE {event_filter}
+            ) AS changes
+            GROUP BY player_id
+        """
+
+    # Starts every player from 'checkpoint' ((checkpoint_id, last_debt_id), or None for 0), then adds up every event
+    #   after it. Events are read when the queries run, so one appended meanwhile is never lost.
+    def rebuild_queries(self, checkpoint):
+        if checkpoint:
+            checkpoint_id, after_debt_id = checkpoint
+            reset_query = f"""
+            UPDATE player_data
+            SET balance = COALESCE((SELECT c.balance FROM player_checkpoint c
+                                    WHERE c.checkpoint_id = {checkpoint_id}
+                                      AND c.player_id = player_data.player_id), 0),
+                net_gain = COALESCE((SELECT c.net_gain FROM player_checkpoint c
+                                     WHERE c.checkpoint_id = {checkpoint_id}
+                                       AND c.player_id = player_data.player_id), 0)
+            WHERE guild_id = {self.guild_id}
+            """
+        else:
+            after_debt_id = 0
+            reset_query = f"""
+            UPDATE player_data
+            SET balance = 0, net_gain = 0
+            WHERE guild_id = {self.guild_id}
+            """
+        rebuild_query = self.backend.update_from(
+            "player_data", self.__changes_query(after_debt_id), "totals", "player_id",
+            "balance = balance + totals.balance_change, net_gain = net_gain + totals.net_change",
+            f"player_data.guild_id = {self.guild_id}")
+        return [reset_query, rebuild_query]
+
+    # 'checkpoint_id' is an SQL expression for the id of the checkpoint being saved.
+    def checkpoint_queries(self, checkpoint_id):
+        return [f"INSERT INTO player_checkpoint (guild_id, checkpoint_id, player_id, balance, net_gain) "
+                f"SELECT guild_id, {checkpoint_id}, player_id, balance, net_gain FROM player_data "
+                f"WHERE guild_id = {self.guild_id}"]
+
+    # 'oldest_kept' is an SQL expression for the id of the oldest checkpoint to keep.
+    def prune_checkpoint_queries(self, oldest_kept):
+        return [f"DELETE FROM player_checkpoint WHERE guild_id = {self.guild_id} AND checkpoint_id < {oldest_kept}"]
+
+
+# class PairProjection keeps pair_balances of one guild: for every two players who have had debts, the amount the
+#   counterparty owes the player (negative: owed by the player), stored once from each side.
+# Initialize: projection = PairProjection(backend, guild_id)
+class PairProjection:
+    name = "pairs"
+
+    def __init__(self, backend, guild_id):
+        self.backend = backend
+        self.guild_id = guild_id
+
+    # One INSERT adding every changed pair onto its row, or creating it.
+    def update_queries(self, delta):
+        pair_changes = [(pair, amount) for pair, amount in delta.pair_changes.items() if amount]
+        if not pair_changes:
+            return []
+        query = self.backend.insert_or_add("pair_balances", ("guild_id", "player_id", "counterparty_id", "amount"),
+                                           ("guild_id", "player_id", "counterparty_id"), ("amount",),
+                                           len(pair_changes))
+        params = [value for (player_id, counterparty_id), amount in pair_changes
+                  for value in (self.guild_id, player_id, counterparty_id, self.backend.store_money(amount))]
+        return [(query, params)]
+
+    def rebuild_queries(self, checkpoint):
+        checkpoint_id, after_debt_id = checkpoint or (None, 0)
+        event_filter = f"guild_id = {self.guild_id} AND debt_id > {after_debt_id} AND recipient_id <> payer_id"
+        from_checkpoint = (f"SELECT player_id, counterparty_id, amount FROM pair_checkpoint "
+                           f"WHERE checkpoint_id = {checkpoint_id} UNION ALL " if checkpoint else "")
+        return [f"DELETE FROM pair_balances WHERE guild_id = {self.guild_id}",
+                f"""
+                INSERT INTO pair_balances (guild_id, player_id, counterparty_id, amount)
+                SELECT {self.guild_id}, player_id, counterparty_id, SUM(amount)
+                FROM ({from_checkpoint}
+                      SELECT recipient_id AS player_id, payer_id AS counterparty_id, amount FROM debt_history
+                      WHERE {event_filter}
+                      UNION ALL
+                      SELECT payer_id, recipient_id, -amount FROM debt_history
+                      WHERE {event_filter}) AS pairs
+                GROUP BY player_id, counterparty_id
+                HAVING SUM(amount) <> 0
+                """]
+
+    def checkpoint_queries(self, checkpoint_id):
+        return [f"INSERT INTO pair_checkpoint (guild_id, checkpoint_id, player_id, counterparty_id, amount) "
+                f"SELECT guild_id, {checkpoint_id}, player_id, counterparty_id, amount FROM pair_balances "
+                f"WHERE guild_id = {self.guild_id} AND amount <> 0"]
+
+    def prune_checkpoint_queries(self, oldest_kept):
+        return [f"DELETE FROM pair_checkpoint WHERE guild_id = {self.guild_id} AND checkpoint_id < {oldest_kept}"]
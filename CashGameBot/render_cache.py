@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from metrics import registry
+
+# --- READ ME! ---:
+# This file holds the cache of the bot's rendered messages (leaderboard and debt tables), and splits long tables into
+# pages that fit in a discord message.
+#
+# for usage in file, write:
+# 'from render_cache import RenderCache, paginate'
+#
+# cache = RenderCache()
+# pages = cache.get(key, balances.version)          # None if missing, or rendered under another version
+# cache.put(key, balances.version, pages)
+#
+# Entries are keyed on anything hashable (the bot uses (guild_id, command, ...)) and stamped with the ledger version
+# they were rendered from (Balances.version, see balances.py). Once the ledger changes, its version goes up and the old
+# entry is a miss, so nothing stale is ever served and nothing needs invalidating by hand. Read the version BEFORE
+# reading the ledger to render: if a write lands in between, the entry is stamped with the older version and simply
+# missed next time. At most MAX_ENTRIES entries are kept, least recently used dropped first.
+#
+# paginate(rows, render) renders 'rows' in pages of up to PAGE_ROWS rows, splitting any page whose message would be
+# longer than MESSAGE_LIMIT characters.
+
+
+# ------------- CONSTANTS -------------
+
+
+# discord's limit on the length of a message
+MESSAGE_LIMIT = 2000
+PAGE_ROWS = 20
+MAX_ENTRIES = 1024
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Splits 'rows' into pages and returns each one rendered by 'render' (a function of a list of rows returning a string).
+#   A page whose rendering is over 'limit' characters is halved until it fits, or is down to one row. Always returns
+#   at least one page, with no rows if 'rows' is empty.
+def paginate(rows, render, rows_per_page=PAGE_ROWS, limit=MESSAGE_LIMIT):
+    pages = []
+    # pages still to render, next one last
+    chunks = [rows[start:start + rows_per_page] for start in range(0, len(rows), rows_per_page)] or [[]]
+    chunks.reverse()
+    while chunks:
+        chunk = chunks.pop()
+        page = render(chunk)
+        if len(page) > limit and len(chunk) > 1:
+            half = len(chunk) // 2
+            chunks.append(chunk[half:])
+            chunks.append(chunk[:half])
+            continue
+        pages.append(page)
+    return pages
+
+
+# ------------- CLASSES -------------
+
+
+# class RenderCache keeps rendered output, each entry stamped with the ledger version it was rendered from.
+#   Thread-safe.
+# Initialize: cache = RenderCache() or RenderCache(max_entries)
+class RenderCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (version, value), least recently used first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the value cached under 'key' if it was rendered from ledger version 'version', None otherwise.
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == version
+            if hit:
+                self.entries.move_to_end(key)
+        registry.cache("render", hit)
+        return entry[1] if hit else None
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
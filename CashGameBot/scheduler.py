@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import deque
+from metrics import registry
+
+# --- READ ME! ---:
+# This file schedules the bot's commands so that concurrent commands can't interleave their changes to a ledger.
+#
+# for usage in file, write:
+# 'from scheduler import CommandScheduler, QueueFull, READ, WRITE'
+#
+# scheduler = CommandScheduler()
+# async with scheduler.slot(guild_id, WRITE):     # or READ. Raises QueueFull if too many commands are waiting
+#     ...
+#
+# discord.py runs command handlers at the same time, and a command is many awaits long (player lookups, then the
+# write, then the replies), so two commands on the same ledger could otherwise interleave, e.g. a cash-out landing in
+# the middle of a 'session end'. Every key (the bot uses the guild id: every session of a guild shares its ledger, its
+# balances and its leaderboard) gets a read-write lock run in arrival order:
+# WRITE commands run one at a time, with nothing else running on the key
+# READ commands run alongside each other, but never during a write, so they see the ledger as a consistent snapshot
+#     between two writes
+# Waiting commands are served first come, first served: a read arriving after a queued write waits for it (so it sees
+# its result), and a stream of reads can't hold a write back forever.
+#
+# At most MAX_QUEUE_DEPTH commands (env var CASHGAMEBOT_MAX_QUEUE_DEPTH) wait per key. Past that, slot raises
+# QueueFull right away, and the bot tells the user to try again, so a burst can't pile up unbounded work and latency.
+# Only the event loop's thread may use a CommandScheduler (it's not thread-safe, and doesn't need to be).
+
+
+# ------------- CONSTANTS -------------
+
+
+READ = "read"
+WRITE = "write"
+MAX_QUEUE_DEPTH = int(os.environ.get("CASHGAMEBOT_MAX_QUEUE_DEPTH", "20"))
+
+
+# ------------- CLASSES -------------
+
+
+# class QueueFull is raised by CommandScheduler.slot when 'waiting' commands are already queued for the key.
+# Initialize: raise QueueFull(waiting)
+class QueueFull(Exception):
+    def __init__(self, waiting):
+        super().__init__(f"{waiting} commands are already waiting")
+        self.waiting = waiting
+
+
+# class CommandLane is the read-write lock of one key: what's running on it, and what's waiting, oldest first.
+# Initialize: lane = CommandLane()
+class CommandLane:
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        # (mode, future) of every waiting command, resolved when it may run
+        self.waiting = deque()
+
+    def can_run(self, mode):
+        if mode == WRITE:
+            return not self.writing and not self.readers
+        return not self.writing
+
+    def start(self, mode):
+        if mode == WRITE:
+            self.writing = True
+        else:
+            self.readers += 1
+
+    def finish(self, mode):
+        if mode == WRITE:
+            self.writing = False
+        else:
+            self.readers -= 1
+
+    # Lets waiting commands run, in order, for as long as the oldest one can.
+    def wake(self):
+        while self.waiting:
+            mode, future = self.waiting[0]
+            if not self.can_run(mode):
+                return
+            self.waiting.popleft()
+            self.start(mode)
+            future.set_result(None)
+
+    def is_idle(self):
+        return not self.readers and not self.writing and not self.waiting
+
+
+# class CommandScheduler keeps a CommandLane for every key with commands running or waiting.
+# Initialize: scheduler = CommandScheduler() or CommandScheduler(max_queue_depth)
+class CommandScheduler:
+    def __init__(self, max_queue_depth=MAX_QUEUE_DEPTH):
+        self.max_queue_depth = max_queue_depth
+        # key -> CommandLane, dropped once idle
+        self.lanes = {}
+
+    # Returns how many commands are waiting on 'key' (not counting the ones running).
+    def queue_depth(self, key):
+        lane = self.lanes.get(key)
+        return len(lane.waiting) if lane else 0
+
+    # Waits until a command of 'mode' may run on 'key', then holds its place until the block exits. Raises QueueFull
+    #   without waiting if max_queue_depth commands are already waiting.
+    @contextlib.asynccontextmanager
+    async def slot(self, key, mode):
+        await self.__acquire(key, mode)
+        try:
+            yield
+        finally:
+            self.__release(key, mode)
+
+    async def __acquire(self, key, mode):
+        lane = self.lanes.setdefault(key, CommandLane())
+        if not lane.waiting and lane.can_run(mode):
+            lane.start(mode)
+            registry.observe("command_wait_seconds", 0, mode=mode)
+            return
+        if len(lane.waiting) >= self.max_queue_depth:
+            registry.inc("commands_rejected_total", mode=mode)
+            raise QueueFull(len(lane.waiting))
+        start_time = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        lane.waiting.append((mode, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # it was let in just as it was cancelled
+                self.__release(key, mode)
+            else:
+                # a write leaving the head of the queue may let the reads behind it in
+                lane.waiting.remove((mode, future))
+                lane.wake()
+                self.__drop_if_idle(key, lane)
+            raise
+        registry.observe("command_wait_seconds", time.perf_counter() - start_time, mode=mode)
+
+    def __release(self, key, mode):
+        lane = self.lanes[key]
+        lane.finish(mode)
+        lane.wake()
+        self.__drop_if_idle(key, lane)
+
+    def __drop_if_idle(self, key, lane):
+        if lane.is_idle() and self.lanes.get(key) is lane:
+            del self.lanes[key]
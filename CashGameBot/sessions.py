@@ -0,0 +1,132 @@
+import threading
+from collections import namedtuple
+from decimal import Decimal
+
+# --- READ ME! ---:
+# This file keeps the state of every running session in memory, so checking whether a session is running doesn't need
+# a database round trip.
+#
+# for usage in file, write:
+# 'from sessions import Session, SessionState, SessionLedger'
+#
+# Sessions are kept per table: a table_key is any string naming where the game is played (the bot uses the discord
+# channel id), so several tables can run a session at the same time. DEFAULT_TABLE is used when no key is given.
+#
+# Balances owns a SessionState: it's loaded from the sessions table once at startup, then updated by
+# Balances.start_session and Balances.end_session, the only places sessions change.
+#
+# Every running session also has a SessionLedger: the running totals of its buy-ins and cash-outs, updated by
+# Balances.add_debts as they're recorded, and by Balances.void_debt as they're voided. It answers 'lb session status'
+# without touching the database, and holds the net_gain change of every player at the table, which
+# Balances.end_session commits in one go.
+
+
+# ------------- CONSTANTS -------------
+
+
+DEFAULT_TABLE = "main"
+
+
+# ------------- CLASSES -------------
+
+
+# class Session holds a running session's session_id, table_key, bank_id (the banker's player id) and start time.
+# Initialize: session = Session(session_id, table_key, bank_id, start)
+class Session(namedtuple("Session", ["session_id", "table_key", "bank_id", "start"])):
+    __slots__ = ()
+
+
+# class SessionLedger keeps the running totals of one session: what each player bought in for and cashed out, the chips
+#   still in play, and the net_gain change every debt of the session makes. Amounts are Decimals. Thread-safe.
+# Initialize: ledger = SessionLedger()
+class SessionLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buyins = {}
+        self.cashouts = {}
+        self.net_changes = {}
+
+    # Adds one debt of the session, the same way Balances.add_debts would count it towards net_gain.
+    def apply(self, debt_type, recipient_id, payer_id, amount):
+        with self.lock:
+            if debt_type == "buyin":
+                self.buyins[payer_id] = self.buyins.get(payer_id, 0) + amount
+            elif debt_type == "cashout":
+                self.cashouts[recipient_id] = self.cashouts.get(recipient_id, 0) + amount
+            if amount >= 0:
+                self.net_changes[recipient_id] = self.net_changes.get(recipient_id, 0) + amount
+                self.net_changes[payer_id] = self.net_changes.get(payer_id, 0) - amount
+
+    # Takes one debt of the session back out, as its reversal does (see Balances.void_debt).
+    def reverse(self, debt_type, recipient_id, payer_id, amount):
+        with self.lock:
+            if debt_type == "buyin":
+                self.buyins[payer_id] = self.buyins.get(payer_id, 0) - amount
+            elif debt_type == "cashout":
+                self.cashouts[recipient_id] = self.cashouts.get(recipient_id, 0) - amount
+            if amount >= 0:
+                self.net_changes[recipient_id] = self.net_changes.get(recipient_id, 0) - amount
+                self.net_changes[payer_id] = self.net_changes.get(payer_id, 0) + amount
+
+    # Money bought in that hasn't been cashed out yet.
+    def chips_in_play(self):
+        with self.lock:
+            return Decimal(sum(self.buyins.values())) - Decimal(sum(self.cashouts.values()))
+
+    # Returns {player_id: net_gain change} for everyone the session's debts involve, banker included.
+    def get_net_changes(self):
+        with self.lock:
+            return {player_id: change for player_id, change in self.net_changes.items() if change}
+
+    # Returns [player_id, bought_in, cashed_out, result] for every player who bought in or cashed out, best result
+    #   first.
+    def rows(self):
+        with self.lock:
+            # players whose every buy-in and cash-out was voided are left out
+            player_ids = {player_id for player_id in set(self.buyins) | set(self.cashouts)
+                          if self.buyins.get(player_id) or self.cashouts.get(player_id)}
+            rows = [[player_id, Decimal(self.buyins.get(player_id, 0)), Decimal(self.cashouts.get(player_id, 0))]
+                    for player_id in player_ids]
+        for row in rows:
+            row.append(row[2] - row[1])
+        rows.sort(key=lambda row: (-row[3], row[0]))
+        return rows
+
+
+# class SessionState maps table keys to the session running at that table, and to that session's SessionLedger.
+#   Thread-safe.
+# Initialize: session_state = SessionState()
+class SessionState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_table = {}
+        self.ledgers = {}
+
+    def load(self, sessions):
+        with self.lock:
+            self.by_table = {session.table_key: session for session in sessions}
+            self.ledgers = {session.table_key: SessionLedger() for session in sessions}
+
+    def get(self, table_key=DEFAULT_TABLE):
+        return self.by_table.get(table_key)
+
+    def get_ledger(self, table_key=DEFAULT_TABLE):
+        return self.ledgers.get(table_key)
+
+    def active(self):
+        return list(self.by_table.values())
+
+    # Adds 'session' (with a new SessionLedger, or 'ledger' if given) unless its table already has one running.
+    #   Returns True if it was added.
+    def start(self, session, ledger=None):
+        with self.lock:
+            if session.table_key in self.by_table:
+                return False
+            self.by_table[session.table_key] = session
+            self.ledgers[session.table_key] = ledger or SessionLedger()
+            return True
+
+    # Removes the session running at 'table_key' and returns (session, ledger), or (None, None).
+    def end(self, table_key=DEFAULT_TABLE):
+        with self.lock:
+            return self.by_table.pop(table_key, None), self.ledgers.pop(table_key, None)
@@ -0,0 +1,123 @@
+import heapq
+from decimal import Decimal
+
+# --- READ ME! ---:
+# This file works out a short list of payments that clears every player's balance.
+#
+# for usage in file, write:
+# 'from settlement import settle'
+#
+# settle(balances) takes {player_id: balance} (positive: owed to the player, negative: owed by the player, the same
+# sign as player_data.balance) and returns a list of (payer_id, recipient_id, amount) payments. Once every payment is
+# made, every balance is 0. Amounts are Decimals rounded to the cent.
+#
+# STRATEGIES:
+# settle_greedy(balances) repeatedly has the biggest debtor pay the biggest creditor. It runs in O(n log n) and needs at
+#     most n - 1 payments, so it handles hundreds of players instantly. This is the default.
+# settle_exact(balances) finds the fewest payments possible, by splitting players into as many groups that sum to zero
+#     as it can (each group of k players then settles in k - 1 payments). It takes O(2^n * n) time, so it only accepts
+#     up to EXACT_MAX_PLAYERS players with non-zero balances.
+# settle(balances, exact=True) uses settle_exact when there are few enough players, and settle_greedy otherwise.
+#
+# bench_settlement.py compares the two strategies on synthetic ledgers.
+
+
+# ------------- CONSTANTS -------------
+
+
+EXACT_MAX_PLAYERS = 14
+
+
+# ------------- FUNCTIONS -------------
+
+
+def to_cents(amount):
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1)))
+
+
+def from_cents(cents):
+    return Decimal(cents) / 100
+
+
+# Converts {player_id: balance} to {player_id: cents}, dropping settled players. Raises ValueError if the balances don't
+#   add up to zero, since no set of payments could clear them.
+def __balances_to_cents(balances):
+    cents = {player_id: to_cents(balance) for player_id, balance in balances.items()}
+    cents = {player_id: amount for player_id, amount in cents.items() if amount != 0}
+    total = sum(cents.values())
+    if total != 0:
+        raise ValueError(f"Balances add up to {from_cents(total)} instead of 0, they can't be settled")
+    return cents
+
+
+def __settle_cents_greedy(cents):
+    creditors = [(-amount, player_id) for player_id, amount in cents.items() if amount > 0]
+    debtors = [(amount, player_id) for player_id, amount in cents.items() if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    payments = []
+    while creditors and debtors:
+        credit, recipient_id = heapq.heappop(creditors)
+        debit, payer_id = heapq.heappop(debtors)
+        amount = min(-credit, -debit)
+        payments.append((payer_id, recipient_id, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, recipient_id))
+        if -debit > amount:
+            heapq.heappush(debtors, (debit + amount, payer_id))
+    return payments
+
+
+def settle_greedy(balances):
+    payments = __settle_cents_greedy(__balances_to_cents(balances))
+    return [(payer_id, recipient_id, from_cents(amount)) for payer_id, recipient_id, amount in payments]
+
+
+def settle_exact(balances):
+    cents = __balances_to_cents(balances)
+    player_ids = list(cents)
+    amounts = [cents[player_id] for player_id in player_ids]
+    n = len(player_ids)
+    if n > EXACT_MAX_PLAYERS:
+        raise ValueError(f"settle_exact supports at most {EXACT_MAX_PLAYERS} players with non-zero balances, got {n}")
+    full = (1 << n) - 1
+    # sums[mask]: total balance of the players in 'mask'
+    sums = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + amounts[low.bit_length() - 1]
+    # groups[mask]: most zero-sum groups the players in 'mask' can be split into
+    groups = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        best = 0
+        remaining = mask
+        while remaining:
+            low = remaining & -remaining
+            best = max(best, groups[mask ^ low])
+            remaining ^= low
+        groups[mask] = best + (sums[mask] == 0)
+    # walk back down from the full set, cutting a group off every time the players left sum to zero
+    payments = []
+    mask = full
+    group_start = full
+    while mask:
+        is_zero = sums[mask] == 0
+        remaining = mask
+        while remaining:
+            low = remaining & -remaining
+            if groups[mask ^ low] == groups[mask] - is_zero:
+                break
+            remaining ^= low
+        mask ^= low
+        if sums[mask] == 0:
+            group = group_start ^ mask
+            group_cents = {player_ids[i]: amounts[i] for i in range(n) if group >> i & 1}
+            payments.extend(__settle_cents_greedy(group_cents))
+            group_start = mask
+    return [(payer_id, recipient_id, from_cents(amount)) for payer_id, recipient_id, amount in payments]
+
+
+def settle(balances, exact=False):
+    if exact and sum(1 for balance in balances.values() if to_cents(balance) != 0) <= EXACT_MAX_PLAYERS:
+        return settle_exact(balances)
+    return settle_greedy(balances)
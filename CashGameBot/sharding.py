@@ -0,0 +1,103 @@
+import os
+import threading
+from balances import Balances
+from storage import make_backend, SHARD_COUNT, POOL_SIZE
+
+# --- READ ME! ---:
+# This file routes every discord guild to its own ledger, on the database shard that guild lives on.
+#
+# for usage in file, write:
+# 'from sharding import LedgerRouter'
+#
+# ledgers = LedgerRouter()
+# balances = ledgers.get(guild_id)    # the guild's Balances, created (and its shard opened) on first use
+#
+# Guilds are spread over SHARD_COUNT databases (see storage.py) by guild_id % SHARD_COUNT, unless GUILD_SHARDS (env var
+# CASHGAMEBOT_GUILD_SHARDS, e.g. '1234:0,5678:2') pins a guild to a shard. Pin a very busy guild to a shard of its own
+# to keep it from slowing the others down, and pin the guild that claimed the pre-sharding ledger (see migrations.py)
+# to shard 0, where that data is.
+# Changing the shard count moves guilds between shards: pin the guilds already in use to their current shard first.
+#
+# Guilds on the same shard share its backend and connection pool. Each guild gets its own Balances, so session state
+# and the leaderboard cache are per guild too. Pass wrap=... to wrap every new Balances, e.g. in a WriteBehindBalances.
+
+
+# ------------- CONSTANTS -------------
+
+
+GUILD_SHARDS = os.environ.get("CASHGAMEBOT_GUILD_SHARDS", "")
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Parses 'guild_id:shard' pairs separated by commas into {guild_id: shard}.
+def parse_guild_shards(spec):
+    pinned = {}
+    for pair in spec.split(","):
+        if pair.strip():
+            guild_id, shard = pair.split(":")
+            pinned[int(guild_id)] = int(shard)
+    return pinned
+
+
+# ------------- CLASSES -------------
+
+
+# class LedgerRouter hands out one Balances per guild, each on its guild's shard. Thread-safe.
+# Initialize: ledgers = LedgerRouter() or LedgerRouter(shard_count, pinned, wrap, backend_factory)
+class LedgerRouter:
+    def __init__(self, shard_count=SHARD_COUNT, pinned=None, wrap=None, backend_factory=None, pool_size=POOL_SIZE):
+        self.shard_count = max(1, shard_count)
+        self.pinned = parse_guild_shards(GUILD_SHARDS) if pinned is None else pinned
+        for guild_id, shard in self.pinned.items():
+            if not 0 <= shard < self.shard_count:
+                raise ValueError(f"Guild {guild_id} is pinned to shard {shard}, but there are {self.shard_count}")
+        self.wrap = wrap
+        # shard -> backend, called as backend_factory(shard)
+        self.backend_factory = backend_factory or (lambda shard: make_backend(pool_size=pool_size, shard=shard))
+        self.lock = threading.Lock()
+        self.backends = {}
+        self.ledgers = {}
+
+    def shard_of(self, guild_id):
+        guild_id = int(guild_id)
+        return self.pinned.get(guild_id, guild_id % self.shard_count)
+
+    def get_backend(self, shard):
+        with self.lock:
+            backend = self.backends.get(shard)
+            if backend is None:
+                backend = self.backends[shard] = self.backend_factory(shard)
+            return backend
+
+    # Returns the Balances of guild 'guild_id'. The first call for a guild loads its session state, so it touches the
+    #   database; later calls don't.
+    def get(self, guild_id):
+        guild_id = int(guild_id)
+        ledger = self.ledgers.get(guild_id)
+        if ledger is not None:
+            return ledger
+        backend = self.get_backend(self.shard_of(guild_id))
+        with self.lock:
+            ledger = self.ledgers.get(guild_id)
+            if ledger is None:
+                ledger = Balances(backend=backend, guild_id=guild_id)
+                if self.wrap:
+                    ledger = self.wrap(ledger)
+                self.ledgers[guild_id] = ledger
+            return ledger
+
+    def all(self):
+        return list(self.ledgers.values())
+
+    def close(self):
+        with self.lock:
+            for ledger in self.ledgers.values():
+                # a plain Balances has nothing to close; wrappers like WriteBehindBalances do
+                if hasattr(type(ledger), "close"):
+                    ledger.close()
+            for backend in self.backends.values():
+                backend.close()
+            self.ledgers = {}
+            self.backends = {}
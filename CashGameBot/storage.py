@@ -0,0 +1,230 @@
+import os
+import sqlite3
+import threading
+import logging
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+
+# --- READ ME! ---:
+# This file holds the storage backends Balances can run on.
+#
+# for usage in file, write:
+# 'from storage import make_backend'
+#
+# backend = make_backend()    # picks the backend from STORAGE_BACKEND (env var CASHGAMEBOT_BACKEND)
+# balances = Balances(backend=backend)
+#
+# The ledger can be split over SHARD_COUNT databases (env var CASHGAMEBOT_DB_SHARDS), each holding whole guilds (see
+# sharding.py). make_backend(shard=n) opens shard n: shard 0 is the usual database, shard n is the database (or SQLite
+# file) named with a '_<n>' suffix.
+#
+# BACKENDS:
+# MySQLBackend - the local MySQL server, through a ConnectionPool (see connection_pool.py). Needs mysql-connector and a
+#     'sql_password.py' file defining PASS = <server_password>. Do not commit that file to repo.
+# SQLiteBackend - an embedded SQLite database file in WAL mode, for small deployments, tests and benchmarks. Needs no
+#     server and no extra packages. Use the path ':memory:' for a throwaway database shared by every thread.
+#     SQLite has no exact decimal type (a DECIMAL column holds binary floats, which drift by fractions of a cent as
+#     they're added up), so money is stored as whole cents in INTEGER values, and converted at the backend boundary by
+#     store_money and load_money. Sums and comparisons in SQL stay exact.
+#
+# Every backend provides:
+# backend.connection() - context manager giving a DB-API connection. Any transaction still open when the block exits
+#     is rolled back.
+# backend.sql(query) - converts a query written with '%s' placeholders to the backend's placeholder style
+# backend.update_from(table, subquery, alias, key, assignments, where) - SQL for an UPDATE of 'table' joined to
+#     'subquery' on column 'key', limited to the rows matching 'where' if given. MySQL and SQLite spell this
+#     differently.
+# backend.last_insert_id(table, column) - SQL expression for the id the last INSERT into 'table' generated in
+#     'column', on the same connection. Safe to use inside an INSERT ... SELECT.
+# backend.insert_or_add(table, columns, keys, added, row_count) - SQL inserting 'row_count' rows of 'columns' (as '%s'
+#     placeholders) into 'table', adding the 'added' columns onto the existing row instead where 'keys' already exist
+# backend.seconds_between(start, end) - SQL expression for the whole seconds from DATETIME expression 'start' to 'end'
+# backend.store_money(amount) - the value to pass as a query parameter for money 'amount' (a Decimal)
+# backend.load_money(value) - the Decimal amount of a money column (or a sum of money columns) read back
+# backend.Error - exception class(es) raised by the driver
+# backend.dialect - "mysql" or "sqlite", for the few places (like migrations.py) that still need to know
+
+
+# ------------- CONSTANTS -------------
+
+
+STORAGE_BACKEND = os.environ.get("CASHGAMEBOT_BACKEND", "mysql")
+SQLITE_PATH = os.environ.get("CASHGAMEBOT_SQLITE_PATH", "cashgamebot.db")
+DATABASE_NAME = "cashgamebot"
+POOL_SIZE = 5
+SHARD_COUNT = int(os.environ.get("CASHGAMEBOT_DB_SHARDS", "1"))
+# seconds a SQLite connection waits for another thread's write to finish before giving up
+SQLITE_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+# ------------- FUNCTIONS -------------
+
+
+def create_server_connection(host_name, user_name, user_password):
+    import mysql.connector
+    from mysql.connector import Error
+    connection = None
+    try:
+        connection = mysql.connector.connect(
+            host=host_name,
+            user=user_name,
+            passwd=user_password
+        )
+        logger.info("MySQL Database connection successful")
+    except Error as err:
+        logger.error("MySQL connection failed: '%s'", err)
+
+    return connection
+
+
+def get_connection():
+    from sql_password import PASS
+    return create_server_connection("localhost", "root", PASS)
+
+
+# Returns the MySQL database name or SQLite path of shard 'shard', given the one of shard 0.
+def shard_database(database, shard):
+    if not shard or database == ":memory:":
+        return database
+    root, extension = os.path.splitext(database)
+    return f"{root}_{shard}{extension}"
+
+
+def make_backend(name=None, pool_size=POOL_SIZE, shard=0):
+    name = name or STORAGE_BACKEND
+    if name == "mysql":
+        return MySQLBackend(pool_size=pool_size, database=shard_database(DATABASE_NAME, shard))
+    if name == "sqlite":
+        return SQLiteBackend(shard_database(SQLITE_PATH, shard), pool_size=pool_size)
+    raise ValueError(f"Unknown storage backend '{name}', expected 'mysql' or 'sqlite'")
+
+
+# ------------- CLASSES -------------
+
+
+# class MySQLBackend runs Balances on the local MySQL server.
+# Initialize: backend = MySQLBackend(pool_size)
+class MySQLBackend:
+    dialect = "mysql"
+
+    def __init__(self, pool_size=POOL_SIZE, host_name="localhost", user_name="root", database=DATABASE_NAME):
+        from mysql.connector import Error
+        from connection_pool import ConnectionPool
+        from sql_password import PASS
+        self.Error = Error
+        self.pool = ConnectionPool(host_name, user_name, PASS, database, pool_size)
+        self.pool_size = pool_size
+
+    def connection(self):
+        return self.pool.connection()
+
+    def sql(self, query):
+        return query
+
+    def last_insert_id(self, table, column):
+        return "LAST_INSERT_ID()"
+
+    def seconds_between(self, start, end):
+        return f"TIMESTAMPDIFF(SECOND, {start}, {end})"
+
+    def store_money(self, amount):
+        return amount
+
+    def load_money(self, value):
+        return value
+
+    def insert_or_add(self, table, columns, keys, added, row_count):
+        values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * row_count)
+        return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+                f"ON DUPLICATE KEY UPDATE " + ", ".join(f"{column} = {column} + VALUES({column})" for column in added))
+
+    def update_from(self, table, subquery, alias, key, assignments, where=None):
+        return (f"UPDATE {table} JOIN ({subquery}) AS {alias} ON {table}.{key} = {alias}.{key} "
+                f"SET {assignments}" + (f" WHERE {where}" if where else ""))
+
+    def close(self):
+        self.pool.close()
+
+
+# class SQLiteBackend runs Balances on an embedded SQLite database file in WAL mode. Each thread gets its own
+#   connection; WAL lets readers carry on while another thread writes.
+# Initialize: backend = SQLiteBackend(path, pool_size)
+class SQLiteBackend:
+    dialect = "sqlite"
+    Error = sqlite3.Error
+
+    def __init__(self, path=SQLITE_PATH, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        if path == ":memory:":
+            # a named shared-cache database, so every thread's connection sees the same data
+            self.database = f"file:cashgamebot-{uuid.uuid4().hex}?mode=memory&cache=shared"
+            self.uri = True
+        else:
+            self.database = path
+            self.uri = False
+        # opened straight away so WAL mode is set before any other connection exists, and so an in-memory database
+        #   stays alive as long as the backend does
+        self.keep_alive = self.__open()
+
+    def __open(self):
+        connection = sqlite3.connect(self.database, uri=self.uri, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        if not self.uri:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.__open()
+            self.local.connection = connection
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+
+    def sql(self, query):
+        return query.replace("%s", "?")
+
+    # last_insert_rowid() changes with every row an INSERT ... SELECT adds, so read the id back instead. Only one
+    #   connection can be writing at a time, so the newest id is this connection's.
+    def last_insert_id(self, table, column):
+        return f"(SELECT MAX({column}) FROM {table})"
+
+    def seconds_between(self, start, end):
+        return f"CAST(ROUND((julianday({end}) - julianday({start})) * 86400) AS INTEGER)"
+
+    # Money is stored as whole cents (see the top of this file).
+    def store_money(self, amount):
+        return int(Decimal(amount).scaleb(2))
+
+    def load_money(self, value):
+        return Decimal(value).scaleb(-2)
+
+    def insert_or_add(self, table, columns, keys, added, row_count):
+        values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * row_count)
+        return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+                f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+                + ", ".join(f"{column} = {column} + excluded.{column}" for column in added))
+
+    def update_from(self, table, subquery, alias, key, assignments, where=None):
+        return (f"UPDATE {table} SET {assignments} "
+                f"FROM ({subquery}) AS {alias} WHERE {table}.{key} = {alias}.{key}"
+                + (f" AND {where}" if where else ""))
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
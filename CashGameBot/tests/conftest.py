@@ -0,0 +1,46 @@
+# Tests of the ledger against throwaway in-memory SQLite databases (see storage.py). They need no discord, MySQL or
+# bot token: run 'python -m pytest' from the repository or CashGameBot/. interactions.py needs discord, so it isn't
+# covered here.
+
+import os
+import sys
+from collections import namedtuple
+import pytest
+
+# the bot's modules import each other by name from CashGameBot/, as when the bot runs from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from balances import Balances  # noqa: E402
+from storage import SQLiteBackend  # noqa: E402
+
+# stands in for a discord user: Balances only reads .id and .name
+User = namedtuple("User", ["id", "name"])
+
+
+@pytest.fixture
+def backend():
+    backend = SQLiteBackend(":memory:")
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def users():
+    return [User(player_id, f"player{player_id}") for player_id in range(1, 6)]
+
+
+# The ledger of guild 1, with every user of 'users' as a player.
+@pytest.fixture
+def ledger(backend, users):
+    balances = Balances(backend=backend, guild_id=1)
+    for user in users:
+        balances.add_player(user)
+    return balances
+
+
+# Everything the projections hold for 'balances': every player's balance and net_gain, what every pair owes each
+#   other, and the leaderboard.
+def snapshot(balances):
+    players = sorted((plr.player_id, plr.balance, plr.net) for plr in balances.get_players())
+    pairs = {player_id: balances.get_counterparty_totals(User(player_id, "")) for player_id, _, _ in players}
+    return players, pairs, balances.get_leaderboard()
@@ -0,0 +1,82 @@
+from decimal import Decimal
+import pytest
+from balances import CHECKPOINTS_KEPT
+from conftest import snapshot
+
+
+def test_void_moves_every_projection_back(ledger, users):
+    ledger.add_debt("buyin", users[0], users[1], 20)
+    ledger.add_debt("payment", users[1], users[2], -5)
+    before = snapshot(ledger)
+    ledger.add_debt("buyin", users[2], users[3], "12.34")
+    debt_id = ledger.get_voidable_debts(1)[0].debt_id
+
+    voided = ledger.void_debt(debt_id)
+
+    assert (voided.debt_type, voided.amount) == ("buyin", Decimal("12.34"))
+    assert snapshot(ledger) == before
+    assert [debt.debt_id for debt in ledger.get_voidable_debts(5)] != [debt_id]
+    with pytest.raises(ValueError):
+        ledger.void_debt(debt_id)
+
+
+def test_void_in_a_session_comes_off_its_ledger(ledger, users):
+    ledger.start_session(users[0].id, "table")
+    ledger.add_debt("buyin", users[0], users[1], 30, "table")
+    ledger.add_debt("buyin", users[0], users[2], 10, "table")
+    ledger.void_debt(ledger.get_voidable_debts(1)[0].debt_id)
+
+    assert ledger.get_session_ledger("table").chips_in_play() == Decimal(30)
+    ledger.add_debt("cashout", users[1], users[0], 30, "table")
+    ledger.end_session("table")
+    nets = {plr.player_id: plr.net for plr in ledger.get_players()}
+    assert nets[users[2].id] == 0
+
+
+def test_undo_only_reaches_the_callers_table(ledger, users):
+    ledger.start_session(users[0].id, "first")
+    ledger.start_session(users[1].id, "second")
+    ledger.add_debt("payment", users[3], users[4], -2)
+    ledger.add_debt("buyin", users[0], users[2], 10, "first")
+    ledger.add_debt("buyin", users[1], users[3], 20, "second")
+
+    assert ledger.undo_last("first").amount == Decimal(10)
+    with pytest.raises(ValueError):
+        ledger.undo_last("first")
+    # no session at this table: the latest debt outside every running session
+    assert ledger.undo_last("elsewhere").debt_type == "payment"
+    assert ledger.undo_last("second").amount == Decimal(20)
+    assert all(balance == 0 for _, balance, _ in snapshot(ledger)[0])
+
+
+def test_checkpoint_rebuild_matches_full_rebuild(ledger, users):
+    for amount in (10, 25, 40):
+        ledger.add_debt("buyin", users[0], users[1], amount)
+    ledger.refresh_balances()
+    ledger.start_session(users[2].id, "table")
+    ledger.add_debt("buyin", users[2], users[3], 50, "table")
+    ledger.add_debt("cashout", users[4], users[2], 35, "table")
+    ledger.end_session("table")
+    ledger.add_debt("payment", users[1], users[0], -15)
+    ledger.void_debt(ledger.get_voidable_debts(3)[-1].debt_id)
+    incremental = snapshot(ledger)
+
+    assert ledger.refresh_balances(full=False) is not None
+    from_checkpoint = snapshot(ledger)
+    assert ledger.refresh_balances(full=True) is not None
+
+    assert from_checkpoint == incremental
+    assert snapshot(ledger) == incremental
+
+
+def test_only_the_latest_checkpoints_are_kept(ledger, users):
+    for _ in range(CHECKPOINTS_KEPT + 2):
+        ledger.add_debt("buyin", users[0], users[1], 5)
+        ledger.refresh_balances()
+    with ledger.backend.connection() as connection:
+        cursor = connection.cursor()
+        for table_name in ("balance_checkpoint", "player_checkpoint", "pair_checkpoint"):
+            cursor.execute(f"SELECT COUNT(DISTINCT checkpoint_id) FROM {table_name} WHERE guild_id = 1")
+            assert cursor.fetchall()[0][0] == CHECKPOINTS_KEPT
+    assert ledger.refresh_balances(full=False) is not None
+    assert snapshot(ledger)[0][0][1] == Decimal(5 * (CHECKPOINTS_KEPT + 2))
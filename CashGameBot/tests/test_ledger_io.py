@@ -0,0 +1,78 @@
+import pytest
+from balances import Balances
+from ledger_io import export_ledger, import_ledger
+from conftest import snapshot
+
+
+@pytest.fixture
+def history(ledger, users):
+    ledger.add_debt("buyin", users[0], users[1], 20)
+    ledger.start_session(users[0].id, "table")
+    ledger.add_debt("buyin", users[0], users[2], 40, "table")
+    ledger.add_debt("cashout", users[3], users[0], 55, "table")
+    ledger.end_session("table")
+    ledger.add_debt("payment", users[1], users[0], "-7.50")
+    ledger.void_debt(ledger.get_voidable_debts(1)[0].debt_id)
+    ledger.add_debt("buyin", users[4], users[1], "0.01")
+    return ledger
+
+
+# The debt records of 'balances' without their ids, and every reversal as the position of the debt it voids.
+def events(balances):
+    records = [record for record in balances.iter_records() if record[0] == "debt"]
+    positions = {record[7]: position for position, record in enumerate(records)}
+    return [record[1:6] + (positions.get(record[8]),) for record in records]
+
+
+@pytest.mark.parametrize("file_name", ["ledger.jsonl", "ledger.jsonl.gz", "ledger.zip"])
+def test_import_round_trip(backend, history, tmp_path, file_name):
+    path = str(tmp_path / file_name)
+    export_ledger(history, path)
+    restored = Balances(backend=backend, guild_id=2)
+
+    result = import_ledger(restored, path)
+
+    assert result.reconciles()
+    assert (result.players, result.sessions, result.ended_sessions) == (5, 1, 0)
+    assert snapshot(restored) == snapshot(history)
+    assert events(restored) == events(history)
+
+
+def test_import_twice_is_refused(backend, history, tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    export_ledger(history, path)
+    restored = Balances(backend=backend, guild_id=2)
+    import_ledger(restored, path)
+    before = snapshot(restored)
+
+    with pytest.raises(ValueError):
+        import_ledger(restored, path)
+    assert snapshot(restored) == before
+
+
+def test_import_rejects_unknown_players(backend, users, tmp_path):
+    path = tmp_path / "debts.csv"
+    path.write_text("debt_type,recipient_id,payer_id,amount,date\n"
+                    "buyin,1,2,10,2024-01-02 10:00:00\n"
+                    "buyin,1,99,10,2024-01-02 11:00:00\n")
+    restored = Balances(backend=backend, guild_id=2)
+    for user in users[:2]:
+        restored.add_player(user)
+
+    with pytest.raises(ValueError, match="99"):
+        import_ledger(restored, str(path))
+    assert restored.get_debts() == []
+
+
+def test_import_ends_running_sessions(backend, ledger, users, tmp_path):
+    ledger.start_session(users[0].id, "table")
+    ledger.add_debt("buyin", users[0], users[1], 10, "table")
+    path = str(tmp_path / "ledger.jsonl")
+    export_ledger(ledger, path)
+    restored = Balances(backend=backend, guild_id=2)
+
+    result = import_ledger(restored, path)
+
+    assert result.ended_sessions == 1
+    assert restored.get_sessions() == []
+    assert restored.refresh_balances(full=False) is not None
@@ -0,0 +1,59 @@
+import sqlite3
+import pytest
+import migrations
+from balances import Balances
+from storage import SQLiteBackend
+from conftest import User
+
+
+def test_failed_sqlite_migration_can_be_retried(tmp_path, monkeypatch):
+    backend = SQLiteBackend(str(tmp_path / "ledger.db"))
+    shipped = list(migrations.MIGRATIONS)
+    monkeypatch.setattr(migrations, "MIGRATIONS", [migration for migration in shipped if migration[0] <= 5])
+    migrations.migrate(backend)
+    version, description, steps = shipped[5]
+
+    def fail_halfway(cursor):
+        steps["sqlite"](cursor)
+        raise sqlite3.OperationalError("failed halfway")
+    monkeypatch.setattr(migrations, "MIGRATIONS", shipped[:5] + [(version, description, {"sqlite": fail_halfway})])
+    with pytest.raises(sqlite3.OperationalError):
+        migrations.migrate(backend)
+    with backend.connection() as connection:
+        assert "guild_id" not in migrations.get_columns_sqlite(connection.cursor(), "debt_history")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", shipped)
+    assert migrations.migrate(backend) == [migration[0] for migration in shipped[5:]]
+    backend.close()
+
+
+def test_claim_guild_merges_into_an_unused_guild(backend, users):
+    old = Balances(backend=backend)
+    for user in users[:3]:
+        old.add_player(user)
+    old.add_debt("buyin", users[0], users[1], 10)
+    old.get_journal_seq("debts")
+    new = Balances(backend=backend, guild_id=7)
+    new.add_player(users[0])
+    new.add_player(User(42, "newcomer"))
+    new.get_journal_seq("debts")
+    new.refresh_balances()
+
+    migrations.claim_guild(backend, 7)
+
+    claimed = Balances(backend=backend, guild_id=7)
+    assert sorted((plr.player_id, plr.balance) for plr in claimed.get_players()) == [
+        (1, 10), (2, -10), (3, 0), (42, 0)]
+    assert claimed.refresh_balances(full=False) is not None
+    assert Balances(backend=backend).get_players() == []
+
+
+def test_claim_guild_refuses_a_guild_with_debts(backend, users):
+    Balances(backend=backend).add_player(users[0])
+    busy = Balances(backend=backend, guild_id=7)
+    busy.add_player(users[1])
+    busy.add_debt("buyin", users[1], users[1], 1)
+
+    with pytest.raises(ValueError):
+        migrations.claim_guild(backend, 7)
+    assert len(Balances(backend=backend).get_players()) == 1
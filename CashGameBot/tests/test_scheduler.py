@@ -0,0 +1,70 @@
+import asyncio
+from scheduler import CommandScheduler, QueueFull, READ, WRITE
+
+
+# Runs a command called 'name' in a slot of 'scheduler', logging when it starts and ends (or that the queue was full).
+async def command(scheduler, log, name, mode, seconds):
+    try:
+        async with scheduler.slot("guild", mode):
+            log.append(("start", name))
+            await asyncio.sleep(seconds)
+            log.append(("end", name))
+    except QueueFull as err:
+        log.append(("full", name, err.waiting))
+
+
+# Starts every (name, mode, seconds) command in order, each queued before the next one arrives.
+async def arrive(scheduler, log, commands):
+    tasks = []
+    for name, mode, seconds in commands:
+        tasks.append(asyncio.create_task(command(scheduler, log, name, mode, seconds)))
+        await asyncio.sleep(0)
+    return tasks
+
+
+def test_commands_run_in_arrival_order():
+    async def run():
+        scheduler = CommandScheduler(max_queue_depth=10)
+        log = []
+        await asyncio.gather(*await arrive(scheduler, log, [
+            ("read1", READ, 0.02), ("read2", READ, 0.02), ("write1", WRITE, 0.01), ("read3", READ, 0.01),
+            ("write2", WRITE, 0.01)]))
+        return scheduler, log
+
+    scheduler, log = asyncio.run(run())
+    # the two reads share the ledger, the write waits for both, and the read queued behind it sees its result
+    assert log.index(("start", "read2")) < log.index(("end", "read1"))
+    assert log.index(("start", "write1")) > max(log.index(("end", "read1")), log.index(("end", "read2")))
+    assert log.index(("start", "read3")) > log.index(("end", "write1"))
+    assert log.index(("start", "write2")) > log.index(("end", "read3"))
+    assert not scheduler.lanes
+
+
+def test_full_queue_is_refused():
+    async def run():
+        scheduler = CommandScheduler(max_queue_depth=2)
+        log = []
+        await asyncio.gather(*await arrive(scheduler, log, [
+            ("write1", WRITE, 0.01), ("write2", WRITE, 0.01), ("write3", WRITE, 0.01), ("write4", WRITE, 0.01)]))
+        return log
+
+    log = asyncio.run(run())
+    assert ("full", "write4", 2) in log
+    assert ("end", "write3") in log
+
+
+def test_cancelled_writer_lets_the_reads_behind_it_in():
+    async def run():
+        scheduler = CommandScheduler(max_queue_depth=10)
+        log = []
+        read1, write, read2 = await arrive(scheduler, log, [
+            ("read1", READ, 0.05), ("write", WRITE, 0.01), ("read2", READ, 0.01)])
+        write.cancel()
+        await asyncio.sleep(0.02)
+        started_early = ("start", "read2") in log and ("end", "read1") not in log
+        await asyncio.gather(read1, read2, return_exceptions=True)
+        return scheduler, started_early
+
+    scheduler, started_early = asyncio.run(run())
+    assert started_early
+    assert not scheduler.lanes
@@ -0,0 +1,87 @@
+from metrics import registry
+
+# --- READ ME! ---:
+# This file keeps an index of discord users by name and by id so commands can resolve players in constant time,
+# instead of scanning every user the bot can see on every lookup.
+#
+# for usage in file, write:
+# 'from user_index import UserIndex'
+#
+# user_index = UserIndex()
+# user_index.rebuild(bot.users)              # once the bot is ready
+# user_index.load_players(players)           # Player objects from Balances.get_players(), used as a fallback
+# user_index.add(member) / user_index.remove(member) / user_index.rename(before, after)   # from discord events
+# user_index.get(user_name=...) or user_index.get(user_id=...)   # returns the user, or False if unknown
+#
+# Players who have left every guild the bot is in are still found by get(), using the name stored in
+# player_data.player_name. They come back as DepartedUser objects, which have the same .id and .name attributes as
+# discord users.
+
+
+# ------------- CLASSES -------------
+
+
+# class DepartedUser stands in for a player who is no longer in any guild the bot can see.
+# Initialize: user = DepartedUser(user_id, name)
+class DepartedUser:
+    __slots__ = ("id", "name")
+
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"DepartedUser({self.id}, {self.name!r})"
+
+
+# class UserIndex maps user names and ids to discord users, falling back to players stored in the database.
+# Initialize: user_index = UserIndex()
+class UserIndex:
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.departed_by_id = {}
+        self.departed_by_name = {}
+
+    def rebuild(self, users):
+        self.by_id = {}
+        self.by_name = {}
+        for user in users:
+            self.add(user)
+
+    def load_players(self, players):
+        for plr in players:
+            self.__add_departed(DepartedUser(int(plr.player_id), plr.name))
+
+    def __add_departed(self, user):
+        self.departed_by_id[user.id] = user
+        self.departed_by_name[user.name] = user
+
+    def add(self, user):
+        old = self.by_id.get(user.id)
+        if old is not None and self.by_name.get(old.name) is old:
+            del self.by_name[old.name]
+        self.by_id[user.id] = user
+        self.by_name[user.name] = user
+
+    # Called when a user is no longer visible to the bot. They stay resolvable as a DepartedUser.
+    def remove(self, user):
+        old = self.by_id.pop(user.id, None)
+        if old is not None and self.by_name.get(old.name) is old:
+            del self.by_name[old.name]
+        self.__add_departed(DepartedUser(user.id, user.name))
+
+    def rename(self, before, after):
+        # add() drops the index entry for the old name
+        self.add(after)
+
+    def get(self, user_name=None, user_id=None):
+        if user_name is not None:
+            user = self.by_name.get(user_name) or self.departed_by_name.get(user_name)
+        else:
+            user = self.by_id.get(user_id) or self.departed_by_id.get(user_id)
+        registry.cache("users", user is not None)
+        return user if user is not None else False
@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from balances import get_current_time_sql, to_money
+from events import check_debt_type
+from metrics import registry
+from sessions import DEFAULT_TABLE
+
+# --- READ ME! ---:
+# This file holds the optional write-behind mode for recording debts during busy sessions.
+#
+# for usage in file, write:
+# 'from write_behind import WriteBehindBalances'
+#
+# balances = WriteBehindBalances(Balances(), journal_path)
+#
+# WriteBehindBalances wraps a Balances. add_debt / add_debts return as soon as the debts are appended to a local journal
+# file and synced to disk, then a background thread writes them to the database in batches: once BATCH_SIZE journal
+# entries are waiting, or FLUSH_DELAY seconds after the oldest one arrived. Every other Balances method passes straight
+# through, so it can be wrapped in AsyncBalances just like a plain Balances.
+#
+# No accepted debt is lost: its journal entry is on disk before the command gets an answer, and every batch moves the
+# journal's watermark in journal_state (see migrations.py) in the same transaction as its debts. On start up, entries
+# past the watermark are written to the database before anything else, and entries at or below it are skipped, so
+# nothing is recorded twice. The watermark only moves forward, and a batch it's already past isn't written again (see
+# Balances.add_debts), so neither is a batch replayed late or written by a second flusher. Once everything queued is
+# in the database the journal file is emptied.
+#
+# Queued debts show up in balances, the leaderboard and 'lb session status' once their batch is written.
+# end_session, void_debt, undo_last, get_voidable_debts, iter_records (exports) and import_records write every queued
+# debt first. If the database refuses a batch, it's retried every RETRY_DELAY seconds and later debts wait behind it,
+# so the order debts were accepted in is kept.
+#
+# The bot turns this on when the environment variable CASHGAMEBOT_WRITE_BEHIND is set to 1 (see interactions.py).
+#
+# Every guild has its own journal file (guild_journal_path). The single journal the bot kept before that (JOURNAL_PATH
+# itself) belongs to guild 0's ledger (see migrations.py): the bot replays whatever is left in it there when it starts
+# (replay_legacy_journal), before the ledger can be claimed by a guild. To replay it into a guild that claimed the old
+# ledger already, run 'python write_behind.py --replay-legacy <guild_id>'.
+
+
+# ------------- CONSTANTS -------------
+
+
+ENABLED = os.environ.get("CASHGAMEBOT_WRITE_BEHIND", "0") == "1"
+JOURNAL_PATH = os.environ.get("CASHGAMEBOT_JOURNAL_PATH", "debt_journal.jsonl")
+JOURNAL_KEY = "debts"
+# journal entries (one per add_debts call) written to the database per transaction
+BATCH_SIZE = 50
+# seconds a debt can wait in the queue before its batch is written
+FLUSH_DELAY = 0.5
+RETRY_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+# ------------- FUNCTIONS -------------
+
+
+# Splits journal 'entries' into batches of at most 'batch_size' consecutive entries for the same table_key, oldest
+#   first. Each batch becomes one Balances.add_debts call.
+def make_batches(entries, batch_size=BATCH_SIZE):
+    batches = []
+    for entry in entries:
+        if batches and batches[-1][0]["table_key"] == entry["table_key"] and len(batches[-1]) < batch_size:
+            batches[-1].append(entry)
+        else:
+            batches.append([entry])
+    return batches
+
+
+# Reads the entries of the journal at 'path' with a seq above 'after_seq'. A line cut short by a crash mid-write was
+#   never acknowledged, so it's skipped.
+def read_journal(path, after_seq):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["seq"] > after_seq:
+                entries.append(entry)
+    return entries
+
+
+# Journal file of guild 'guild_id' (every guild's ledger has its own queue, see sharding.py).
+def guild_journal_path(guild_id, path=JOURNAL_PATH):
+    root, extension = os.path.splitext(path)
+    return f"{root}-{guild_id}{extension}"
+
+
+# Writes the entries left in the journal at 'path', kept before every guild had its own, to the ledger of 'balances'
+#   (guild 0's, or the guild that claimed it), then deletes the file. Returns how many entries were replayed. Raises
+#   RuntimeError if they can't all be written, or if the ledger has no watermark for the journal, e.g. guild 0's after
+#   it was claimed: replaying there would record the debts twice.
+def replay_legacy_journal(balances, path=JOURNAL_PATH):
+    entries = read_journal(path, 0)
+    if entries:
+        last_seq = balances.get_journal_seq(JOURNAL_KEY, register=False)
+        if last_seq is None:
+            raise RuntimeError(f"{path} holds debts journaled before every guild had its own journal, and guild "
+                               f"{balances.guild_id} has no watermark for them. Replay them into the guild that "
+                               f"claimed the old ledger: 'python write_behind.py --replay-legacy <guild_id>'")
+        entries = [entry for entry in entries if entry["seq"] > last_seq]
+        writer = WriteBehindBalances(balances, path)
+        writer.close()
+        if writer.pending:
+            raise RuntimeError(f"{len(writer.pending)} entries of {path} could not be written, see the log")
+        logger.info("Replayed %s entries of %s into guild %s", len(entries), path, balances.guild_id)
+    if os.path.exists(path):
+        os.remove(path)
+    return len(entries)
+
+
+# ------------- CLASSES -------------
+
+
+# class PlayerRef stands in for a discord user when replaying journaled debts, which only store player ids.
+# Initialize: ref = PlayerRef(player_id)
+class PlayerRef(namedtuple("PlayerRef", ["id"])):
+    __slots__ = ()
+
+
+# class WriteBehindBalances wraps a Balances, queueing debts in a journal and writing them to the database in batches.
+#   Thread-safe.
+# Initialize: balances = WriteBehindBalances(balances) or WriteBehindBalances(balances, journal_path, batch_size,
+#   flush_delay)
+class WriteBehindBalances:
+    def __init__(self, balances, journal_path=JOURNAL_PATH, batch_size=BATCH_SIZE, flush_delay=FLUSH_DELAY,
+                 journal_key=JOURNAL_KEY):
+        self.balances = balances
+        self.journal_path = journal_path
+        self.journal_key = journal_key
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        # guards the journal file and the queue; flush_lock keeps batches going to the database one at a time
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        # journal entries not in the database yet, oldest first, each with the time it was accepted
+        last_seq = balances.get_journal_seq(journal_key)
+        self.pending = [{**entry, "accepted": time.monotonic()} for entry in read_journal(journal_path, last_seq)]
+        self.seq = max([entry["seq"] for entry in self.pending], default=last_seq)
+        if self.pending:
+            logger.info("Replaying %s journaled debt entries", len(self.pending))
+        self.journal = open(journal_path, "a", encoding="utf-8")
+        self.flush()
+        self.thread = threading.Thread(target=self.__run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.balances, name)
+
+    def add_debt(self, debt_type, recipient, payer, amount, table_key=None):
+        return self.add_debts([(debt_type, recipient, payer, amount)], table_key)
+
+    # Journals 'debts' (same format as Balances.add_debts) and queues them for the database. Returns True once they're
+    #   safely on disk, False if the journal couldn't be written (nothing is queued then). Raises ValueError on a
+    #   debt_type that isn't a debt, like Balances.add_debts.
+    def add_debts(self, debts, table_key=None):
+        if not debts:
+            return True
+        now = get_current_time_sql()
+        rows = []
+        for debt in debts:
+            debt_type, recipient, payer, amount = debt[:4]
+            # checked before it's journaled, so a bad debt can't hold up the queue behind it
+            check_debt_type(debt_type)
+            rows.append([debt_type, recipient.id, payer.id, str(to_money(amount)), debt[4] if len(debt) > 4 else now])
+        with self.lock:
+            if self.closed:
+                return False
+            entry = {"seq": self.seq + 1, "table_key": table_key, "debts": rows}
+            position = self.journal.tell()
+            try:
+                self.journal.write(json.dumps(entry) + "\n")
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            except OSError as err:
+                logger.error("Could not write debt journal: '%s'", err)
+                self.journal.truncate(position)
+                return False
+            self.seq += 1
+            entry["accepted"] = time.monotonic()
+            self.pending.append(entry)
+            registry.set("write_behind_pending", len(self.pending))
+            # the flusher needs waking to start the FLUSH_DELAY clock, or because a batch is full
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.wakeup.notify()
+        return True
+
+    # Voiding goes straight to the database, once every queued debt is written, so the debt to void is there and a
+    #   later one isn't undone in its place (see Balances.void_debt).
+    def void_debt(self, debt_id):
+        self.flush()
+        return self.balances.void_debt(debt_id)
+
+    def undo_last(self, table_key=None):
+        if not self.flush():
+            return None
+        return self.balances.undo_last(table_key)
+
+    def get_voidable_debts(self, count):
+        self.flush()
+        return self.balances.get_voidable_debts(count)
+
+    # Exports and imports work on the whole ledger, so every queued debt is written first (see ledger_io.py).
+    def iter_records(self):
+        if not self.flush():
+            raise RuntimeError("Queued debts could not be written to the database, try again in a moment")
+        return self.balances.iter_records()
+
+    def import_records(self, records):
+        if not self.flush():
+            return None
+        return self.balances.import_records(records)
+
+    # Writes every queued debt to the database, one transaction per batch. Returns True if the queue is empty
+    #   afterwards, False if a batch failed (it stays queued, with everything after it).
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                entries = list(self.pending)
+            for batch in make_batches(entries, self.batch_size):
+                debts = [(debt_type, PlayerRef(recipient_id), PlayerRef(payer_id), amount, date)
+                         for entry in batch for debt_type, recipient_id, payer_id, amount, date in entry["debts"]]
+                if not self.balances.add_debts(debts, batch[0]["table_key"], (self.journal_key, batch[-1]["seq"])):
+                    return False
+                with self.lock:
+                    del self.pending[:len(batch)]
+                    registry.set("write_behind_pending", len(self.pending))
+            with self.lock:
+                if not self.pending:
+                    self.__empty_journal()
+            return True
+
+    # Called with self.lock held, once every journaled entry is in the database.
+    def __empty_journal(self):
+        try:
+            self.journal.seek(0)
+            self.journal.truncate()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except OSError as err:
+            # harmless: entries already in the database are skipped when the journal is replayed
+            logger.warning("Could not empty debt journal: '%s'", err)
+
+    # Seconds until the oldest queued entry is due to be written (0 if a batch is already full), or None if the queue
+    #   is empty. Called with self.lock held.
+    def __time_to_flush(self):
+        if not self.pending:
+            return None
+        if len(self.pending) >= self.batch_size:
+            return 0
+        return max(0, self.pending[0]["accepted"] + self.flush_delay - time.monotonic())
+
+    def __run(self):
+        while True:
+            with self.lock:
+                while not self.closed and self.__time_to_flush() != 0:
+                    self.wakeup.wait(self.__time_to_flush())
+                if self.closed:
+                    return
+            if not self.flush():
+                with self.lock:
+                    self.wakeup.wait(RETRY_DELAY)
+
+    # Writes the queued debts, then ends the session like Balances.end_session. Returns None without ending it if the
+    #   queued debts couldn't be written.
+    def end_session(self, table_key=DEFAULT_TABLE):
+        if not self.flush():
+            return None
+        return self.balances.end_session(table_key)
+
+    # Stops the background thread and writes whatever is still queued. Debts that can't be written stay in the journal
+    #   for the next start.
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify_all()
+        self.thread.join()
+        self.flush()
+        self.journal.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from balances import Balances
+    from metrics import configure_logging
+    from sharding import LedgerRouter
+    parser = argparse.ArgumentParser(description="Write the debts left in the journal kept before every guild had its "
+                                                 "own to the database. Stop the bot first.")
+    parser.add_argument("--replay-legacy", type=int, metavar="GUILD_ID", required=True,
+                        help="guild whose ledger the journal belongs to: 0, or the guild that claimed it")
+    args = parser.parse_args()
+    configure_logging()
+    router = LedgerRouter()
+    try:
+        guild_balances = Balances(backend=router.get_backend(router.shard_of(args.replay_legacy)),
+                                  guild_id=args.replay_legacy)
+        print(f"Replayed {replay_legacy_journal(guild_balances)} journal entries")
+    except RuntimeError as err:
+        sys.exit(f"ERROR: {err}")
+    finally:
+        router.close()